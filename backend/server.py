@@ -1,26 +1,542 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.routing import APIRoute
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ReturnDocument, UpdateOne, WriteConcern, ASCENDING, DESCENDING
+from pymongo.read_preferences import Primary, SecondaryPreferred
+from pymongo.read_concern import ReadConcern
+from pymongo import monitoring
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from sortedcontainers import SortedList
 import os
+import sys
+import json
+import csv
+import io
+import asyncio
+import argparse
+import contextvars
 import logging
+import logging.handlers
+import queue
+import random
 import hashlib
+import hmac
+import base64
+import bisect
+import time
+import threading
+import traceback
+import functools
+import math
+from collections import deque
+from contextlib import asynccontextmanager
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Annotated
+from typing import List, Optional, Annotated, Union, get_args, get_origin
 import uuid
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 from jose import JWTError, jwt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
+# The client is created by the app lifespan (or connect_mongo() in the CLI) so the
+# pool settings below are read once per process, not at import time.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+client = None
+db = None
+
+def _env_int(name: str):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else None
+
+def _write_concern(value: str, journal: Optional[bool] = None):
+    w = int(value) if value.isdigit() else value
+    timeout = _env_int("MONGO_WRITE_TIMEOUT_MS")
+    return WriteConcern(w=w, j=journal, wtimeout=timeout) if timeout else WriteConcern(w=w, j=journal)
+
+# Write concern per operation class. "critical" covers money and points (orders,
+# ledger, balances), "bulk" covers batch jobs and migrations, "default" the rest.
+WRITE_CONCERNS = {
+    "critical": _write_concern(os.environ.get("MONGO_WRITE_CONCERN_CRITICAL", "majority"), journal=True),
+    "default": _write_concern(os.environ.get("MONGO_WRITE_CONCERN", "1")),
+    "bulk": _write_concern(os.environ.get("MONGO_WRITE_CONCERN_BULK", "1")),
+}
+
+# Compressor name -> module it needs; zlib ships with Python
+_COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+def _available_compressors(names: str):
+    available = []
+    for name in filter(None, (name.strip() for name in names.split(","))):
+        module = _COMPRESSOR_MODULES.get(name)
+        try:
+            if module is None:
+                raise ImportError(name)
+            __import__(module)
+            available.append(name)
+        except ImportError:
+            logger.warning(f"MongoDB compressor {name} requested but {module or 'unknown'} is not installed, skipping")
+    return available
+
+class PoolMonitor(ConnectionPoolListener):
+    """Connection checkout accounting for every pool of the client.
+
+    Checkout start and end are reported on the same thread (Motor runs each
+    operation on an executor thread), so the wait is timed with a thread-local.
+    """
+    
+    def __init__(self, sample_size: int = 1024):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=sample_size)
+        self.checkouts = 0
+        self.checkout_failures = {}
+        self.checked_out = 0
+        self.open_connections = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.pool_clears = 0
+    
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+    
+    def _wait_ms(self):
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return (time.perf_counter() - started) * 1000 if started is not None else 0.0
+    
+    def connection_checked_out(self, event):
+        wait_ms = self._wait_ms()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            self._waits.append(wait_ms)
+    
+    def connection_check_out_failed(self, event):
+        self._wait_ms()
+        with self._lock:
+            self.checkout_failures[event.reason] = self.checkout_failures.get(event.reason, 0) + 1
+    
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+    
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+    
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+    
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_closed(self, event):
+        pass
+    
+    def connection_ready(self, event):
+        pass
+    
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            checkouts = self.checkouts
+            return {
+                "checkouts": checkouts,
+                "checkout_failures": dict(self.checkout_failures),
+                "checked_out": self.checked_out,
+                "open_connections": self.open_connections,
+                "pool_clears": self.pool_clears,
+                "avg_wait_ms": round(self.total_wait_ms / checkouts, 3) if checkouts else 0.0,
+                "p95_wait_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 3),
+            }
+
+pool_monitor = PoolMonitor()
+
+# Query accounting
+# Every Mongo command is charged to the HTTP request that issued it through a
+# context variable (Motor runs commands on executor threads with a copy of the
+# caller's context). MONGO_QUERY_STATS=header adds X-DB-* and a "db" Server-Timing
+# entry to responses, =log writes one line per request, "header,log" does both;
+# streamed responses only count commands issued before their headers went out.
+# Commands slower than MONGO_SLOW_QUERY_MS (0 disables) are logged with their
+# collection and filter shape: field names and operators, never values.
+QUERY_STATS_MODES = {mode.strip() for mode in os.environ.get("MONGO_QUERY_STATS", "").lower().split(",") if mode.strip()}
+SLOW_QUERY_MS = float(os.environ.get("MONGO_SLOW_QUERY_MS", "100"))
+
+request_query_stats = contextvars.ContextVar("request_query_stats", default=None)
+
+class RequestQueryStats:
+    """Commands issued on behalf of one request"""
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.commands = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest = None
+        self._lock = threading.Lock()
+
+    def add(self, command: str, duration_ms: float, failed: bool):
+        with self._lock:
+            self.commands += 1
+            self.failures += failed
+            self.total_ms += duration_ms
+            if duration_ms >= self.slowest_ms:
+                self.slowest_ms, self.slowest = duration_ms, command
+
+    def headers(self):
+        headers = [
+            (b"x-db-commands", str(self.commands).encode()),
+            (b"x-db-time-ms", f"{self.total_ms:.1f}".encode()),
+            (b"server-timing", f'db;dur={self.total_ms:.1f};desc="{self.commands} commands"'.encode()),
+        ]
+        if self.slowest:
+            headers.append((b"x-db-slowest", f"{self.slowest};dur={self.slowest_ms:.1f}".encode()))
+        return headers
+
+def query_shape(value, depth: int = 0):
+    """Filter with every value replaced by its type name, for logging without data.
+
+    Lists keep each distinct element shape once, in order, so `$in` lists of any
+    length share a shape while `$or` branches stay apart.
+    """
+    if depth > 6:
+        return "..."
+    if isinstance(value, dict):
+        return {key: query_shape(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = query_shape(item, depth + 1)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return type(value).__name__
+
+def pipeline_shape(pipeline):
+    """One entry per stage: `$match` shaped like a filter, other stages by their keys"""
+    return [
+        {
+            name: query_shape(stage[name]) if name == "$match"
+            else {key: "..." for key in stage[name]} if isinstance(stage[name], dict)
+            else "..."
+            for name in stage
+        }
+        for stage in pipeline
+    ]
+
+def command_shape(command_name: str, command):
+    """The part of a command that selects documents, in a comparable shape"""
+    if command_name == "aggregate":
+        return pipeline_shape(command.get("pipeline", []))
+    selector = None
+    if command_name in ("find", "distinct"):
+        selector = command.get("filter")
+    elif command_name in ("count", "findAndModify"):
+        selector = command.get("query")
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        selector = statements[0].get("q")
+    return query_shape(selector) if selector is not None else None
+
+class QueryMonitor(monitoring.CommandListener):
+    """Charges commands to the current request and logs slow ones"""
+
+    def __init__(self):
+        self._pending = {}
+        self.slow_queries = 0
+
+    def started(self, event):
+        stats = request_query_stats.get()
+        if stats is None and SLOW_QUERY_MS <= 0 and not span_timings.enabled:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "")
+        self._pending[(event.connection_id, event.request_id)] = (
+            stats, event.database_name, collection, event.command
+        )
+
+    def _finish(self, event, failed: bool):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        stats, database, collection, command = pending
+        duration_ms = event.duration_micros / 1000
+        label = f"{event.command_name} {collection}".strip()
+        if stats is not None:
+            stats.add(label, duration_ms, failed)
+        if span_timings.enabled:
+            span_timings.record(f"mongo.{event.command_name}", duration_ms / 1000)
+        if 0 < SLOW_QUERY_MS <= duration_ms:
+            self.slow_queries += 1
+            source = f" ({stats.method} {stats.path})" if stats is not None else ""
+            shape = json.dumps(command_shape(event.command_name, command), default=str)
+            logger.warning(
+                f"Slow query {duration_ms:.1f}ms{source}: {event.command_name} {database}.{collection} filter={shape}",
+                extra={
+                    "event": "db.slow_query", "command": event.command_name, "namespace": f"{database}.{collection}",
+                    "duration_ms": round(duration_ms, 1), "filter_shape": shape
+                }
+            )
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+    def stats(self):
+        return {
+            "modes": sorted(QUERY_STATS_MODES),
+            "slow_query_ms": SLOW_QUERY_MS,
+            "slow_queries": self.slow_queries,
+            "in_flight": len(self._pending),
+        }
+
+query_monitor = QueryMonitor()
+
+class QueryStatsMiddleware:
+    """ASGI middleware scoping RequestQueryStats to each HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestQueryStats(scope["method"], scope["path"])
+        token = request_query_stats.set(stats)
+        status_code = None
+
+        async def send_with_stats(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if "header" in QUERY_STATS_MODES:
+                    message = {**message, "headers": [*message.get("headers", []), *stats.headers()]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            request_query_stats.reset(token)
+            if "log" in QUERY_STATS_MODES:
+                logger.info(
+                    f"{stats.method} {stats.path} {status_code}: {stats.commands} db commands, "
+                    f"{stats.total_ms:.1f}ms, slowest {stats.slowest or '-'} {stats.slowest_ms:.1f}ms",
+                    extra={
+                        "event": "db.request", "method": stats.method, "path": stats.path, "status": status_code,
+                        "db_commands": stats.commands, "db_time_ms": round(stats.total_ms, 1)
+                    }
+                )
+
+def mongo_client_options():
+    """AsyncIOMotorClient keyword arguments from MONGO_* environment variables.
+
+    Unset variables fall back to the driver defaults. tz_aware is always on so
+    native BSON dates come back as UTC-aware datetimes.
+    """
+    options = {"tz_aware": True, "event_listeners": [pool_monitor, query_monitor]}
+    for option, name in (
+        ("maxPoolSize", "MONGO_MAX_POOL_SIZE"),
+        ("minPoolSize", "MONGO_MIN_POOL_SIZE"),
+        ("maxIdleTimeMS", "MONGO_MAX_IDLE_TIME_MS"),
+        ("maxConnecting", "MONGO_MAX_CONNECTING"),
+        ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+        ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+        ("connectTimeoutMS", "MONGO_CONNECT_TIMEOUT_MS"),
+        ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS"),
+    ):
+        value = _env_int(name)
+        if value is not None:
+            options[option] = value
+    compressors = _available_compressors(os.environ.get("MONGO_COMPRESSORS", ""))
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+        if "zlib" in compressors and _env_int("MONGO_ZLIB_COMPRESSION_LEVEL") is not None:
+            options["zlibCompressionLevel"] = _env_int("MONGO_ZLIB_COMPRESSION_LEVEL")
+    if os.environ.get("MONGO_READ_PREFERENCE"):
+        options["readPreference"] = os.environ["MONGO_READ_PREFERENCE"]
+    default_concern = WRITE_CONCERNS["default"].document
+    options["w"] = default_concern["w"]
+    if "wtimeout" in default_concern:
+        options["wTimeoutMS"] = default_concern["wtimeout"]
+    return options
+
+def connect_mongo(mongo_client=None):
+    """Create (or adopt) the process-wide client and bind `db` to it"""
+    global client, db, mongo_options
+    if mongo_client is None:
+        mongo_options = mongo_client_options()
+        mongo_client = AsyncIOMotorClient(mongo_url, **mongo_options)
+    client = mongo_client
+    db = client[os.environ['DB_NAME']]
+    _class_collections.clear()
+    return client
+
+def close_mongo():
+    global client, db
+    if client is not None:
+        client.close()
+    client = db = None
+
+mongo_options = {}
+_class_collections = {}
+
+def collection_for(name: str, op_class: str = "default"):
+    """Collection handle carrying the write concern of an operation class"""
+    key = (name, op_class)
+    collection = _class_collections.get(key)
+    if collection is None:
+        collection = db.get_collection(name, write_concern=WRITE_CONCERNS[op_class])
+        _class_collections[key] = collection
+    return collection
+
+# Read routing
+# Opt-in (MONGO_READ_ROUTING=true, needs a replica set, e.g.
+# mongodb://localhost:27017/?replicaSet=rs0). Reads are tagged "strong" (primary),
+# "eventual" (secondaryPreferred within MONGO_MAX_STALENESS_SECONDS) or "user". A
+# user's own reads stay causally after that user's own recent writes: writes made
+# through causal_write record the session's cluster/operation time, and
+# read_session hands those to a causally consistent session so a secondary waits
+# until it has replicated them.
+#
+# Those tokens live in this process's memory: with several workers a user's next
+# request can land on a process that never saw their write. Reads of a user's own
+# data are tagged "user" and stay on the primary unless
+# MONGO_USER_READS_FROM_SECONDARIES=true, which is only correct when a single
+# process serves every request (WEB_CONCURRENCY=1) and is refused otherwise.
+READ_ROUTING_ENABLED = os.environ.get("MONGO_READ_ROUTING", "false").lower() in ("1", "true", "yes")
+USER_READS_FROM_SECONDARIES = os.environ.get("MONGO_USER_READS_FROM_SECONDARIES", "false").lower() in ("1", "true", "yes")
+if USER_READS_FROM_SECONDARIES and int(os.environ.get("WEB_CONCURRENCY", "1")) > 1:
+    raise RuntimeError(
+        "MONGO_USER_READS_FROM_SECONDARIES needs a single process: causal tokens are not shared between workers"
+    )
+# Whether a user's reads go to secondaries behind their own causal tokens
+CAUSAL_READS_ENABLED = READ_ROUTING_ENABLED and USER_READS_FROM_SECONDARIES
+# 90 seconds is the smallest max staleness MongoDB accepts
+MAX_STALENESS_SECONDS = max(90, int(os.environ.get("MONGO_MAX_STALENESS_SECONDS", "90")))
+
+READ_PREFERENCES = {
+    "strong": Primary(),
+    "eventual": SecondaryPreferred(max_staleness=MAX_STALENESS_SECONDS),
+}
+
+def read_collection(name: str, consistency: str = "strong"):
+    """Collection handle routed by consistency; everything reads the primary when routing is off"""
+    if consistency == "user":
+        consistency = "eventual" if CAUSAL_READS_ENABLED else "strong"
+    if not READ_ROUTING_ENABLED or consistency == "strong":
+        return db[name]
+    key = (name, consistency)
+    collection = _class_collections.get(key)
+    if collection is None:
+        collection = db.get_collection(name, read_preference=READ_PREFERENCES[consistency])
+        _class_collections[key] = collection
+    return collection
+
+class CausalTokens:
+    """Cluster and operation time of each user's latest write, kept for the staleness window.
+
+    Past the window a secondaryPreferred read is already bounded by max staleness,
+    so entries expire with it; the map is capped like the principal cache.
+    """
+    
+    def __init__(self, ttl_seconds: float, max_entries: int = 50000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}
+    
+    def record(self, user_id: str, session):
+        if session is None or session.operation_time is None:
+            return
+        cluster_time, operation_time = session.cluster_time, session.operation_time
+        current = self.get(user_id)
+        if current is not None:
+            if current[1] > operation_time:
+                operation_time = current[1]
+            if current[0] and cluster_time and current[0]["clusterTime"] > cluster_time["clusterTime"]:
+                cluster_time = current[0]
+        self._entries.pop(user_id, None)
+        if len(self._entries) >= self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[user_id] = (cluster_time, operation_time, time.monotonic() + self.ttl_seconds)
+    
+    def get(self, user_id: str):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            self._entries.pop(user_id, None)
+            return None
+        return entry[0], entry[1]
+    
+    def stats(self):
+        return {"users": len(self._entries)}
+
+causal_tokens = CausalTokens(ttl_seconds=MAX_STALENESS_SECONDS)
+
+async def causal_write(user_id: str, operation):
+    """Run `operation(session)` and remember its position for the user's later reads.
+
+    `operation` must issue a single write; concurrent writes each get their own
+    session since a session is not safe for concurrent use.
+    """
+    if not CAUSAL_READS_ENABLED:
+        return await operation(None)
+    async with await client.start_session(causal_consistency=True) as session:
+        result = await operation(session)
+        causal_tokens.record(user_id, session)
+        return result
+
+@asynccontextmanager
+async def read_session(user_id: str):
+    """Session for a user's eventual reads, or None when there is nothing to wait for"""
+    tokens = causal_tokens.get(user_id) if CAUSAL_READS_ENABLED else None
+    if tokens is None:
+        yield None
+        return
+    async with await client.start_session(causal_consistency=True) as session:
+        cluster_time, operation_time = tokens
+        if cluster_time:
+            session.advance_cluster_time(cluster_time)
+        session.advance_operation_time(operation_time)
+        yield session
+
+def mongo_pool_config():
+    """Settings the current client was created with, for /system/stats"""
+    options = {key: value for key, value in mongo_options.items() if key != "event_listeners"}
+    options["write_concerns"] = {name: concern.document for name, concern in WRITE_CONCERNS.items()}
+    return options
 
 # JWT Configuration
 SECRET_KEY = "your-secret-key-health-loop-nexus-2025"
@@ -29,46 +545,624 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 480  # 8 hours for testing
 
 # Password hashing
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
-# Helper functions for MongoDB serialization
-def parse_from_mongo(item):
-    """Parse MongoDB document to Python dict, handling special types"""
-    if isinstance(item.get('date'), str):
-        try:
-            item['date'] = datetime.fromisoformat(item['date']).date()
-        except:
-            pass
-    if isinstance(item.get('time'), str):
-        try:
-            item['time'] = datetime.strptime(item['time'], '%H:%M:%S').time()
-        except:
-            pass
-    if isinstance(item.get('created_at'), str):
+# Shared secret for operational endpoints (bulk awards, exports); unset disables them
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN")
+
+# Fast JSON responses
+# Opt-in: orjson encoding, and handlers hand already-decoded models straight to
+# the response instead of having FastAPI re-validate them against response_model.
+FAST_JSON_RESPONSES = os.environ.get("FAST_JSON_RESPONSES", "false").lower() in ("1", "true", "yes")
+
+def _orjson_default(value):
+    if isinstance(value, BaseModel):
+        # JSON mode, so fields come out exactly as response_model serialization writes them
+        return value.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson when it is installed; accepts models as content.
+
+    The output matches the regular path field for field: models are dumped the way
+    response_model does it and bare datetimes keep jsonable_encoder's `+00:00`.
+    """
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(jsonable_encoder(content))
+
+def fast_response(content, response: Optional[Response] = None):
+    """Return `content` as a FastJSONResponse when FAST_JSON_RESPONSES is on.
+
+    Headers set on the injected `response` are carried over, since FastAPI ignores
+    them once a handler returns its own Response. With the flag off the content is
+    returned unchanged for the usual response_model handling.
+    """
+    if not FAST_JSON_RESPONSES:
+        return content
+    fast = FastJSONResponse(content)
+    if response is not None:
+        fast.raw_headers.extend(header for header in response.raw_headers if header[0] != b"content-length")
+        if response.status_code:
+            fast.status_code = response.status_code
+    return fast
+
+# Metrics
+# In-process counters, gauges and histograms served in the Prometheus text format at
+# GET /metrics. Updates happen on the event loop and are plain arithmetic, no locks.
+# Values owned by other components (pool, caches, jobs) are read at scrape time
+# through `collect` callbacks. Routes are labelled by their template, so
+# /api/products/{product_id} is a single series.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Bearer token for scrapers (Prometheus' `authorization` setting); the admin token also works
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+# A wake-up this late is logged with the stack that was blocking the loop; 0 disables
+LOOP_STALL_MS = float(os.environ.get("LOOP_STALL_MS", "250"))
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=(), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.collect = collect
+        self._values = {}
+
+    def values(self):
+        """{label values tuple: value}, from the callback when there is one"""
+        if self.collect is None:
+            return self._values
+        collected = self.collect()
+        return collected if isinstance(collected, dict) else {(): collected}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        state = self._values.get(label_values)
+        if state is None:
+            # Per-bucket counts (the last one is +Inf), sum, count
+            state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, le)} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels=(), collect=None) -> Counter:
+        return self.register(Counter(name, help_text, labels, collect))
+
+    def gauge(self, name: str, help_text: str, labels=(), collect=None) -> Gauge:
+        return self.register(Gauge(name, help_text, labels, collect))
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+class RateWindow:
+    """Events in the trailing `seconds`, for per-minute gauges"""
+
+    def __init__(self, seconds: float = 60.0):
+        self.seconds = seconds
+        self._events = deque()
+
+    def add(self):
+        self._events.append(time.monotonic())
+
+    def count(self):
+        cutoff = time.monotonic() - self.seconds
+        while self._events and self._events[0] < cutoff:
+            self._events.popleft()
+        return len(self._events)
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a task that sleeps `interval` seconds.
+
+    Lag is only known once the loop gets back to the task, so a watchdog thread
+    also checks the pending wake-up: when it is `stall_seconds` overdue the loop
+    thread's current stack (the code holding it up) is logged, once per stall.
+    """
+
+    def __init__(self, interval: float, stall_seconds: float):
+        self.interval = interval
+        self.stall_seconds = stall_seconds
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._wake_deadline = None
+        self._task = None
+        self._watchdog_stop = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            self._wake_deadline = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            loop_lag_seconds.observe(lag)
+
+    def _watch(self, loop_thread_id: int, stop: threading.Event):
+        reported = None
+        while not stop.wait(self.stall_seconds / 2):
+            deadline = self._wake_deadline
+            if deadline is None or deadline == reported:
+                continue
+            overdue = time.monotonic() - deadline
+            if overdue < self.stall_seconds:
+                continue
+            reported = deadline
+            self.stalls += 1
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            logger.warning(
+                f"Event loop blocked for over {overdue * 1000:.0f}ms",
+                extra={"event": "loop.stall", "blocked_ms": round(overdue * 1000), "stack": stack}
+            )
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+            if self.stall_seconds > 0:
+                self._watchdog_stop = threading.Event()
+                threading.Thread(
+                    target=self._watch, args=(threading.get_ident(), self._watchdog_stop),
+                    name="loop-stall-watchdog", daemon=True
+                ).start()
+
+    async def stop(self):
+        if self._watchdog_stop is not None:
+            self._watchdog_stop.set()
+            self._watchdog_stop = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wake_deadline = None
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL_SECONDS, LOOP_STALL_MS / 1000)
+orders_window = RateWindow(60.0)
+
+def _pool_utilization():
+    max_size = mongo_options.get("maxPoolSize", 100)
+    return round(pool_monitor.checked_out / max_size, 4) if max_size else 0.0
+
+def _cache_counts(kind: str):
+    cart = cart_snapshot_reads._values
+    return {
+        ("principal",): principal_cache.hits if kind == "hits" else principal_cache.misses,
+        ("cart_snapshot",): cart.get(("fresh",), 0) if kind == "hits" else cart.get(("repriced",), 0),
+    }
+
+def _cache_hit_ratios():
+    hits, misses = _cache_counts("hits"), _cache_counts("misses")
+    return {
+        key: round(hits[key] / (hits[key] + misses[key]), 4) if hits[key] + misses[key] else 0.0
+        for key in hits
+    }
+
+http_requests_total = metrics.counter("healthloop_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_request_duration = metrics.histogram("healthloop_http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_requests_in_flight = metrics.gauge("healthloop_http_requests_in_flight", "HTTP requests being served")
+mongo_commands_per_request = metrics.histogram(
+    "healthloop_mongo_commands_per_request", "MongoDB commands issued per HTTP request", ("route",), COMMAND_COUNT_BUCKETS
+)
+metrics.counter("healthloop_mongo_pool_checkouts_total", "Connection checkouts", collect=lambda: pool_monitor.checkouts)
+metrics.counter(
+    "healthloop_mongo_pool_checkout_failures_total", "Failed connection checkouts", ("reason",),
+    collect=lambda: {(reason,): count for reason, count in pool_monitor.checkout_failures.items()}
+)
+metrics.counter("healthloop_mongo_pool_wait_seconds_total", "Time spent waiting for connections", collect=lambda: pool_monitor.total_wait_ms / 1000)
+metrics.gauge("healthloop_mongo_pool_checked_out", "Connections checked out", collect=lambda: pool_monitor.checked_out)
+metrics.gauge("healthloop_mongo_pool_open_connections", "Open pool connections", collect=lambda: pool_monitor.open_connections)
+metrics.gauge("healthloop_mongo_pool_utilization", "Checked out connections / maxPoolSize", collect=_pool_utilization)
+metrics.counter("healthloop_mongo_slow_queries_total", "Commands slower than MONGO_SLOW_QUERY_MS", collect=lambda: query_monitor.slow_queries)
+cart_snapshot_reads = metrics.counter("healthloop_cart_reads_total", "Cart reads served from the priced snapshot or repriced", ("result",))
+metrics.counter("healthloop_cache_hits_total", "Cache hits", ("cache",), collect=lambda: _cache_counts("hits"))
+metrics.counter("healthloop_cache_misses_total", "Cache misses", ("cache",), collect=lambda: _cache_counts("misses"))
+metrics.gauge("healthloop_cache_hit_ratio", "Cache hits / lookups since start", ("cache",), collect=_cache_hit_ratios)
+points_awarded_total = metrics.counter("healthloop_points_awarded_total", "Points awarded", ("action",))
+points_awards_total = metrics.counter("healthloop_points_awards_total", "Points transactions recorded", ("action",))
+orders_total = metrics.counter("healthloop_orders_total", "Orders completed")
+order_revenue_total = metrics.counter("healthloop_order_revenue_total", "Order amounts")
+metrics.gauge("healthloop_orders_per_minute", "Orders completed in the last 60 seconds", collect=orders_window.count)
+metrics.counter("healthloop_jobs_processed_total", "Background jobs completed", collect=lambda: job_queue.processed)
+metrics.counter("healthloop_jobs_retried_total", "Background job retries", collect=lambda: job_queue.retried)
+metrics.counter("healthloop_jobs_failed_total", "Background jobs given up on", collect=lambda: job_queue.failed)
+loop_lag_seconds = metrics.histogram("healthloop_event_loop_lag_seconds", "Event loop wake-up delay", buckets=LOOP_LAG_BUCKETS)
+metrics.gauge("healthloop_event_loop_lag_max_seconds", "Largest event loop delay since start", collect=lambda: loop_lag_monitor.max_lag)
+metrics.counter("healthloop_event_loop_stalls_total", "Event loop stalls longer than LOOP_STALL_MS", collect=lambda: loop_lag_monitor.stalls)
+
+def record_points_awarded(action, points: int):
+    points_awarded_total.inc(action.value, amount=points)
+    points_awards_total.inc(action.value)
+
+def record_order(order):
+    orders_total.inc()
+    order_revenue_total.inc(amount=order.total_amount)
+    orders_window.add()
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
         try:
-            item['created_at'] = datetime.fromisoformat(item['created_at'])
-        except:
-            pass
-    return item
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            http_request_duration.observe(time.perf_counter() - start, method, route)
+            http_requests_total.inc(method, route, str(status_code))
+            stats = request_query_stats.get()
+            if stats is not None:
+                mongo_commands_per_request.observe(stats.commands, route)
 
-def prepare_for_mongo(data):
-    """Prepare Python data for MongoDB storage"""
-    if hasattr(data, 'dict'):
-        data = data.dict()
-    
-    if isinstance(data.get('date'), str):
-        data['date'] = data['date']
-    if isinstance(data.get('time'), str):
-        data['time'] = data['time'] 
-    if isinstance(data.get('created_at'), datetime):
-        data['created_at'] = data['created_at'].isoformat()
-    
-    return data
+# Profiling
+# Opt-in, per process, and cheap enough to leave on at a low rate:
+# - spans total the wall time of get_current_user, document decoding/encoding,
+#   request and response validation around each /api endpoint (TimedRoute) and
+#   every Mongo command (PROFILE_SPANS=true, or toggled at runtime); a disabled
+#   span is a no-op object.
+# - a sampling profiler thread snapshots the event-loop thread's stack PROFILER_HZ
+#   times a second into folded stacks, the input format of flamegraph.pl and
+#   speedscope. PROFILER_AUTOSTART=true starts it with the app.
+# Both are controlled through /api/admin/profiler.
+PROFILE_SPANS = os.environ.get("PROFILE_SPANS", "false").lower() in ("1", "true", "yes")
+PROFILER_AUTOSTART = os.environ.get("PROFILER_AUTOSTART", "false").lower() in ("1", "true", "yes")
+# An odd rate keeps samples from lining up with periodic work
+PROFILER_HZ = float(os.environ.get("PROFILER_HZ", "19"))
+PROFILER_MAX_STACKS = int(os.environ.get("PROFILER_MAX_STACKS", "5000"))
+PROFILER_MAX_DEPTH = 128
+
+class _Span:
+    __slots__ = ("timings", "name", "start")
+
+    def __init__(self, timings, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.record(self.name, time.perf_counter() - self.start)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class SpanTimings:
+    """Call count, total and max wall time per span name"""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def span(self, name: str):
+        return _Span(self, name) if self.enabled else _NO_SPAN
+
+    def record(self, name: str, seconds: float):
+        # Mongo spans arrive from the driver's executor threads
+        with self._lock:
+            entry = self._spans.get(name)
+            if entry is None:
+                entry = self._spans[name] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+
+    def reset(self):
+        with self._lock:
+            self._spans = {}
+
+    def stats(self):
+        with self._lock:
+            spans = {name: list(entry) for name, entry in self._spans.items()}
+        return {
+            "enabled": self.enabled,
+            "spans": {
+                name: {
+                    "count": count,
+                    "total_ms": round(total * 1000, 3),
+                    "avg_ms": round(total * 1000 / count, 3),
+                    "max_ms": round(longest * 1000, 3),
+                }
+                for name, (count, total, longest) in sorted(spans.items())
+            },
+        }
+
+span_timings = SpanTimings(PROFILE_SPANS)
+
+# [handler start, endpoint start, endpoint end] for the request being routed
+_route_marks = contextvars.ContextVar("route_marks", default=None)
+
+def _marked_endpoint(endpoint):
+    """Wrap a route endpoint to note when it starts and returns in _route_marks.
+
+    functools.wraps keeps the signature FastAPI inspects for dependencies, and
+    sync endpoints stay sync so they still run in the threadpool (which copies
+    the context, so the marks list is shared).
+    """
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def marked(*args, **kwargs):
+            marks = _route_marks.get()
+            if marks is not None:
+                marks[1] = time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                if marks is not None:
+                    marks[2] = time.perf_counter()
+    else:
+        @functools.wraps(endpoint)
+        def marked(*args, **kwargs):
+            marks = _route_marks.get()
+            if marks is not None:
+                marks[1] = time.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                if marks is not None:
+                    marks[2] = time.perf_counter()
+    return marked
+
+class TimedRoute(APIRoute):
+    """APIRoute that records the time spent before and after its endpoint.
+
+    validation.request covers dependency resolution and body parsing,
+    validation.response the response_model serialization and rendering.
+    """
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _marked_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            if not span_timings.enabled:
+                return await handler(request)
+            marks = [time.perf_counter(), None, None]
+            token = _route_marks.set(marks)
+            try:
+                return await handler(request)
+            finally:
+                end = time.perf_counter()
+                _route_marks.reset(token)
+                if marks[1] is not None:
+                    span_timings.record("validation.request", marks[1] - marks[0])
+                if marks[2] is not None:
+                    span_timings.record("validation.response", end - marks[2])
+
+        return timed_handler
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """Samples one thread's stack from a background thread into folded-stack counts"""
+
+    def __init__(self, hz: float, max_stacks: int):
+        self.hz = hz
+        self.max_stacks = max_stacks
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stacks = {}
+        self._thread = None
+        self._stop = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, hz: Optional[float] = None, seconds: Optional[float] = None, reset: bool = True):
+        """Start sampling the calling thread (the event loop's)"""
+        self.stop()
+        if reset:
+            self._stacks = {}
+            self.samples = 0
+        if hz:
+            self.hz = hz
+        self.started_at, self.stopped_at = datetime.now(timezone.utc), None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(threading.get_ident(), self._stop, seconds),
+            name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._thread.join(timeout=1)
+            self._thread = self._stop = None
+            self.stopped_at = datetime.now(timezone.utc)
+
+    def _run(self, thread_id: int, stop: threading.Event, seconds: Optional[float]):
+        interval = 1 / self.hz
+        ends_at = time.monotonic() + seconds if seconds else None
+        while not stop.wait(interval):
+            if ends_at is not None and time.monotonic() >= ends_at:
+                self.stopped_at = datetime.now(timezone.utc)
+                break
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            labels = []
+            while frame is not None and len(labels) < PROFILER_MAX_DEPTH:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            stack = ";".join(reversed(labels))
+            if stack not in self._stacks and len(self._stacks) >= self.max_stacks:
+                stack = "[other stacks]"
+            self._stacks[stack] = self._stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        """`frame;frame;frame count` per line, root first"""
+        stacks = dict(self._stacks)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "hz": self.hz,
+            "samples": self.samples,
+            "stacks": len(self._stacks),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "stopped_at": self.stopped_at.isoformat() if self.stopped_at else None,
+        }
+
+profiler = SamplingProfiler(PROFILER_HZ, PROFILER_MAX_STACKS)
+
+def _span_totals(index: int):
+    with span_timings._lock:
+        return {(name,): entry[index] for name, entry in span_timings._spans.items()}
+
+metrics.counter("healthloop_span_calls_total", "Profiling span executions", ("span",), collect=lambda: _span_totals(0))
+metrics.counter("healthloop_span_seconds_total", "Profiling span wall time", ("span",), collect=lambda: _span_totals(1))
 
 # Create the main app without a prefix
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Process lifecycle: connect, warm caches, then tear down in reverse order"""
+    configure_logging()
+    if client is None:
+        connect_mongo()
+    loop_lag_monitor.start()
+    if PROFILER_AUTOSTART:
+        profiler.start()
+    await bootstrap_indexes()
+    await start_product_catalog()
+    await principal_cache.start()
+    await start_leaderboard()
+    await job_queue.start()
+    await settle_pending_badges()
+    try:
+        yield
+    finally:
+        await job_queue.stop()
+        await leaderboard.stop()
+        await principal_cache.stop()
+        await product_catalog.stop()
+        await loop_lag_monitor.stop()
+        profiler.stop()
+        close_mongo()
+        shutdown_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", route_class=TimedRoute, default_response_class=FastJSONResponse if FAST_JSON_RESPONSES else JSONResponse)
 
 # Enums
 class DietType(str, Enum):
@@ -123,6 +1217,7 @@ class PointAction(str, Enum):
     REFER_FRIEND = "refer_friend"
     COMPLETE_CONSULTATION = "complete_consultation"
     VIDEO_COMPLETION = "video_completion"
+    MONTHLY_MEMBERSHIP = "monthly_membership"
 
 class BadgeType(str, Enum):
     BEGINNER = "beginner"
@@ -171,11 +1266,16 @@ class Product(BaseModel):
 class CartItem(BaseModel):
     product_id: str
     quantity: int = 1
+    # Priced snapshot, filled in by the cart mutations; None for a product no longer sold
+    unit_price: Optional[float] = None
+    subtotal: Optional[float] = None
     
 class Cart(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     items: List[CartItem] = []
+    total: float = 0
+    catalog_version: Optional[str] = None  # ProductCatalog.price_version the snapshot was priced at
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -449,234 +1549,2112 @@ class OnboardingStep5Request(BaseModel):
 class UserLogin(BaseModel):
     email: EmailStr
     password: str
+    cart_items: Optional[List[CartItem]] = None  # Guest cart to merge into the user's cart
 
 class CartAddRequest(BaseModel):
     product_id: str
-    quantity: int = 1
+    quantity: int = Field(1, ge=1)
+
+class CartQuantityRequest(BaseModel):
+    quantity: int = Field(..., ge=0)  # 0 removes the line
+
+class PointsAddRequest(BaseModel):
+    action: PointAction
+    description: Optional[str] = None
+    amount_spent: Optional[float] = None  # For purchase-based points
+
+class BulkPointsAward(BaseModel):
+    user_id: str
+    action: PointAction
+    amount: Optional[int] = None  # Points to grant, defaults to POINT_VALUES[action]
+    description: Optional[str] = None
+    transaction_id: Optional[str] = None  # Idempotency key, an award with a known id is not granted again
+
+# Larger grants go through award_points_bulk directly (e.g. grant-monthly-points)
+BULK_AWARD_REQUEST_LIMIT = int(os.environ.get("BULK_AWARD_REQUEST_LIMIT", "10000"))
+
+class BulkPointsAwardRequest(BaseModel):
+    awards: List[BulkPointsAward] = Field(..., max_length=BULK_AWARD_REQUEST_LIMIT)
+
+class ProfilerControlRequest(BaseModel):
+    sampling: Optional[bool] = None
+    hz: Optional[float] = Field(None, gt=0, le=1000)
+    seconds: Optional[float] = Field(None, gt=0, le=3600)
+    spans: Optional[bool] = None
+    reset: bool = False
+
+class ConsultationStartRequest(BaseModel):
+    client_id: str
+
+class ConsultationCompleteRequest(BaseModel):
+    consultation_id: str
+    notes: str
+    recommendations: str
+
+class OrderCreateRequest(BaseModel):
+    user_email: str
+    user_name: str
+
+class Token(BaseModel):
+    access_token: str
+    token_type: str
+    user: dict
+
+# Response Models
+class UserResponse(BaseModel):
+    id: str
+    email: str
+    name: str
+    role: UserRole
+    points: int
+    total_points_earned: int
+    level: str
+
+# Response Models
+class UserResponse(BaseModel):
+    id: str
+    email: EmailStr
+    name: str
+    role: UserRole
+    points: int
+    total_points_earned: int
+    level: str
+    membership_level: Optional[MembershipLevel] = None
+
+class PointsHistoryResponse(BaseModel):
+    transactions: List[PointsTransaction]
+    total_points: int
+    current_level: str
+    next_level_threshold: int
+    progress_percentage: float
+    next_cursor: Optional[str] = None
+
+class LeaderboardEntry(BaseModel):
+    name: str
+    points: int
+    level: str
+    rank: int
+
+class DashboardClientResponse(BaseModel):
+    user: UserResponse
+    upcoming_appointments: List[dict] = []
+    recommended_products: List[Product] = []
+    recent_orders: List[Order] = []
+    recent_points: List[PointsTransaction] = []
+    badges: List[Badge] = []
+    degraded_sections: List[str] = []
+
+class DashboardProfessionalResponse(BaseModel):
+    user: UserResponse
+    professional_info: dict
+    assigned_clients: List[dict] = []
+    upcoming_appointments: List[dict] = []
+    commission_pending: float = 125.0
+    total_earnings: float = 850.0
+    active_consultations: List[ConsultationSession] = []
+    degraded_sections: List[str] = []
+
+# Document codec
+def _parse_iso_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def _unwrap_annotation(annotation):
+    """Reduce Optional[X] / List[X] / List[Optional[X]] to (X, is_list)"""
+    is_list = False
+    while True:
+        origin = get_origin(annotation)
+        if origin is Union:
+            members = [arg for arg in get_args(annotation) if arg is not type(None)]
+            if len(members) != 1:
+                return None, False
+            annotation = members[0]
+        elif origin in (list, List):
+            (annotation,) = get_args(annotation) or (None,)
+            is_list = True
+        else:
+            return annotation, is_list
+
+class DocumentCodec:
+    """Converts between Mongo documents and one model class.
+
+    The fields that hold datetimes, enums or nested models are worked out once per
+    class, so decoding trusted database documents is one pass over those fields plus
+    `model_construct`, without re-running validation. Datetimes still stored as ISO
+    strings by older releases are parsed on the way in.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.field_names = frozenset(model.model_fields)
+        self.datetime_fields = []
+        self.enum_fields = []
+        self.nested_fields = []
+        for name, field in model.model_fields.items():
+            target, is_list = _unwrap_annotation(field.annotation)
+            if not isinstance(target, type):
+                continue
+            if issubclass(target, datetime) and not is_list:
+                self.datetime_fields.append(name)
+            elif issubclass(target, Enum) and not is_list:
+                self.enum_fields.append((name, target))
+            elif issubclass(target, BaseModel):
+                self.nested_fields.append((name, target, is_list))
+
+    def decode(self, document: dict):
+        data = {key: value for key, value in document.items() if key in self.field_names}
+        for name in self.datetime_fields:
+            value = data.get(name)
+            if isinstance(value, str):
+                data[name] = _parse_iso_datetime(value)
+        for name, enum in self.enum_fields:
+            value = data.get(name)
+            if value is not None and not isinstance(value, enum):
+                try:
+                    data[name] = enum(value)
+                except ValueError:
+                    # Fail at read time, not when the response goes out (or never, on
+                    # the fast path, which skips response validation)
+                    return self.model.model_validate(data)
+        for name, model, is_list in self.nested_fields:
+            value = data.get(name)
+            nested = codec_for(model)
+            if is_list and isinstance(value, list):
+                data[name] = [nested.decode(item) if isinstance(item, dict) else item for item in value]
+            elif isinstance(value, dict):
+                data[name] = nested.decode(value)
+        return self.model.model_construct(**data)
+
+    def decode_many(self, documents) -> list:
+        return [self.decode(document) for document in documents]
+
+    @staticmethod
+    def encode(instance) -> dict:
+        # Python mode keeps datetimes native so they are stored as BSON dates
+        return instance.model_dump()
+
+_codecs = {}
+
+def codec_for(model) -> DocumentCodec:
+    codec = _codecs.get(model)
+    if codec is None:
+        codec = _codecs[model] = DocumentCodec(model)
+    return codec
+
+def projection_for(model, include=(), exclude=(), aliases=None) -> dict:
+    """Projection that fetches only what `model` reads, without _id.
+
+    `aliases` maps a model field to the stored field it is built from (e.g. the
+    leaderboard's `points` comes from `total_points_earned`); fields in `exclude`
+    are computed rather than stored, and `include` adds stored fields the caller
+    needs besides the model's own.
+    """
+    aliases = aliases or {}
+    projection = {"_id": 0}
+    for name in model.model_fields:
+        if name not in exclude:
+            projection[aliases.get(name, name)] = 1
+    for name in include:
+        projection[name] = 1
+    return projection
+
+def from_mongo(model, document: dict):
+    """Build a model instance from a trusted database document"""
+    with span_timings.span("codec.decode"):
+        return codec_for(model).decode(document)
+
+def many_from_mongo(model, documents) -> list:
+    with span_timings.span("codec.decode"):
+        return codec_for(model).decode_many(documents)
+
+def to_mongo(instance) -> dict:
+    with span_timings.span("codec.encode"):
+        return DocumentCodec.encode(instance)
+
+# Projections for the read paths that don't map onto a single stored model
+USER_PROJECTION = projection_for(User)
+# With the _id that change events identify the document by
+PRINCIPAL_PROJECTION = {**USER_PROJECTION, "_id": 1}
+LEADERBOARD_USER_PROJECTION = projection_for(LeaderboardEntry, include=("id",), exclude=("rank",), aliases={"points": "total_points_earned"})
+ONBOARDING_STATUS_PROJECTION = projection_for(
+    UserProfile,
+    exclude=("id", "user_id", "billing_address", "created_at", "updated_at")
+)
+CART_PROJECTION = projection_for(Cart, exclude=("id", "user_id", "created_at"))
+
+# Auth helper functions
+def verify_password(plain_password, hashed_password):
+    # Simple hash comparison using SHA256
+    password_hash = hashlib.sha256(plain_password.encode()).hexdigest()
+    return password_hash == hashed_password
+
+def get_password_hash(password):
+    # Simple SHA256 hash
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.now(timezone.utc) + expires_delta
+    else:
+        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+# Principal cache
+class PrincipalCache:
+    """Per-process cache of authenticated users keyed by user id.
+
+    Writers in this process call `invalidate`, which also bumps a generation so a
+    lookup that raced the write cannot re-populate the cache with the old document.
+    Writes made elsewhere (other API workers, maintenance commands) arrive through
+    a change stream on users, which drops the changed user's entry within the
+    stream's lag; entries then live for `ttl_seconds`. A standalone mongod has no
+    change streams, so there entries live at most `fallback_ttl_seconds`, which
+    bounds how long another process's change to points, level, role or membership
+    can go unseen.
+    """
+    def __init__(self, ttl_seconds: float, fallback_ttl_seconds: float, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.fallback_ttl_seconds = fallback_ttl_seconds
+        self.max_entries = max_entries
+        self.refresh_mode = None
+        self._entries = {}
+        self._ids_by_key = {}
+        self._generations = {}
+        self._epoch = 0
+        self._changes = 0
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def entry_ttl(self):
+        return self.ttl_seconds if self.refresh_mode == "change_stream" else min(self.ttl_seconds, self.fallback_ttl_seconds)
+
+    def generation(self, user_id: str):
+        return self._epoch, self._changes, self._generations.get(user_id, 0)
+
+    def get(self, user_id: str):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            user, expires_at, _ = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                return user
+            self._drop(user_id)
+        self.misses += 1
+        return None
+
+    def put(self, user, generation, key=None):
+        """Cache `user`, read at `generation`; `key` is its document _id, as change events name it"""
+        ttl = self.entry_ttl
+        if ttl <= 0 or generation != self.generation(user.id):
+            return
+        if user.id not in self._entries and len(self._entries) >= self.max_entries:
+            # Dicts keep insertion order, so this evicts the oldest entry
+            self._drop(next(iter(self._entries)))
+        self._entries[user.id] = (user, time.monotonic() + ttl, key)
+        if key is not None:
+            self._ids_by_key[key] = user.id
+
+    def _drop(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None and entry[2] is not None:
+            self._ids_by_key.pop(entry[2], None)
+
+    def invalidate(self, user_id: str):
+        self._drop(user_id)
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+        self.invalidations += 1
+
+    def changed(self, key):
+        """Handle a change event for the users document with _id `key`"""
+        # Also refuses lookups in flight, which may have read the document before the change
+        self._changes += 1
+        user_id = self._ids_by_key.get(key)
+        if user_id is not None:
+            self.invalidate(user_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._ids_by_key.clear()
+        self._generations.clear()
+        self._epoch += 1
+        self.invalidations += 1
+
+    async def _watch_changes(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}, {"$project": {"documentKey": 1}}]
+        async with db.users.watch(pipeline) as stream:
+            self.refresh_mode = "change_stream"
+            async for change in stream:
+                self.changed(change["documentKey"]["_id"])
+
+    async def _refresh_forever(self):
+        try:
+            await self._watch_changes()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Standalone mongod has no change streams
+            logger.info(f"Principal cache falling back to a {self.fallback_ttl_seconds:g}s TTL: {e}")
+        # Entries cached under the longer TTL could now miss changes
+        self.refresh_mode = "ttl"
+        self.clear()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.refresh_mode = None
+        self.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "ttl_seconds": self.entry_ttl,
+            "refresh_mode": self.refresh_mode
+        }
+
+principal_cache = PrincipalCache(
+    ttl_seconds=float(os.environ.get("PRINCIPAL_CACHE_TTL_SECONDS", "30")),
+    fallback_ttl_seconds=float(os.environ.get("PRINCIPAL_CACHE_FALLBACK_TTL_SECONDS", "5"))
+)
+
+def invalidate_principal(user_id: str):
+    """Call after any write to a users document so the next request re-reads it"""
+    principal_cache.invalidate(user_id)
+
+async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    with span_timings.span("auth.current_user"):
+        credentials_exception = HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+        try:
+            token = credentials.credentials
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            user_id: str = payload.get("sub")
+            if user_id is None:
+                raise credentials_exception
+        except JWTError:
+            raise credentials_exception
+    
+        # Per-request memo for handlers that resolve the principal more than once
+        memo = getattr(request.state, "current_user", None)
+        if memo is not None and memo.id == user_id:
+            return memo
+
+        current_user = principal_cache.get(user_id)
+        if current_user is None:
+            generation = principal_cache.generation(user_id)
+            user = await db.users.find_one({"id": user_id}, PRINCIPAL_PROJECTION)
+            if user is None:
+                raise credentials_exception
+            current_user = from_mongo(User, user)
+            principal_cache.put(current_user, generation, user["_id"])
+
+        request.state.current_user = current_user
+        return current_user
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(x_admin_token or "", ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+# Points system helper functions
+LEVEL_THRESHOLDS = [
+    (5000, "Elite"),
+    (1500, "Premium"),
+    (500, "Active")
+]
+
+LEVEL_BADGES = {
+    "Active": BadgeType.ACTIVE,
+    "Premium": BadgeType.PREMIUM,
+    "Elite": BadgeType.ELITE
+}
+
+def calculate_level(total_points):
+    for threshold, level in LEVEL_THRESHOLDS:
+        if total_points >= threshold:
+            return level
+    return "Beginner"
+
+def level_expression(total_points):
+    """Aggregation equivalent of calculate_level, for computing the level server-side"""
+    return {
+        "$switch": {
+            "branches": [{"case": {"$gte": [total_points, threshold]}, "then": level} for threshold, level in LEVEL_THRESHOLDS],
+            "default": "Beginner"
+        }
+    }
+
+def get_next_level_threshold(current_level):
+    thresholds = {
+        "Beginner": 500,
+        "Active": 1500,
+        "Premium": 5000,
+        "Elite": 10000
+    }
+    return thresholds.get(current_level, 10000)
+
+def points_for_action(action: PointAction, amount_spent: float = None):
+    if action == PointAction.PURCHASE and amount_spent:
+        return int(amount_spent * POINT_VALUES[PointAction.PURCHASE])
+    return POINT_VALUES.get(action, 0)
+
+# An unapplied ledger row whose writer has not finished it within this long can be
+# taken over and finished by a retry or a rerun (see claim_stale_awards)
+AWARD_CLAIM_SECONDS = float(os.environ.get("AWARD_CLAIM_SECONDS", "60"))
+
+def points_award_pipeline(points, award_ids=None):
+    """Update pipeline that adds points and recomputes the level in the same write.
+
+    A level change also sets `badge_pending` to the new level, so the badge for it
+    is written after the award instead of in its round trips; the marker stays on
+    the user until settle_pending_badge clears it, which makes a lost badge write
+    recoverable (see settle_pending_badges).
+
+    `points` may be an aggregation expression. `award_ids` (a list, or an array
+    expression) are added to the user's `pending_award_ids`, where they stay until
+    finish_awards has marked their ledger rows applied.
+    """
+    stages = [
+        {"$set": {
+            "previous_level": "$level",
+            "points": {"$add": [{"$ifNull": ["$points", 0]}, points]},
+            "total_points_earned": {"$add": [{"$ifNull": ["$total_points_earned", 0]}, points]},
+            # Lets other processes' leaderboards pick up just the changed users
+            "ranked_at": datetime.now(timezone.utc)
+        }},
+        {"$set": {"level": level_expression("$total_points_earned")}},
+        {"$set": {"badge_pending": {"$cond": [{"$ne": ["$level", "$previous_level"]}, "$level", "$badge_pending"]}}}
+    ]
+    if award_ids is not None:
+        if isinstance(award_ids, list):
+            award_ids = {"$literal": award_ids}
+        stages.append({"$set": {"pending_award_ids": {"$concatArrays": [{"$ifNull": ["$pending_award_ids", []]}, award_ids]}}})
+    stages.append({"$project": {"previous_level": 0, "new_awards": 0}})
+    return stages
+
+def guarded_award_pipeline(awards):
+    """points_award_pipeline for [(transaction id, points)] that credits each id once.
+
+    Ids already in the user's `pending_award_ids` were credited by an earlier
+    attempt whose ledger rows are not marked applied yet, so they are left out of
+    the sum; replaying the update after a crash between the two writes adds nothing.
+    """
+    pending = {"$filter": {
+        "input": {"$literal": [{"id": transaction_id, "points": points} for transaction_id, points in awards]},
+        "as": "award",
+        "cond": {"$not": {"$in": ["$$award.id", {"$ifNull": ["$pending_award_ids", []]}]}}
+    }}
+    return [{"$set": {"new_awards": pending}}] + points_award_pipeline({"$sum": "$new_awards.points"}, "$new_awards.id")
+
+def award_claim():
+    """Ownership fields for unapplied ledger rows: a fresh token and when it was taken"""
+    return {"claim": uuid.uuid4().hex, "claimed_at": datetime.now(timezone.utc)}
+
+async def claim_stale_awards(transaction_ids, claim: dict) -> list:
+    """Take over unapplied ledger rows whose writer did not finish them in AWARD_CLAIM_SECONDS.
+
+    Returns the rows now held under `claim`; rows that are applied, or still held
+    by a live writer, are left alone.
+    """
+    cutoff = claim["claimed_at"] - timedelta(seconds=AWARD_CLAIM_SECONDS)
+    ledger = collection_for("points_transactions", "critical")
+    await ledger.update_many(
+        {"id": {"$in": list(transaction_ids)}, "applied": False, "claimed_at": {"$not": {"$gte": cutoff}}},
+        {"$set": claim}
+    )
+    return await ledger.find(
+        {"id": {"$in": list(transaction_ids)}, "applied": False, "claim": claim["claim"]},
+        {"_id": 0, "id": 1, "user_id": 1, "action": 1, "points": 1}
+    ).to_list(length=None)
+
+async def release_awards(transaction_ids, claim: dict):
+    """Hand rows back after a failed attempt so a retry can finish them right away"""
+    await collection_for("points_transactions", "critical").update_many(
+        {"id": {"$in": list(transaction_ids)}, "applied": False, "claim": claim["claim"]},
+        {"$set": {"claimed_at": datetime.min.replace(tzinfo=timezone.utc)}}
+    )
+
+async def finish_awards(awards_by_user: dict, claim: dict) -> set:
+    """Mark credited ledger rows applied and drop their ids from `pending_award_ids`.
+
+    `awards_by_user` maps user ids to the transaction ids credited for them. Only
+    rows still held under `claim` are finished; one taken over in the meantime is
+    left (with its pending id) to the run that took it. Returns the finished ids.
+    """
+    transaction_ids = [transaction_id for ids in awards_by_user.values() for transaction_id in ids]
+    ledger = collection_for("points_transactions", "critical")
+    result = await ledger.update_many(
+        {"id": {"$in": transaction_ids}, "claim": claim["claim"], "applied": False},
+        {"$set": {"applied": True}}
+    )
+    finished = set(transaction_ids)
+    if result.modified_count < len(transaction_ids):
+        finished -= {row["id"] for row in await ledger.find(
+            {"id": {"$in": transaction_ids}, "claim": {"$ne": claim["claim"]}}, {"_id": 0, "id": 1}
+        ).to_list(length=None)}
+    pulls = []
+    for user_id, ids in awards_by_user.items():
+        done = [transaction_id for transaction_id in ids if transaction_id in finished]
+        if done:
+            pulls.append(UpdateOne({"id": user_id}, {"$pull": {"pending_award_ids": {"$in": done}}}))
+    if pulls:
+        await collection_for("users", "critical").bulk_write(pulls, ordered=False)
+    return finished
+
+# What award_points needs back: the balance plus the leaderboard entry fields
+AWARDED_USER_PROJECTION = {**LEADERBOARD_USER_PROJECTION, "points": 1, "badge_pending": 1}
+
+_badge_tasks = set()
+
+async def settle_pending_badge(user_id: str, level: str, session=None):
+    """Write the badge for a level the user reached, then clear the user's marker"""
+    await award_badge_if_eligible(user_id, level, session=session)
+    await db.users.update_one({"id": user_id, "badge_pending": level}, {"$unset": {"badge_pending": ""}}, session=session)
+
+def settle_pending_badge_later(user_id: str, level: str):
+    """Settle a badge off the award's path; the marker covers a process dying first"""
+    async def settle():
+        try:
+            await settle_pending_badge(user_id, level)
+        except Exception as e:
+            logger.warning(f"Badge for user {user_id} left pending: {e}")
+    task = asyncio.create_task(settle())
+    _badge_tasks.add(task)
+    task.add_done_callback(_badge_tasks.discard)
+
+async def settle_pending_badges(limit: int = 10000):
+    """Settle badges left pending by a process that stopped before writing them"""
+    settled = 0
+    async for user in db.users.find({"badge_pending": {"$exists": True}}, {"_id": 0, "id": 1, "badge_pending": 1}).limit(limit):
+        await settle_pending_badge(user["id"], user["badge_pending"])
+        settled += 1
+    if settled:
+        logger.info(f"Settled {settled} pending badges")
+    return settled
+
+async def award_points(
+    user_id: str,
+    action: PointAction,
+    description: str = None,
+    amount_spent: float = None,
+    session=None,
+    transaction_id: Optional[str] = None,
+    evaluate_badges: bool = True
+):
+    """Award points to user for specific actions.
+
+    Two round trips: the ledger insert, then the balance update, which recomputes
+    the level in the same atomic write. The ledger row goes first so a balance is
+    never credited without one. When the award crosses a level threshold the badge
+    is settled in the background (or on the caller's `session`, inside its
+    transaction) rather than adding a third round trip.
+    
+    A `transaction_id` makes the award idempotent: if the ledger already holds that
+    id nothing is applied again. Background jobs use it so a retry cannot double
+    award. With a session the ledger and balance commit together; without one the
+    row is written unapplied under a claim, the balance update only matches while
+    the id is not in the user's `pending_award_ids`, and finish_awards flips the row
+    afterwards, so a retry after a crash between the two writes credits the award
+    exactly once. A retry that finds the row still claimed by a live attempt raises,
+    so the job runs again later.
+    """
+    points = points_for_action(action, amount_spent)
+    if points <= 0:
+        return 0
+    
+    transaction = PointsTransaction(
+        user_id=user_id,
+        action=action,
+        points=points,
+        description=description or f"Points earned for {action.value}"
+    )
+    # Outside a transaction an idempotent award is tracked until its balance lands
+    guarded = bool(transaction_id) and session is None
+    claim = award_claim() if guarded else None
+    if transaction_id:
+        transaction.id = transaction_id
+        if session is not None and await db.points_transactions.find_one({"id": transaction_id}, {"_id": 1}, session=session):
+            return 0
+    
+    def insert_transaction(session):
+        document = to_mongo(transaction)
+        if guarded:
+            document.update(applied=False, **claim)
+        return collection_for("points_transactions", "critical").insert_one(document, session=session)
+    
+    def update_balance(session):
+        return collection_for("users", "critical").find_one_and_update(
+            {"id": user_id, "pending_award_ids": {"$ne": transaction_id}} if guarded else {"id": user_id},
+            points_award_pipeline(points, [transaction_id] if guarded else None),
+            projection=AWARDED_USER_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+    
+    try:
+        await (insert_transaction(session) if session is not None else causal_write(user_id, insert_transaction))
+    except DuplicateKeyError:
+        if not guarded:
+            raise
+        # A previous attempt wrote the row; finish it if that attempt stopped short
+        if not await claim_stale_awards([transaction_id], claim):
+            existing = await db.points_transactions.find_one({"id": transaction_id}, {"_id": 0, "applied": 1})
+            if existing is None or existing.get("applied", True):
+                return 0
+            raise RuntimeError(f"Points transaction {transaction_id} is still being applied")
+    try:
+        user = await (update_balance(session) if session is not None else causal_write(user_id, update_balance))
+    except Exception:
+        if guarded:
+            await release_awards([transaction_id], claim)
+        raise
+    finally:
+        # The balance may have changed even if the reply was lost
+        invalidate_principal(user_id)
+    if guarded:
+        await finish_awards({user_id: [transaction_id]}, claim)
+        if user is None:
+            # Credited by an earlier attempt (or the user is gone)
+            return 0
+    
+    if user is None:
+        logger.warning(f"Points transaction {transaction.id} recorded for unknown user {user_id}")
+        return 0
+    leaderboard.update(user)
+    
+    if evaluate_badges and user.get("badge_pending"):
+        if session is not None:
+            await settle_pending_badge(user_id, user["badge_pending"], session=session)
+        else:
+            settle_pending_badge_later(user_id, user["badge_pending"])
+    
+    if session is None:
+        # Transactional callers record once the transaction commits
+        record_points_awarded(action, points)
+    logger.info(
+        f"Awarded {points} points to user {user_id} for {action.value}",
+        extra={"event": "points.awarded", "user_id": user_id, "action": action.value, "points": points}
+    )
+    return points
+
+BULK_AWARD_CHUNK_SIZE = 1000
+
+async def award_points_bulk(awards):
+    """Award points for many (user_id, action, amount[, description[, transaction_id]]) tuples at once.
+
+    Works in chunks of BULK_AWARD_CHUNK_SIZE: one unordered insert_many for the
+    ledger, one unordered bulk_write of per-user pipeline updates (several awards
+    for the same user are summed), then one read of the resulting levels and a
+    single bulk upsert for the badges of users that crossed a threshold. Awards for
+    unknown users or with no points are skipped and reported.
+
+    A `transaction_id` makes an award idempotent: repeats within the call are
+    dropped, the unique ledger index rejects ids written before, and only rows
+    that were actually inserted are credited. Ledger rows are written unapplied
+    under a claim and finished once the balance is updated, so a rerun after a
+    crash in between takes over the leftovers (see claim_stale_awards) and credits
+    them exactly once instead of skipping them as duplicates. Leftovers a live run
+    still holds are reported as `in_flight`.
+    """
+    summary = {"transactions": 0, "points": 0, "users": 0, "badges_awarded": 0, "skipped": 0, "duplicates": 0, "in_flight": 0, "unknown_users": []}
+    awards = list(awards)
+    seen_ids = set()
+    
+    for start in range(0, len(awards), BULK_AWARD_CHUNK_SIZE):
+        chunk = awards[start:start + BULK_AWARD_CHUNK_SIZE]
+        user_ids = list({award[0] for award in chunk})
+        known = await db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1}).to_list(length=None)
+        known_ids = {user["id"] for user in known}
+        summary["unknown_users"].extend(sorted(set(user_ids) - known_ids))
+        
+        claim = award_claim()
+        rows = []
+        for award in chunk:
+            user_id, action, amount = award[0], PointAction(award[1]), award[2]
+            description = award[3] if len(award) > 3 else None
+            transaction_id = award[4] if len(award) > 4 else None
+            points = amount if amount is not None else points_for_action(action)
+            if user_id not in known_ids or points <= 0:
+                summary["skipped"] += 1
+                continue
+            if transaction_id:
+                if transaction_id in seen_ids:
+                    summary["duplicates"] += 1
+                    continue
+                seen_ids.add(transaction_id)
+            transaction = PointsTransaction(
+                user_id=user_id,
+                action=action,
+                points=points,
+                description=description or f"Points earned for {action.value}"
+            )
+            if transaction_id:
+                transaction.id = transaction_id
+            rows.append({**to_mongo(transaction), "applied": False, **claim})
+        
+        if not rows:
+            continue
+        
+        failure = None
+        failed = set()
+        duplicate_ids = set()
+        try:
+            await collection_for("points_transactions", "bulk").insert_many(rows, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            failed = {error["index"] for error in errors}
+            duplicate_ids = {rows[error["index"]]["id"] for error in errors if error.get("code") == 11000}
+            if any(error.get("code") != 11000 for error in errors):
+                # Credit what did get inserted, then surface the failure
+                failure = e
+        
+        # Duplicates that a previous run wrote but never finished
+        repairs = await claim_stale_awards(duplicate_ids, claim) if duplicate_ids else []
+        if duplicate_ids:
+            unfinished = await db.points_transactions.count_documents({"id": {"$in": list(duplicate_ids)}, "applied": False})
+            summary["in_flight"] += unfinished - len(repairs)
+            summary["duplicates"] += len(duplicate_ids) - unfinished
+        to_apply = [row for index, row in enumerate(rows) if index not in failed] + repairs
+        
+        awards_by_user = {}
+        for row in to_apply:
+            awards_by_user.setdefault(row["user_id"], []).append((row["id"], row["points"]))
+        if awards_by_user:
+            try:
+                await collection_for("users", "bulk").bulk_write(
+                    [UpdateOne({"id": user_id}, guarded_award_pipeline(user_awards)) for user_id, user_awards in awards_by_user.items()],
+                    ordered=False
+                )
+            except Exception:
+                await release_awards([row["id"] for row in to_apply], claim)
+                raise
+            finally:
+                for user_id in awards_by_user:
+                    invalidate_principal(user_id)
+            finished = await finish_awards(
+                {user_id: [transaction_id for transaction_id, _ in user_awards] for user_id, user_awards in awards_by_user.items()},
+                claim
+            )
+            to_apply = [row for row in to_apply if row["id"] in finished]
+            for row in to_apply:
+                record_points_awarded(PointAction(row["action"]), row["points"])
+            
+            # Recompute badges in one pass over the updated users
+            updated = await db.users.find(
+                {"id": {"$in": list(awards_by_user)}},
+                AWARDED_USER_PROJECTION
+            ).to_list(length=None)
+            badge_upserts = []
+            settled = []
+            for user in updated:
+                leaderboard.update(user)
+                if not user.get("badge_pending"):
+                    continue
+                settled.append(UpdateOne({"id": user["id"], "badge_pending": user["badge_pending"]}, {"$unset": {"badge_pending": ""}}))
+                badge_type = LEVEL_BADGES.get(user["badge_pending"])
+                if badge_type:
+                    badge = Badge(user_id=user["id"], badge_type=badge_type)
+                    badge_upserts.append(UpdateOne(
+                        {"user_id": user["id"], "badge_type": badge_type},
+                        {"$setOnInsert": to_mongo(badge)},
+                        upsert=True
+                    ))
+            if badge_upserts:
+                try:
+                    result = await collection_for("badges", "bulk").bulk_write(badge_upserts, ordered=False)
+                    summary["badges_awarded"] += result.upserted_count
+                except BulkWriteError as e:
+                    # Duplicate keys mean a concurrent award inserted the badge first
+                    if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                        raise
+                    summary["badges_awarded"] += e.details.get("nUpserted", 0)
+            if settled:
+                await collection_for("users", "bulk").bulk_write(settled, ordered=False)
+            
+            summary["transactions"] += len(to_apply)
+            summary["points"] += sum(row["points"] for row in to_apply)
+            summary["users"] += len({row["user_id"] for row in to_apply})
+        
+        if failure is not None:
+            raise failure
+    
+    logger.info(
+        f"Awarded {summary['points']} points to {summary['users']} users in bulk",
+        extra={"event": "points.bulk_awarded", **{key: summary[key] for key in ("transactions", "points", "users", "badges_awarded", "skipped", "duplicates", "in_flight")}}
+    )
+    return summary
+
+async def grant_monthly_membership_points(batch_size: int = 5000, month: Optional[str] = None):
+    """Grant every user the monthly points of their membership level.
+
+    Ledger ids are derived from (user, month), so running it twice for the same
+    month (a retried cron, a manual rerun) grants nothing the second time.
+    """
+    month = month or datetime.now(timezone.utc).strftime("%Y-%m")
+    summary = None
+    batch = []
+    cursor = db.users.find({}, {"_id": 0, "id": 1, "membership_level": 1}).batch_size(batch_size)
+    async for user in cursor:
+        level = MembershipLevel(user.get("membership_level") or MembershipLevel.BASIC)
+        batch.append((
+            user["id"], PointAction.MONTHLY_MEMBERSHIP, MEMBERSHIP_BENEFITS[level]["monthly_points"],
+            f"Puntos mensuales {level.value}", f"monthly_membership:{user['id']}:{month}"
+        ))
+        if len(batch) >= batch_size:
+            summary = _merge_bulk_summaries(summary, await award_points_bulk(batch))
+            batch = []
+    if batch:
+        summary = _merge_bulk_summaries(summary, await award_points_bulk(batch))
+    return summary or await award_points_bulk([])
+
+def _merge_bulk_summaries(total, summary):
+    if total is None:
+        return summary
+    for key, value in summary.items():
+        total[key] = total[key] + value
+    return total
+
+async def award_badge_if_eligible(user_id: str, level: str, session=None):
+    """Award badge based on user level; safe to call repeatedly"""
+    badge_type = LEVEL_BADGES.get(level)
+    if badge_type:
+        badge = Badge(user_id=user_id, badge_type=badge_type)
+        def upsert(session):
+            return db.badges.update_one(
+                {"user_id": user_id, "badge_type": badge_type},
+                {"$setOnInsert": to_mongo(badge)},
+                upsert=True,
+                session=session
+            )
+        try:
+            result = await (upsert(session) if session is not None else causal_write(user_id, upsert))
+        except DuplicateKeyError:
+            # A concurrent award inserted the same badge first
+            return
+        if result.upserted_id is not None:
+            logger.info(
+                f"Badge {badge_type.value} awarded to user {user_id}",
+                extra={"event": "badge.awarded", "user_id": user_id, "badge_type": badge_type.value}
+            )
+
+# Leaderboard
+class Leaderboard:
+    """In-memory ranking of every user by total_points_earned.
+
+    Ranks are kept in SortedLists of (-total_points_earned, user_id) keys, one
+    overall and one per level, so updates, rank lookups and page starts are all
+    logarithmic. award_points feeds it incrementally. `reconcile` picks up writes
+    made by other processes by reading only the users whose `ranked_at` moved since
+    the previous pass (overlapping by one interval to absorb replica lag and clock
+    skew); a full rescan runs every `full_reconcile_interval` to catch the rest,
+    such as new signups.
+    """
+    def __init__(self, reconcile_interval: float, full_reconcile_interval: float):
+        self.reconcile_interval = reconcile_interval
+        self.full_reconcile_interval = full_reconcile_interval
+        self.loaded_at = None
+        self.full_loaded_at = None
+        self.reconciles = 0
+        self.full_reconciles = 0
+        self._entries = {}
+        self._ranking = SortedList()
+        self._rankings_by_level = {}
+        self._pending = None
+        self._task = None
+
+    @staticmethod
+    def _key(entry):
+        return (-entry["total_points_earned"], entry["id"])
+
+    @staticmethod
+    def _entry(user: dict):
+        return {
+            "id": user["id"],
+            "name": user["name"],
+            "total_points_earned": user.get("total_points_earned", 0),
+            "level": user.get("level", "Beginner")
+        }
+
+    def _apply(self, entry):
+        previous = self._entries.get(entry["id"])
+        if previous is not None:
+            key = self._key(previous)
+            self._ranking.discard(key)
+            self._rankings_by_level[previous["level"]].discard(key)
+        self._entries[entry["id"]] = entry
+        key = self._key(entry)
+        self._ranking.add(key)
+        self._rankings_by_level.setdefault(entry["level"], SortedList()).add(key)
+
+    def update(self, user: dict):
+        """Apply a user document holding at least id, name, total_points_earned and level"""
+        entry = self._entry(user)
+        if self._pending is not None:
+            self._pending[entry["id"]] = entry
+        self._apply(entry)
+
+    def size(self, level: Optional[str] = None) -> int:
+        return len(self._ranking if level is None else self._rankings_by_level.get(level, ()))
+
+    def rank(self, user_id: str, level: Optional[str] = None) -> Optional[int]:
+        entry = self._entries.get(user_id)
+        if entry is None or (level is not None and entry["level"] != level):
+            return None
+        ranking = self._ranking if level is None else self._rankings_by_level[level]
+        return ranking.bisect_left(self._key(entry)) + 1
+
+    def page(self, offset: int = 0, limit: int = 10, level: Optional[str] = None) -> List[LeaderboardEntry]:
+        ranking = self._ranking if level is None else self._rankings_by_level.get(level, SortedList())
+        return [
+            self.entry_for(user_id, offset + i + 1)
+            for i, (_, user_id) in enumerate(ranking.islice(offset, offset + limit))
+        ]
+
+    def entry_for(self, user_id: str, rank: int) -> LeaderboardEntry:
+        entry = self._entries[user_id]
+        return LeaderboardEntry(name=entry["name"], points=entry["total_points_earned"], level=entry["level"], rank=rank)
+
+    async def reconcile(self, full: bool = False):
+        """Read changed users (or everyone) from Mongo, then replay updates that arrived while reading"""
+        started = datetime.now(timezone.utc)
+        full = full or self.full_loaded_at is None or (started - self.full_loaded_at).total_seconds() >= self.full_reconcile_interval
+        query = {} if full else {"ranked_at": {"$gte": self.loaded_at - timedelta(seconds=self.reconcile_interval)}}
+        self._pending = {}
+        try:
+            entries = {}
+            cursor = read_collection("users", "eventual").find(query, LEADERBOARD_USER_PROJECTION).batch_size(5000)
+            async for user in cursor:
+                entries[user["id"]] = self._entry(user)
+            pending = self._pending
+        finally:
+            self._pending = None
+        
+        entries.update(pending)
+        if READ_ROUTING_ENABLED:
+            # The scan may come from a lagging secondary; totals only grow, so keep
+            # whichever side has seen more of a user's awards
+            for user_id, entry in entries.items():
+                current = self._entries.get(user_id)
+                if current is not None and current["total_points_earned"] > entry["total_points_earned"]:
+                    entries[user_id] = current
+        
+        if full:
+            ranking = SortedList(self._key(entry) for entry in entries.values())
+            rankings_by_level = {}
+            for key in ranking:
+                rankings_by_level.setdefault(entries[key[1]]["level"], []).append(key)
+            self._entries, self._ranking = entries, ranking
+            self._rankings_by_level = {level: SortedList(keys) for level, keys in rankings_by_level.items()}
+            self.full_loaded_at = started
+            self.full_reconciles += 1
+        else:
+            for entry in entries.values():
+                self._apply(entry)
+        self.loaded_at = started
+        self.reconciles += 1
+
+    async def ensure_loaded(self):
+        if self.loaded_at is None:
+            await self.reconcile()
+
+    async def _reconcile_forever(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Error reconciling leaderboard: {e}")
+
+    async def start(self):
+        await self.reconcile(full=True)
+        self._task = asyncio.create_task(self._reconcile_forever())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "users": len(self._entries),
+            "levels": {level: len(ranking) for level, ranking in self._rankings_by_level.items()},
+            "reconciles": self.reconciles,
+            "full_reconciles": self.full_reconciles,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "full_loaded_at": self.full_loaded_at.isoformat() if self.full_loaded_at else None
+        }
+
+leaderboard = Leaderboard(
+    reconcile_interval=float(os.environ.get("LEADERBOARD_RECONCILE_SECONDS", "60")),
+    full_reconcile_interval=float(os.environ.get("LEADERBOARD_FULL_RECONCILE_SECONDS", "3600"))
+)
+
+# Anonymous clients only see the top of the ranking; deeper pages need a login
+LEADERBOARD_PUBLIC_DEPTH = int(os.environ.get("LEADERBOARD_PUBLIC_DEPTH", "100"))
+
+# Product catalog
+def _serialize_json(content) -> bytes:
+    """Encode like JSONResponse does, so cached bodies match the regular responses"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+class ProductCatalog:
+    """Process-local snapshot of the products collection.
+
+    Products are indexed by id and by diet type and the list responses are kept
+    pre-serialized. Writers bump the version counter in `catalog_meta`; the snapshot
+    is rebuilt from a change stream on products when the deployment supports one,
+    otherwise by polling that counter every `poll_interval` seconds.
+    """
+    META_ID = "products"
+
+    def __init__(self, poll_interval: float, coalesce_seconds: float = 0.5):
+        self.poll_interval = poll_interval
+        self.coalesce_seconds = coalesce_seconds
+        self.version = None
+        self.price_version = None
+        self.loaded_at = None
+        self.refresh_mode = None
+        self.refreshes = 0
+        self.change_events = 0
+        self._by_id = {}
+        self._by_diet_type = {}
+        self._products = []
+        self._serialized_lists = {}
+        self._serialized_products = {}
+        self._task = None
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    async def _read_version(self):
+        meta = await db.catalog_meta.find_one({"_id": self.META_ID})
+        return meta.get("version", 0) if meta else 0
+
+    async def load(self):
+        version = await self._read_version()
+        documents = await db.products.find({}, projection_for(Product)).to_list(length=None)
+        products = many_from_mongo(Product, documents)
+
+        by_id = {product.id: product for product in products}
+        by_diet_type = {diet_type.value: [] for diet_type in DietType}
+        for product in products:
+            by_diet_type.setdefault(product.diet_type.value, []).append(product)
+
+        payloads = {product.id: product.model_dump(mode="json") for product in products}
+        serialized_lists = {None: _serialize_json([payloads[product.id] for product in products])}
+        for diet_type, members in by_diet_type.items():
+            serialized_lists[diet_type] = _serialize_json([payloads[product.id] for product in members])
+
+        # Swap everything at once so readers never see a half-built snapshot
+        (self._products, self._by_id, self._by_diet_type, self._serialized_lists,
+         self._serialized_products) = (products, by_id, by_diet_type, serialized_lists,
+                                       {product_id: _serialize_json(payload) for product_id, payload in payloads.items()})
+        self.version = version
+        # Changes whenever a product is added, removed or repriced, however the reload was triggered
+        self.price_version = hashlib.sha1(
+            "".join(f"{product.id}:{product.price!r};" for product in sorted(products, key=lambda product: product.id)).encode()
+        ).hexdigest()[:16]
+        self.loaded_at = datetime.now(timezone.utc)
+        self.refreshes += 1
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.load()
+
+    async def bump_version(self):
+        """Record a catalog change for every process and reload this one right away"""
+        await db.catalog_meta.update_one({"_id": self.META_ID}, {"$inc": {"version": 1}}, upsert=True)
+        await self.load()
+
+    def get(self, product_id: str) -> Optional[Product]:
+        return self._by_id.get(product_id)
+
+    def list(self, diet_type: Optional[str] = None, limit: Optional[int] = None) -> List[Product]:
+        products = self._products if diet_type is None else self._by_diet_type.get(diet_type, [])
+        return products[:limit] if limit is not None else list(products)
+
+    def serialized_list(self, diet_type: Optional[str] = None) -> bytes:
+        return self._serialized_lists.get(diet_type, b"[]")
+
+    def serialized_product(self, product_id: str) -> Optional[bytes]:
+        return self._serialized_products.get(product_id)
+
+    async def _watch_changes(self):
+        async with db.products.watch() as stream:
+            self.refresh_mode = "change_stream"
+            await self._reload_on(stream)
+
+    async def _reload_on(self, events):
+        """Reload once per burst of change events rather than once per event.
+
+        A bulk repricing emits an event per product; they are collected while a
+        reload waits `coalesce_seconds` (and while it runs), then handled by a
+        single reload, so carts see one price_version change instead of N.
+        """
+        changed = asyncio.Event()
+
+        async def reload_on_change():
+            while True:
+                await changed.wait()
+                await asyncio.sleep(self.coalesce_seconds)
+                changed.clear()
+                try:
+                    await self.load()
+                except Exception as e:
+                    logger.error(f"Error refreshing product catalog: {e}")
+
+        reloader = asyncio.create_task(reload_on_change())
+        try:
+            async for _ in events:
+                self.change_events += 1
+                changed.set()
+        finally:
+            reloader.cancel()
+
+    async def _poll_version(self):
+        self.refresh_mode = "polling"
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if await self._read_version() != self.version:
+                    await self.load()
+            except Exception as e:
+                logger.error(f"Error refreshing product catalog: {e}")
+
+    async def _refresh_forever(self):
+        try:
+            await self._watch_changes()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Standalone mongod has no change streams
+            logger.info(f"Product catalog falling back to polling: {e}")
+        await self._poll_version()
+
+    async def start(self):
+        await self.load()
+        self._task = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "price_version": self.price_version,
+            "products": len(self._products),
+            "refreshes": self.refreshes,
+            "change_events": self.change_events,
+            "refresh_mode": self.refresh_mode,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None
+        }
+
+product_catalog = ProductCatalog(
+    poll_interval=float(os.environ.get("CATALOG_POLL_SECONDS", "30")),
+    coalesce_seconds=float(os.environ.get("CATALOG_COALESCE_SECONDS", "0.5"))
+)
+
+# Cart pricing
+# Cart documents carry a priced snapshot: unit_price and subtotal per line, the total
+# and the catalog price_version they were priced at. Mutations keep it current in the
+# same write; a read only reprices (and writes the result back) when the catalog's
+# prices changed since, so GET /cart is normally one document fetch.
+def round_cents(amount: float) -> float:
+    """Round to cents, half up; round_cents_expression does the same inside a pipeline"""
+    return math.floor(amount * 100 + 0.5) / 100
+
+def round_cents_expression(amount) -> dict:
+    # Same double arithmetic as round_cents, so Python and Mongo agree to the bit
+    return {"$divide": [{"$floor": {"$add": [{"$multiply": [amount, 100]}, 0.5]}}, 100]}
+
+def price_cart_items(items):
+    """Price cart lines against the product catalog (which must be loaded).
+
+    Returns (priced items, total). Subtotals are rounded to cents before they are
+    added up, so the lines always sum to the total. Lines whose product no longer
+    exists keep their quantity with no unit price and count for nothing.
+    """
+    priced = []
+    total = 0
+    for item in items:
+        product = product_catalog.get(item["product_id"])
+        unit_price = product.price if product else None
+        subtotal = round_cents(unit_price * item["quantity"]) if product else 0
+        priced.append({"product_id": item["product_id"], "quantity": item["quantity"], "unit_price": unit_price, "subtotal": subtotal})
+        total += subtotal
+    return priced, round_cents(total)
+
+def cart_line_expression(item: str, quantity=None) -> dict:
+    """A stored cart line rebuilt from the pipeline variable `item`, optionally with a new quantity"""
+    return {
+        "product_id": f"{item}.product_id",
+        "quantity": f"{item}.quantity" if quantity is None else quantity,
+        "unit_price": f"{item}.unit_price",
+        "subtotal": f"{item}.subtotal"
+    }
+
+def cart_total_stages():
+    """Pipeline stages recomputing line subtotals and the cart total from unit prices, like price_cart_items"""
+    return [
+        {"$set": {"items": {"$map": {
+            "input": "$items",
+            "as": "item",
+            "in": {**cart_line_expression("$$item"), "subtotal": round_cents_expression(
+                {"$multiply": ["$$item.quantity", {"$ifNull": ["$$item.unit_price", 0]}]}
+            )}
+        }}}},
+        {"$set": {"total": round_cents_expression({"$sum": "$items.subtotal"})}}
+    ]
+
+async def reprice_cart(user_id: str, cart: dict):
+    """Bring a cart's snapshot up to the current catalog prices and store it.
+
+    The write only lands if the cart was not mutated since it was read; either way
+    the freshly priced cart is returned.
+    """
+    items, total = price_cart_items(cart.get("items", []))
+    repriced = {"items": items, "total": total, "catalog_version": product_catalog.price_version}
+    await db.carts.update_one({"user_id": user_id, "updated_at": cart.get("updated_at")}, {"$set": repriced})
+    return {**cart, **repriced}
+
+# Cart mutations
+# Every change to a cart is a single update, so concurrent requests cannot lose each
+# other's items. Adds and merges are one upsert with an update pipeline that folds the
+# incoming lines into the stored ones, summing quantities of the same product.
+def cart_merge_pipeline(items: list, catalog_version: str):
+    """Update pipeline adding priced `items` (one per product) to a cart, creating it if needed.
+
+    Lines already in the cart keep their unit price, so the snapshot only stays at
+    `catalog_version` if it was priced at that version before (or the cart was empty).
+    """
+    now = datetime.now(timezone.utc)
+    incoming = {"$literal": items}
+    existing = {"$ifNull": ["$items", []]}
+    return [{"$set": {
+        "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+        "created_at": {"$ifNull": ["$created_at", now]},
+        "updated_at": now,
+        "catalog_version": {"$cond": [
+            {"$or": [{"$eq": [{"$size": existing}, 0]}, {"$eq": ["$catalog_version", catalog_version]}]},
+            catalog_version,
+            None
+        ]},
+        "items": {"$let": {
+            "vars": {"existing": existing},
+            "in": {"$concatArrays": [
+                # Lines already in the cart, plus the incoming quantity for the same product
+                {"$map": {
+                    "input": "$$existing",
+                    "as": "item",
+                    "in": cart_line_expression("$$item", {"$add": ["$$item.quantity", {"$ifNull": [{"$arrayElemAt": [{"$map": {
+                        "input": {"$filter": {"input": incoming, "as": "line", "cond": {"$eq": ["$$line.product_id", "$$item.product_id"]}}},
+                        "as": "line",
+                        "in": "$$line.quantity"
+                    }}, 0]}, 0]}]})
+                }},
+                # Incoming lines for products not in the cart yet
+                {"$filter": {"input": incoming, "as": "line", "cond": {"$not": {"$in": ["$$line.product_id", "$$existing.product_id"]}}}}
+            ]}
+        }}
+    }}, *cart_total_stages()]
+
+async def merge_into_cart(user_id: str, items: list):
+    """Add cart lines in one round trip; lines for products not in the catalog are dropped"""
+    await product_catalog.ensure_loaded()
+    quantities = {}
+    for item in items:
+        if item["quantity"] > 0 and product_catalog.get(item["product_id"]) is not None:
+            quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    if not quantities:
+        return False
+    lines, _ = price_cart_items([{"product_id": product_id, "quantity": quantity} for product_id, quantity in quantities.items()])
+    await db.carts.update_one({"user_id": user_id}, cart_merge_pipeline(lines, product_catalog.price_version), upsert=True)
+    return True
+
+async def set_cart_quantity(user_id: str, product_id: str, quantity: int):
+    """Set a line's quantity (0 removes it); False when the cart has no such line"""
+    result = await db.carts.update_one(
+        {"user_id": user_id, "items.product_id": product_id},
+        [{"$set": {
+            "updated_at": datetime.now(timezone.utc),
+            "items": {"$filter": {
+                "input": {"$map": {
+                    "input": "$items",
+                    "as": "item",
+                    "in": {"$cond": [
+                        {"$eq": ["$$item.product_id", {"$literal": product_id}]},
+                        cart_line_expression("$$item", quantity),
+                        "$$item"
+                    ]}
+                }},
+                "as": "item",
+                "cond": {"$gt": ["$$item.quantity", 0]}
+            }}
+        }}, *cart_total_stages()]
+    )
+    return result.matched_count > 0
+
+# Transactions
+# Multi-document transactions need a replica set or sharded cluster. MONGO_TRANSACTIONS
+# forces them on or off; "auto" asks the server once.
+MONGO_TRANSACTIONS = os.environ.get("MONGO_TRANSACTIONS", "auto").lower()  # auto, on or off
+
+_transactions_supported = None
+
+async def transactions_supported():
+    """Whether the deployment runs multi-document transactions (anything but a standalone)"""
+    global _transactions_supported
+    if MONGO_TRANSACTIONS in ("on", "off"):
+        return MONGO_TRANSACTIONS == "on"
+    if _transactions_supported is None:
+        try:
+            hello = await client.admin.command("hello")
+            _transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception as e:
+            logger.warning(f"Could not detect MongoDB topology, running without transactions: {e}")
+            _transactions_supported = False
+    return _transactions_supported
+
+async def run_in_transaction(callback, user_id: Optional[str] = None):
+    """Run `callback(session)` in a transaction, or `callback(None)` where there are none.
+
+    The callback may be retried on transient errors, so it must only write through
+    the session. With read routing on, the commit position is recorded for `user_id`.
+    """
+    if not await transactions_supported():
+        return await callback(None)
+    
+    async with await client.start_session() as session:
+        result = await session.with_transaction(
+            callback,
+            read_concern=ReadConcern("majority"),
+            write_concern=WRITE_CONCERNS["critical"],
+            read_preference=Primary()
+        )
+        if CAUSAL_READS_ENABLED and user_id:
+            causal_tokens.record(user_id, session)
+    return result
+
+# Background jobs
+# Side effects that do not have to finish inside a request (points, emails, badges)
+# go through a Mongo-backed outbox: jobs are inserted in the same transaction as the
+# write that causes them, and a pool of asyncio workers in every API process claims
+# them with a lease, retries failures with exponential backoff and marks them done.
+# Deterministic job ids make enqueueing idempotent.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "5"))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "8"))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.environ.get("JOB_RETRY_MAX_SECONDS", "300"))
+# Finished jobs are removed by a TTL index; failed ones stay for inspection
+JOB_RETENTION_DAYS = int(os.environ.get("JOB_RETENTION_DAYS", "7"))
+
+class JobQueue:
+    """Outbox-backed asyncio worker pool.
+
+    Handlers must be idempotent: a job whose worker dies mid-run is picked up
+    again once its lease expires.
+    """
+    
+    def __init__(self, workers: int, poll_seconds: float):
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.handlers = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self.lost = 0
+    
+    def handler(self, job_type: str):
+        def register(func):
+            self.handlers[job_type] = func
+            return func
+        return register
+    
+    @staticmethod
+    def job(job_type: str, payload: dict, job_id: Optional[str] = None):
+        """Outbox document for `enqueue`; `job_id` deduplicates repeated enqueues"""
+        now = datetime.now(timezone.utc)
+        return {
+            "_id": job_id or f"{job_type}:{uuid.uuid4()}",
+            "type": job_type,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "run_at": now,
+            "created_at": now,
+            # Logs written while the job runs carry the id of the request that queued it
+            "request_id": request_id_var.get()
+        }
+    
+    async def enqueue(self, jobs: list, session=None):
+        """Insert outbox documents, skipping ids that were already enqueued"""
+        try:
+            await collection_for("jobs", "critical").insert_many(jobs, ordered=False, session=session)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        if session is None:
+            self.notify()
+    
+    def notify(self):
+        """Wake idle workers of this process instead of waiting for the next poll"""
+        self._wakeup.set()
+    
+    async def _claim(self):
+        now = datetime.now(timezone.utc)
+        return await db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "run_at": {"$lte": now}},
+                # A worker died holding the lease
+                {"status": "running", "locked_until": {"$lt": now}}
+            ]},
+            # The lease token identifies this claim; a worker that outlived its lease cannot finish a re-leased job
+            {"$set": {"status": "running", "lease": uuid.uuid4().hex, "locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS)}, "$inc": {"attempts": 1}},
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def _settle(self, job: dict, update: dict) -> bool:
+        """Apply the outcome of a run, unless another worker has leased the job since"""
+        result = await db.jobs.update_one({"_id": job["_id"], "status": "running", "lease": job["lease"]}, update)
+        if result.matched_count == 0:
+            self.lost += 1
+            logger.warning(f"Job {job['_id']} attempt {job['attempts']} lost its lease before finishing")
+            return False
+        return True
+    
+    async def run_job(self, job: dict):
+        handler = self.handlers.get(job["type"])
+        token = request_id_var.set(job.get("request_id"))
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for job type {job['type']}")
+            await handler(job["payload"])
+        except Exception as e:
+            now = datetime.now(timezone.utc)
+            give_up = job["attempts"] >= JOB_MAX_ATTEMPTS
+            if give_up:
+                update = {"status": "failed", "last_error": str(e), "failed_at": now}
+            else:
+                delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1))
+                update = {"status": "pending", "last_error": str(e), "run_at": now + timedelta(seconds=delay)}
+            if not await self._settle(job, {"$set": update, "$unset": {"locked_until": "", "lease": ""}}):
+                return False
+            if give_up:
+                self.failed += 1
+                logger.error(f"Job {job['_id']} failed after {job['attempts']} attempts: {e}")
+            else:
+                self.retried += 1
+                logger.warning(f"Job {job['_id']} attempt {job['attempts']} failed, retrying in {delay:.0f}s: {e}")
+            return False
+        finally:
+            request_id_var.reset(token)
+        
+        if not await self._settle(job, {
+            "$set": {"status": "done", "finished_at": datetime.now(timezone.utc)},
+            "$unset": {"locked_until": "", "lease": "", "last_error": ""}
+        }):
+            return False
+        self.processed += 1
+        return True
+    
+    async def run_pending(self, limit: Optional[int] = None):
+        """Process due jobs in the calling task until none are left (or `limit` ran)"""
+        ran = 0
+        while limit is None or ran < limit:
+            job = await self._claim()
+            if job is None:
+                break
+            await self.run_job(job)
+            ran += 1
+        return ran
+    
+    async def _worker(self):
+        while True:
+            try:
+                if await self.run_pending(limit=100):
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker error: {e}")
+            # asyncio.wait rather than wait_for: on 3.11 wait_for swallows a cancel that
+            # lands as the wakeup fires (notify() right before stop()), hanging shutdown
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait((wakeup,), timeout=self.poll_seconds)
+            finally:
+                wakeup.cancel()
+            self._wakeup.clear()
+    
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def stats(self):
+        return {
+            "workers": len(self._tasks),
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "lost_leases": self.lost
+        }
+
+job_queue = JobQueue(workers=JOB_WORKERS, poll_seconds=JOB_POLL_SECONDS)
+
+@job_queue.handler("order.points")
+async def award_order_points(payload: dict):
+    """Purchase (and first-purchase) points for an order, then queue the badge check.
+
+    The ledger ids are derived from the order, so a retried job finds its earlier
+    award and skips it rather than paying out twice. Without transactions a job
+    that died between the ledger row and the balance finishes the balance on retry
+    (see award_points).
+    """
+    order_id, user_id = payload["order_id"], payload["user_id"]
+    committed = {}
+    
+    async def award(session):
+        awards = {}
+        if payload.get("first_purchase"):
+            awards[PointAction.FIRST_PURCHASE] = await award_points(
+                user_id, PointAction.FIRST_PURCHASE, "¡Primera compra completada!",
+                session=session, transaction_id=f"{order_id}:first_purchase", evaluate_badges=False
+            )
+        awards[PointAction.PURCHASE] = await award_points(
+            user_id, PointAction.PURCHASE, f"Compra por ${payload['total']}", payload["total"],
+            session=session, transaction_id=f"{order_id}:purchase", evaluate_badges=False
+        )
+        await job_queue.enqueue([JobQueue.job("badges.evaluate", {"user_id": user_id}, f"badges.evaluate:{order_id}")], session=session)
+        if session is not None:
+            # Only the attempt that commits is counted; without a session award_points already did
+            committed.clear()
+            committed.update(awards)
+    
+    await run_in_transaction(award, user_id)
+    for action, points in committed.items():
+        if points:
+            record_points_awarded(action, points)
+    job_queue.notify()
+
+@job_queue.handler("badges.evaluate")
+async def evaluate_badges(payload: dict):
+    user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0, "level": 1})
+    if user:
+        await settle_pending_badge(payload["user_id"], user.get("level", "Beginner"))
+
+@job_queue.handler("order.email")
+async def send_order_email(payload: dict):
+    logger.info(
+        f"Order confirmation email sent to {payload['email']} for order {payload['order_id']}",
+        extra={"event": "order.email_sent", "order_id": payload["order_id"]}
+    )
+
+def order_jobs(order: Order, user: User, first_purchase: bool):
+    """Outbox entries for everything that follows an order, keyed by order id"""
+    return [
+        JobQueue.job("order.points", {
+            "order_id": order.id,
+            "user_id": user.id,
+            "total": order.total_amount,
+            "first_purchase": first_purchase
+        }, f"order.points:{order.id}"),
+        JobQueue.job("order.email", {"order_id": order.id, "email": user.email}, f"order.email:{order.id}")
+    ]
+
+# Checkout
+# POST /orders turns the cart into an order. On a replica set or sharded cluster the
+# cart claim, order insert, outbox jobs and idempotency record commit in one transaction;
+# points, badges and the confirmation email then run as background jobs. On a standalone
+# server the steps run in sequence; the cart is claimed (deleted) first, so a second
+# concurrent checkout finds it empty, and it is put back if a later step fails.
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+# An in-progress key older than this belongs to a request that died and may be taken over
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+async def claim_idempotency_key(record_id: str, user_id: str):
+    """Reserve an Idempotency-Key for this request.
+
+    Returns the stored record when the key already completed, None once the key is
+    reserved for the caller, and raises 409 while another request holds it.
+    """
+    now = datetime.now(timezone.utc)
+    reservation = {
+        "user_id": user_id,
+        "status": "in_progress",
+        "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS),
+        "created_at": now,
+        "expires_at": now + timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    }
+    try:
+        await db.idempotency_keys.insert_one({"_id": record_id, **reservation})
+        return None
+    except DuplicateKeyError:
+        pass
+    
+    # Take over a key whose request died, or one the TTL monitor has not removed yet
+    taken = await db.idempotency_keys.find_one_and_update(
+        {"_id": record_id, "$or": [
+            {"status": "in_progress", "locked_until": {"$lt": now}},
+            {"expires_at": {"$lt": now}}
+        ]},
+        {"$set": reservation, "$unset": {"status_code": "", "response": ""}}
+    )
+    if taken is not None:
+        return None
+    
+    record = await db.idempotency_keys.find_one({"_id": record_id})
+    if record is not None and record["status"] == "completed":
+        return record
+    raise HTTPException(status_code=409, detail="Hay un pedido en proceso con esta Idempotency-Key")
+
+async def release_idempotency_key(record_id: str):
+    await db.idempotency_keys.delete_one({"_id": record_id, "status": "in_progress"})
+
+async def _restore_cart(cart: dict):
+    try:
+        await db.carts.insert_one(cart)
+    except DuplicateKeyError:
+        # The user started a new cart meanwhile; keep both sets of items
+        await db.carts.update_one({"user_id": cart["user_id"]}, {"$push": {"items": {"$each": cart.get("items", [])}}})
+
+async def _checkout_steps(user: User, session=None, idempotency_record_id: Optional[str] = None):
+    cart = await db.carts.find_one_and_delete({"user_id": user.id}, projection={"_id": 0}, session=session)
+    order = None
+    try:
+        if not cart or not cart.get("items"):
+            raise HTTPException(status_code=400, detail="Cart is empty")
+        
+        # Always charge current prices, whatever the cart snapshot says
+        await product_catalog.ensure_loaded()
+        items, total = price_cart_items(cart["items"])
+        first_purchase = await db.orders.count_documents({"user_id": user.id}, limit=1, session=session) == 0
+        
+        order = Order(
+            user_id=user.id,
+            items=items,
+            total_amount=total,
+            status=OrderStatus.COMPLETED
+        )
+        def insert_order(session):
+            return collection_for("orders", "critical").insert_one(to_mongo(order), session=session)
+        await (insert_order(session) if session is not None else causal_write(user.id, insert_order))
+        await job_queue.enqueue(order_jobs(order, user, first_purchase), session=session)
+        
+        if idempotency_record_id:
+            await db.idempotency_keys.update_one(
+                {"_id": idempotency_record_id},
+                {"$set": {"status": "completed", "status_code": 200, "response": jsonable_encoder(order)}},
+                session=session
+            )
+        return order
+    except Exception:
+        # Inside a transaction the abort undoes everything
+        if session is None and cart is not None:
+            if order is not None:
+                await db.orders.delete_one({"id": order.id})
+                await db.jobs.delete_many({"_id": {"$in": [job["_id"] for job in order_jobs(order, user, False)]}, "status": "pending"})
+            await _restore_cart(cart)
+        raise
 
-class PointsAddRequest(BaseModel):
-    action: PointAction
-    description: Optional[str] = None
-    amount_spent: Optional[float] = None  # For purchase-based points
+async def checkout(user: User, idempotency_record_id: Optional[str] = None):
+    """Turn the user's cart into a completed order; its points follow as a background job"""
+    order = await run_in_transaction(lambda session: _checkout_steps(user, session, idempotency_record_id), user.id)
+    record_order(order)
+    job_queue.notify()
+    return order
 
-class ConsultationStartRequest(BaseModel):
-    client_id: str
+# Dashboard loading
+DASHBOARD_SECTION_TIMEOUT_SECONDS = float(os.environ.get("DASHBOARD_SECTION_TIMEOUT_SECONDS", "2"))
 
-class ConsultationCompleteRequest(BaseModel):
-    consultation_id: str
-    notes: str
-    recommendations: str
+async def load_sections(loaders: dict, required=(), timeout: float = None):
+    """Run independent dashboard queries concurrently.
 
-class OrderCreateRequest(BaseModel):
-    user_email: str
-    user_name: str
+    `loaders` maps a section name to a coroutine. Each section gets its own timeout;
+    one that fails or times out comes back as None and is listed as degraded, unless
+    it is in `required`, in which case its error is raised. Returns
+    (results, timings in ms, degraded section names).
+    """
+    timeout = timeout or DASHBOARD_SECTION_TIMEOUT_SECONDS
+    timings = {}
+    
+    async def run(name, loader):
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(loader, timeout)
+        finally:
+            timings[name] = (time.perf_counter() - started) * 1000
+    
+    outcomes = await asyncio.gather(*(run(name, loader) for name, loader in loaders.items()), return_exceptions=True)
+    
+    results = {}
+    degraded = []
+    for name, outcome in zip(loaders, outcomes):
+        if isinstance(outcome, BaseException):
+            if name in required:
+                raise outcome
+            logger.warning(f"Dashboard section {name} degraded: {outcome!r}")
+            degraded.append(name)
+            outcome = None
+        results[name] = outcome
+    return results, timings, degraded
 
-class Token(BaseModel):
-    access_token: str
-    token_type: str
-    user: dict
+def server_timing_header(timings: dict) -> str:
+    return ", ".join(f"{name};dur={duration:.1f}" for name, duration in timings.items())
 
-# Response Models
-class UserResponse(BaseModel):
-    id: str
-    email: str
-    name: str
-    role: UserRole
-    points: int
-    total_points_earned: int
-    level: str
+# Pagination
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
-# Response Models
-class UserResponse(BaseModel):
-    id: str
-    email: EmailStr
-    name: str
-    role: UserRole
-    points: int
-    total_points_earned: int
-    level: str
-    membership_level: Optional[MembershipLevel] = None
+def encode_cursor(sort_value, document_id: str) -> str:
+    """Opaque keyset cursor for the last document of a page"""
+    if isinstance(sort_value, datetime):
+        sort_value = {"$date": sort_value.isoformat()}
+    raw = json.dumps([sort_value, document_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
-class PointsHistoryResponse(BaseModel):
-    transactions: List[PointsTransaction]
-    total_points: int
-    current_level: str
-    next_level_threshold: int
-    progress_percentage: float
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, document_id = json.loads(raw)
+        if isinstance(sort_value, dict):
+            sort_value = datetime.fromisoformat(sort_value["$date"])
+        return sort_value, document_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-class LeaderboardEntry(BaseModel):
-    name: str
-    points: int
-    level: str
-    rank: int
+async def find_page(collection, query: dict, sort_field: str, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, projection=None, session=None):
+    """Fetch one page of documents ordered by (sort_field, id) descending.
 
-class DashboardClientResponse(BaseModel):
-    user: UserResponse
-    upcoming_appointments: List[dict] = []
-    recommended_products: List[Product] = []
-    recent_orders: List[Order] = []
-    recent_points: List[PointsTransaction] = []
-    badges: List[Badge] = []
+    Returns (documents, next_cursor); next_cursor is None on the last page. Pages
+    continue strictly after the cursor, so inserts at the head never shift them.
+    """
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor)
+        after_cursor = [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": last_id}}
+        ]
+        if isinstance(sort_value, datetime):
+            # Legacy ISO strings sort below every BSON date, i.e. after them in descending order
+            after_cursor.append({sort_field: {"$type": "string"}})
+        query = {"$and": [query, {"$or": after_cursor}]}
+    
+    documents = await collection.find(query, projection, session=session).sort([(sort_field, DESCENDING), ("id", DESCENDING)]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1][sort_field], documents[-1]["id"])
+    return documents, next_cursor
 
-class DashboardProfessionalResponse(BaseModel):
-    user: UserResponse
-    professional_info: dict
-    assigned_clients: List[dict] = []
-    upcoming_appointments: List[dict] = []
-    commission_pending: float = 125.0
-    total_earnings: float = 850.0
-    active_consultations: List[ConsultationSession] = []
+def set_next_cursor_header(response: Response, next_cursor: Optional[str]):
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
-# Helper functions
-def prepare_for_mongo(data):
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, datetime):
-                data[key] = value.isoformat()
-    return data
-
-def parse_from_mongo(item):
-    if isinstance(item.get('created_at'), str):
-        item['created_at'] = datetime.fromisoformat(item['created_at'])
-    if isinstance(item.get('updated_at'), str):
-        item['updated_at'] = datetime.fromisoformat(item['updated_at'])
-    if isinstance(item.get('scheduled_date'), str):
-        item['scheduled_date'] = datetime.fromisoformat(item['scheduled_date'])
-    if isinstance(item.get('start_time'), str):
-        item['start_time'] = datetime.fromisoformat(item['start_time'])
-    if isinstance(item.get('end_time'), str):
-        item['end_time'] = datetime.fromisoformat(item['end_time'])
-    if isinstance(item.get('earned_at'), str):
-        item['earned_at'] = datetime.fromisoformat(item['earned_at'])
-    return item
+# Ledger export
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+LEDGER_EXPORT_FIELDS = ["id", "user_id", "action", "points", "description", "created_at"]
 
-# Auth helper functions
-def verify_password(plain_password, hashed_password):
-    # Simple hash comparison using SHA256
-    password_hash = hashlib.sha256(plain_password.encode()).hexdigest()
-    return password_hash == hashed_password
+def datetime_range_query(field: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """[start, end) filter on a datetime field that also matches not-yet-migrated ISO strings"""
+    as_dates = {}
+    as_strings = {}
+    if start:
+        start = start if start.tzinfo else start.replace(tzinfo=timezone.utc)
+        as_dates["$gte"] = start
+        as_strings["$gte"] = start.astimezone(timezone.utc).isoformat()
+    if end:
+        end = end if end.tzinfo else end.replace(tzinfo=timezone.utc)
+        as_dates["$lt"] = end
+        as_strings["$lt"] = end.astimezone(timezone.utc).isoformat()
+    if not as_dates:
+        return {}
+    return {"$or": [{field: as_dates}, {field: {**as_strings, "$type": "string"}}]}
 
-def get_password_hash(password):
-    # Simple SHA256 hash
-    return hashlib.sha256(password.encode()).hexdigest()
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+async def stream_points_ledger(user_id: str, export_format: str = "ndjson", start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Yield a user's points ledger oldest first as NDJSON lines or CSV rows.
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
+    Documents are pulled from the cursor EXPORT_BATCH_SIZE at a time and written out
+    batch by batch, so memory stays flat however long the ledger is.
+    """
+    query = {"user_id": user_id, **datetime_range_query("created_at", start, end)}
     
-    user = await db.users.find_one({"id": user_id})
-    if user is None:
-        raise credentials_exception
-    return User(**parse_from_mongo(user))
+    projection = {"_id": 0, **{field: 1 for field in LEDGER_EXPORT_FIELDS}}
+    
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=LEDGER_EXPORT_FIELDS, extrasaction="ignore") if export_format == "csv" else None
+    if writer:
+        writer.writeheader()
+    
+    pending = 0
+    async with read_session(user_id) as session:
+        cursor = read_collection("points_transactions", "user").find(query, projection, session=session).sort(
+            [("created_at", ASCENDING), ("id", ASCENDING)]
+        ).batch_size(EXPORT_BATCH_SIZE)
+        async for transaction in cursor:
+            transaction["created_at"] = _export_value(transaction.get("created_at"))
+            if writer:
+                writer.writerow(transaction)
+            else:
+                buffer.write(json.dumps(transaction, ensure_ascii=False, default=str))
+                buffer.write("\n")
+            pending += 1
+            if pending >= EXPORT_BATCH_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+    
+    if buffer.tell():
+        yield buffer.getvalue()
 
-# Points system helper functions
-def calculate_level(total_points):
-    if total_points >= 5000:
-        return "Elite"
-    elif total_points >= 1500:
-        return "Premium"
-    elif total_points >= 500:
-        return "Active"
-    else:
-        return "Beginner"
+def points_ledger_response(user_id: str, export_format: str, start: Optional[datetime], end: Optional[datetime]):
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    extension = "csv" if export_format == "csv" else "ndjson"
+    return StreamingResponse(
+        stream_points_ledger(user_id, export_format, start, end),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="points-{user_id}.{extension}"'}
+    )
 
-def get_next_level_threshold(current_level):
-    thresholds = {
-        "Beginner": 500,
-        "Active": 1500,
-        "Premium": 5000,
-        "Elite": 10000
-    }
-    return thresholds.get(current_level, 10000)
+# BSON date migration
+# Datetime fields that older releases stored as ISO strings, per collection
+DATETIME_FIELDS = {
+    "users": ["created_at", "membership_start_date"],
+    "user_profiles": ["created_at", "updated_at"],
+    "professionals": ["created_at"],
+    "products": ["created_at"],
+    "carts": ["created_at", "updated_at"],
+    "orders": ["created_at"],
+    "points_transactions": ["created_at"],
+    "badges": ["earned_at"],
+    "consultations": ["created_at", "start_time", "end_time"],
+}
 
-async def award_points(user_id: str, action: PointAction, description: str = None, amount_spent: float = None):
-    """Award points to user for specific actions"""
-    if action == PointAction.PURCHASE and amount_spent:
-        points = int(amount_spent * POINT_VALUES[PointAction.PURCHASE])
-    else:
-        points = POINT_VALUES.get(action, 0)
-    
-    if points > 0:
-        # Create points transaction
-        transaction = PointsTransaction(
-            user_id=user_id,
-            action=action,
-            points=points,
-            description=description or f"Points earned for {action.value}"
-        )
-        
-        transaction_dict = prepare_for_mongo(transaction.dict())
-        await db.points_transactions.insert_one(transaction_dict)
+async def migrate_datetime_fields(batch_size: int = 1000, restart: bool = False):
+    """Rewrite ISO-string datetime fields as native BSON dates, in place.
+
+    Each collection is walked in _id order in batches of `batch_size`, converting
+    only documents that still hold strings. Progress is checkpointed in the
+    `migrations` collection so an interrupted run resumes where it stopped; every
+    update is conditional on the original string, so concurrent writes win.
+    """
+    summary = {}
+    for collection_name, fields in DATETIME_FIELDS.items():
+        checkpoint_id = f"bson-datetimes:{collection_name}"
+        if restart:
+            await db.migrations.delete_one({"_id": checkpoint_id})
+        checkpoint = await db.migrations.find_one({"_id": checkpoint_id}) or {}
+        if checkpoint.get("completed"):
+            summary[collection_name] = {"migrated": checkpoint.get("migrated", 0), "skipped": checkpoint.get("skipped", 0)}
+            continue
         
-        # Update user points
-        await db.users.update_one(
-            {"id": user_id},
-            {
-                "$inc": {
-                    "points": points,
-                    "total_points_earned": points
-                }
-            }
-        )
+        last_id = checkpoint.get("last_id")
+        migrated = checkpoint.get("migrated", 0)
+        skipped = checkpoint.get("skipped", 0)
+        collection = collection_for(collection_name, "bulk")
+        has_strings = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        projection = {field: 1 for field in fields}
         
-        # Update user level
-        user = await db.users.find_one({"id": user_id})
-        new_level = calculate_level(user["total_points_earned"])
-        if user["level"] != new_level:
-            await db.users.update_one(
-                {"id": user_id},
-                {"$set": {"level": new_level}}
-            )
+        while True:
+            query = has_strings if last_id is None else {"$and": [has_strings, {"_id": {"$gt": last_id}}]}
+            documents = await collection.find(query, projection).sort("_id", ASCENDING).limit(batch_size).to_list(batch_size)
+            if not documents:
+                break
             
-            # Award badge if needed
-            await award_badge_if_eligible(user_id, new_level)
-        
-        print(f"🏆 {points} puntos otorgados a usuario {user_id} por {action.value}")
-        return points
-    return 0
-
-async def award_badge_if_eligible(user_id: str, level: str):
-    """Award badge based on user level"""
-    badge_mapping = {
-        "Active": BadgeType.ACTIVE,
-        "Premium": BadgeType.PREMIUM,
-        "Elite": BadgeType.ELITE
-    }
-    
-    badge_type = badge_mapping.get(level)
-    if badge_type:
-        # Check if user already has this badge
-        existing_badge = await db.badges.find_one({
-            "user_id": user_id,
-            "badge_type": badge_type
-        })
+            updates = []
+            for document in documents:
+                original = {field: document[field] for field in fields if isinstance(document.get(field), str)}
+                converted = {}
+                for field, value in original.items():
+                    try:
+                        converted[field] = _parse_iso_datetime(value)
+                    except ValueError:
+                        logger.warning(f"Unparseable {collection_name}.{field} on {document['_id']}: {value!r}")
+                if converted:
+                    updates.append(UpdateOne({"_id": document["_id"], **original}, {"$set": converted}))
+                else:
+                    skipped += 1
+            
+            if updates:
+                result = await collection.bulk_write(updates, ordered=False)
+                migrated += result.modified_count
+            last_id = documents[-1]["_id"]
+            await db.migrations.update_one(
+                {"_id": checkpoint_id},
+                {"$set": {"last_id": last_id, "migrated": migrated, "skipped": skipped, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
         
-        if not existing_badge:
-            badge = Badge(user_id=user_id, badge_type=badge_type)
-            badge_dict = prepare_for_mongo(badge.dict())
-            await db.badges.insert_one(badge_dict)
-            print(f"🎖️ Badge {badge_type.value} otorgado a usuario {user_id}")
+        await db.migrations.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"completed": True, "migrated": migrated, "skipped": skipped, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        summary[collection_name] = {"migrated": migrated, "skipped": skipped}
+        logger.info(f"Datetime migration of {collection_name}: {migrated} documents converted, {skipped} skipped")
+    return summary
+
+# MongoDB indexes
+# Every collection the API filters or sorts on, keyed by collection name. Index
+# names are explicit so drift can be detected by name across deployments.
+INDEX_SPECS = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("total_points_earned", DESCENDING)], name="total_points_earned_desc"),
+        IndexModel([("badge_pending", ASCENDING)], name="badge_pending_sparse", sparse=True),
+        IndexModel([("ranked_at", ASCENDING)], name="ranked_at_sparse", sparse=True),
+    ],
+    "user_profiles": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "professionals": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("diet_type", ASCENDING)], name="diet_type"),
+    ],
+    "carts": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_id_created_at_id"),
+    ],
+    "points_transactions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_id_created_at_id"),
+    ],
+    "badges": [
+        IndexModel([("user_id", ASCENDING), ("badge_type", ASCENDING)], name="user_id_badge_type_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("earned_at", DESCENDING), ("id", DESCENDING)], name="user_id_earned_at_id"),
+    ],
+    "consultations": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("professional_id", ASCENDING), ("status", ASCENDING)], name="professional_id_status"),
+    ],
+    "idempotency_keys": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "jobs": [
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=JOB_RETENTION_DAYS * 86400),
+    ],
+}
+
+def _index_signature(spec):
+    """Comparable (key, unique, ttl) triple for a declared IndexModel or an index_information() entry"""
+    document = spec.document if isinstance(spec, IndexModel) else spec
+    key = document["key"]
+    key = list(key.items()) if hasattr(key, "items") else list(key)
+    return [(field, int(direction)) for field, direction in key], bool(document.get("unique", False)), document.get("expireAfterSeconds")
+
+async def ensure_indexes(create_missing: bool = True, drop_mismatched: bool = False):
+    """Reconcile INDEX_SPECS against the database and return a per-collection drift report.
+
+    Missing indexes are created when `create_missing` is set. Indexes whose name matches a
+    declared one but whose keys, uniqueness or TTL differ are only rebuilt with `drop_mismatched`;
+    indexes that exist but are not declared are reported and never dropped.
+    """
+    report = {}
+    for collection_name, specs in INDEX_SPECS.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        entry = {"missing": [], "created": [], "mismatched": [], "undeclared": [], "errors": []}
+        declared_names = set()
+        to_create = []
+
+        for spec in specs:
+            name = spec.document["name"]
+            declared_names.add(name)
+            if name not in existing:
+                entry["missing"].append(name)
+                to_create.append(spec)
+            elif _index_signature(existing[name]) != _index_signature(spec):
+                entry["mismatched"].append(name)
+                if drop_mismatched:
+                    await collection.drop_index(name)
+                    to_create.append(spec)
+
+        entry["undeclared"] = sorted(name for name in existing if name != "_id_" and name not in declared_names)
+
+        if to_create and (create_missing or drop_mismatched):
+            for spec in to_create:
+                try:
+                    await collection.create_indexes([spec])
+                    entry["created"].append(spec.document["name"])
+                except Exception as e:
+                    # Typically a unique index blocked by duplicate legacy data
+                    entry["errors"].append(f"{spec.document['name']}: {e}")
+
+        report[collection_name] = entry
+    return report
+
+def index_report_has_drift(report):
+    return any(
+        set(entry["missing"]) - set(entry["created"]) or entry["mismatched"] or entry["errors"]
+        for entry in report.values()
+    )
+
+def log_index_report(report):
+    for collection_name, entry in report.items():
+        for name in entry["created"]:
+            logger.info(f"Index {collection_name}.{name} created")
+        for name in set(entry["missing"]) - set(entry["created"]):
+            logger.warning(f"Index {collection_name}.{name} is missing")
+        for name in entry["mismatched"]:
+            logger.warning(f"Index {collection_name}.{name} differs from its declaration")
+        for name in entry["undeclared"]:
+            logger.info(f"Index {collection_name}.{name} exists but is not declared")
+        for error in entry["errors"]:
+            logger.error(f"Index {collection_name}.{error}")
 
 # Initialize demo products and users on startup
 demo_products = [
@@ -741,7 +3719,7 @@ async def root():
 @api_router.post("/auth/register", response_model=Token)
 async def register_user(user_data: UserRegister):
     # Check if user exists
-    existing_user = await db.users.find_one({"email": user_data.email})
+    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 1})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -754,8 +3732,8 @@ async def register_user(user_data: UserRegister):
         password_hash=get_password_hash(user_data.password)
     )
     
-    user_dict = prepare_for_mongo(user.dict())
-    await db.users.insert_one(user_dict)
+    user_dict = to_mongo(user)
+    await collection_for("users", "critical").insert_one(user_dict)
     
     # Create empty user profile for onboarding
     if user_data.role == UserRole.CLIENT:
@@ -765,7 +3743,7 @@ async def register_user(user_data: UserRegister):
             onboarding_completed=False,
             onboarding_step=1
         )
-        profile_dict = prepare_for_mongo(profile.dict())
+        profile_dict = to_mongo(profile)
         await db.user_profiles.insert_one(profile_dict)
     
     # If professional, create professional profile
@@ -776,7 +3754,7 @@ async def register_user(user_data: UserRegister):
             specialization=user_data.specialization or "General",
             bio=f"Especialista en {user_data.specialization or 'General'}"
         )
-        professional_dict = prepare_for_mongo(professional.dict())
+        professional_dict = to_mongo(professional)
         await db.professionals.insert_one(professional_dict)
     
     # Award registration points
@@ -804,11 +3782,15 @@ async def register_user(user_data: UserRegister):
 
 @api_router.post("/auth/login", response_model=Token)
 async def login_user(user_data: UserLogin):
-    user = await db.users.find_one({"email": user_data.email})
+    user = await db.users.find_one({"email": user_data.email}, USER_PROJECTION)
     if not user or not verify_password(user_data.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    user_obj = User(**parse_from_mongo(user))
+    user_obj = from_mongo(User, user)
+    
+    if user_data.cart_items:
+        # Carry over what the visitor put in the cart before logging in
+        await merge_into_cart(user_obj.id, [item.dict() for item in user_data.cart_items])
     
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -832,7 +3814,7 @@ async def login_user(user_data: UserLogin):
 
 @api_router.get("/auth/me", response_model=UserResponse)
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
-    return UserResponse(
+    return fast_response(UserResponse(
         id=current_user.id,
         email=current_user.email,
         name=current_user.name,
@@ -841,7 +3823,7 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
         total_points_earned=current_user.total_points_earned,
         level=current_user.level,
         membership_level=current_user.membership_level
-    )
+    ))
 
 # Onboarding endpoints
 @api_router.post("/onboarding/step1")
@@ -849,7 +3831,7 @@ async def update_onboarding_step1(request: OnboardingStep1Request, current_user:
     """Save personal data (Step 1 of onboarding)"""
     try:
         # Get or create user profile
-        profile = await db.user_profiles.find_one({"user_id": current_user.id})
+        profile = await db.user_profiles.find_one({"user_id": current_user.id}, {"_id": 1})
         
         personal_data = PersonalData(**request.dict())
         
@@ -858,9 +3840,9 @@ async def update_onboarding_step1(request: OnboardingStep1Request, current_user:
             await db.user_profiles.update_one(
                 {"user_id": current_user.id},
                 {"$set": {
-                    "personal_data": prepare_for_mongo(personal_data.dict()),
+                    "personal_data": to_mongo(personal_data),
                     "onboarding_step": 2,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "updated_at": datetime.now(timezone.utc)
                 }}
             )
         else:
@@ -870,7 +3852,7 @@ async def update_onboarding_step1(request: OnboardingStep1Request, current_user:
                 personal_data=personal_data,
                 onboarding_step=2
             )
-            await db.user_profiles.insert_one(prepare_for_mongo(new_profile.dict()))
+            await db.user_profiles.insert_one(to_mongo(new_profile))
         
         return {"message": "Información personal guardada exitosamente", "next_step": 2}
     except Exception as e:
@@ -901,10 +3883,10 @@ async def update_onboarding_step2(request: OnboardingStep2Request, current_user:
         await db.user_profiles.update_one(
             {"user_id": current_user.id},
             {"$set": {
-                "anthropometric_data": prepare_for_mongo(anthropometric.dict()) if anthropometric else None,
-                "health_history": prepare_for_mongo(health_history.dict()) if health_history else None,
+                "anthropometric_data": to_mongo(anthropometric) if anthropometric else None,
+                "health_history": to_mongo(health_history) if health_history else None,
                 "onboarding_step": 3,
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": datetime.now(timezone.utc)
             }}
         )
         
@@ -936,10 +3918,10 @@ async def update_onboarding_step3(request: OnboardingStep3Request, current_user:
         await db.user_profiles.update_one(
             {"user_id": current_user.id},
             {"$set": {
-                "goals": prepare_for_mongo(goals.dict()),
-                "habits": prepare_for_mongo(habits.dict()),
+                "goals": to_mongo(goals),
+                "habits": to_mongo(habits),
                 "onboarding_step": 4,
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": datetime.now(timezone.utc)
             }}
         )
         
@@ -953,7 +3935,7 @@ async def update_onboarding_step4(request: OnboardingStep4Request, current_user:
     """Save PAR-Q evaluation and dietary habits (Step 4)"""
     try:
         # Get existing health history
-        profile = await db.user_profiles.find_one({"user_id": current_user.id})
+        profile = await db.user_profiles.find_one({"user_id": current_user.id}, {"_id": 0, "health_history": 1, "habits": 1})
         existing_health = profile.get("health_history", {}) if profile else {}
         
         # Update health history with PAR-Q data
@@ -974,10 +3956,10 @@ async def update_onboarding_step4(request: OnboardingStep4Request, current_user:
         await db.user_profiles.update_one(
             {"user_id": current_user.id},
             {"$set": {
-                "health_history": prepare_for_mongo(health_history.dict()),
-                "habits": prepare_for_mongo(habits.dict()),
+                "health_history": to_mongo(health_history),
+                "habits": to_mongo(habits),
                 "onboarding_step": 5,
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": datetime.now(timezone.utc)
             }}
         )
         
@@ -1008,12 +3990,12 @@ async def update_onboarding_step5(request: OnboardingStep5Request, current_user:
         await db.user_profiles.update_one(
             {"user_id": current_user.id},
             {"$set": {
-                "shipping_address": prepare_for_mongo(request.shipping_address.dict()),
-                "billing_address": prepare_for_mongo(billing_addr.dict()),
-                "consent_settings": prepare_for_mongo(consent_settings.dict()),
+                "shipping_address": to_mongo(request.shipping_address),
+                "billing_address": to_mongo(billing_addr),
+                "consent_settings": to_mongo(consent_settings),
                 "onboarding_completed": True,
                 "onboarding_step": 6,  # Completed
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": datetime.now(timezone.utc)
             }}
         )
         
@@ -1029,7 +4011,7 @@ async def update_onboarding_step5(request: OnboardingStep5Request, current_user:
 async def get_onboarding_status(current_user: User = Depends(get_current_user)):
     """Get current onboarding status and progress"""
     try:
-        profile = await db.user_profiles.find_one({"user_id": current_user.id})
+        profile = await db.user_profiles.find_one({"user_id": current_user.id}, ONBOARDING_STATUS_PROJECTION)
         
         if not profile:
             return {
@@ -1080,14 +4062,15 @@ async def upgrade_membership(new_level: MembershipLevel, current_user: User = De
             raise HTTPException(status_code=400, detail="Ya tienes este nivel de membresía")
         
         # Update user membership
-        await db.users.update_one(
+        await collection_for("users", "critical").update_one(
             {"id": current_user.id},
             {"$set": {
                 "membership_level": new_level.value,
-                "membership_start_date": datetime.now(timezone.utc).isoformat(),
+                "membership_start_date": datetime.now(timezone.utc),
                 "consultations_used_this_month": 0
             }}
         )
+        invalidate_principal(current_user.id)
         
         # Award bonus points for upgrade
         bonus_points = MEMBERSHIP_BENEFITS[new_level]["monthly_points"]
@@ -1115,15 +4098,28 @@ async def add_points(request: PointsAddRequest, current_user: User = Depends(get
         "action": request.action
     }
 
+@api_router.post("/points/bulk", dependencies=[Depends(require_admin)])
+async def add_points_bulk(request: BulkPointsAwardRequest):
+    """Award points to many users at once (monthly grants, partner campaigns)"""
+    summary = await award_points_bulk(
+        (award.user_id, award.action, award.amount, award.description, award.transaction_id) for award in request.awards
+    )
+    return {
+        "message": f"¡{summary['points']} puntos agregados a {summary['users']} usuarios!",
+        **summary
+    }
+
 @api_router.get("/points/history", response_model=PointsHistoryResponse)
-async def get_points_history(current_user: User = Depends(get_current_user)):
-    """Get user's points history and progress"""
-    # Get recent transactions
-    transactions = await db.points_transactions.find(
-        {"user_id": current_user.id}
-    ).sort("created_at", -1).to_list(20)
+async def get_points_history(response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Get user's points history and progress, newest first; pass next_cursor to continue"""
+    async with read_session(current_user.id) as session:
+        transactions, next_cursor = await find_page(
+            read_collection("points_transactions", "user"), {"user_id": current_user.id}, "created_at", limit, cursor,
+            projection_for(PointsTransaction), session
+        )
+    set_next_cursor_header(response, next_cursor)
     
-    transactions_list = [PointsTransaction(**parse_from_mongo(t)) for t in transactions]
+    transactions_list = many_from_mongo(PointsTransaction, transactions)
     
     # Calculate progress to next level
     current_threshold = get_next_level_threshold(current_user.level)
@@ -1134,35 +4130,159 @@ async def get_points_history(current_user: User = Depends(get_current_user)):
         previous_threshold = BADGE_THRESHOLDS.get(BadgeType(current_user.level.lower()), 0)
         progress_percentage = min(100, ((current_user.total_points_earned - previous_threshold) / (current_threshold - previous_threshold)) * 100)
     
-    return PointsHistoryResponse(
+    return fast_response(PointsHistoryResponse(
         transactions=transactions_list,
         total_points=current_user.points,
         current_level=current_user.level,
         next_level_threshold=current_threshold,
-        progress_percentage=round(progress_percentage, 1)
+        progress_percentage=round(progress_percentage, 1),
+        next_cursor=next_cursor
+    ), response)
+
+@api_router.get("/system/stats", dependencies=[Depends(require_admin)])
+async def get_system_stats():
+    """Process-local cache and connection pool counters; exposes client config, so admin only"""
+    return {
+        "principal_cache": principal_cache.stats(),
+        "product_catalog": product_catalog.stats(),
+        "leaderboard": leaderboard.stats(),
+        "mongo_pool": {**pool_monitor.stats(), "config": mongo_pool_config()},
+        "jobs": job_queue.stats(),
+        "queries": query_monitor.stats(),
+        "logging": logging_stats(),
+        "read_routing": {"enabled": READ_ROUTING_ENABLED, "user_reads_from_secondaries": CAUSAL_READS_ENABLED, "max_staleness_seconds": MAX_STALENESS_SECONDS, **causal_tokens.stats()}
+    }
+
+def profiler_status():
+    return {
+        "profiler": profiler.stats(),
+        "spans": span_timings.stats(),
+        "event_loop": {
+            "last_lag_ms": round(loop_lag_monitor.last_lag * 1000, 3),
+            "max_lag_ms": round(loop_lag_monitor.max_lag * 1000, 3),
+            "stalls": loop_lag_monitor.stalls,
+            "stall_threshold_ms": LOOP_STALL_MS
+        }
+    }
+
+@api_router.get("/admin/profiler", dependencies=[Depends(require_admin)])
+async def get_profiler():
+    """Sampling profiler, span timings and event-loop lag of this process"""
+    return profiler_status()
+
+@api_router.post("/admin/profiler", dependencies=[Depends(require_admin)])
+async def control_profiler(request: ProfilerControlRequest):
+    """Start/stop the sampling profiler (optionally for `seconds`) and toggle spans.
+
+    Settings apply to the process that serves the request only.
+    """
+    if request.spans is not None:
+        span_timings.enabled = request.spans
+    if request.reset:
+        span_timings.reset()
+    if request.sampling is True:
+        profiler.start(hz=request.hz, seconds=request.seconds, reset=request.reset or not profiler.samples)
+    elif request.sampling is False:
+        profiler.stop()
+    return profiler_status()
+
+@api_router.get("/admin/profiler/profile", dependencies=[Depends(require_admin)])
+async def get_profile():
+    """Folded stacks collected so far, for flamegraph.pl or speedscope"""
+    return Response(
+        profiler.folded(),
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="healthloop-{os.getpid()}.folded"'}
     )
 
+@api_router.get("/points/export")
+async def export_points(
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Stream the user's complete points ledger, optionally limited to [start, end)"""
+    return points_ledger_response(current_user.id, export_format, start, end)
+
+@api_router.get("/admin/users/{user_id}/points/export", dependencies=[Depends(require_admin)])
+async def export_user_points(
+    user_id: str,
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+):
+    """Stream any user's points ledger for support and finance"""
+    return points_ledger_response(user_id, export_format, start, end)
+
 @api_router.get("/leaderboard")
-async def get_leaderboard():
-    """Get top users leaderboard"""
-    users = await db.users.find().sort("total_points_earned", -1).limit(10).to_list(10)
+async def get_leaderboard(
+    request: Request,
+    page: int = 1,
+    page_size: int = 10,
+    level: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Get top users leaderboard, optionally for a single level.
+
+    Pages past the first LEADERBOARD_PUBLIC_DEPTH ranks require a signed-in user,
+    so the full user list cannot be walked anonymously.
+    """
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 100)
+    offset = (page - 1) * page_size
+    limit = page_size
+    if offset + page_size > LEADERBOARD_PUBLIC_DEPTH:
+        if credentials is None:
+            if offset >= LEADERBOARD_PUBLIC_DEPTH:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Inicia sesión para ver el ranking completo",
+                    headers={"WWW-Authenticate": "Bearer"}
+                )
+            limit = LEADERBOARD_PUBLIC_DEPTH - offset
+        else:
+            await get_current_user(request, credentials)
+    await leaderboard.ensure_loaded()
     
-    leaderboard = []
-    for i, user_data in enumerate(users):
-        leaderboard.append(LeaderboardEntry(
-            name=user_data["name"],
-            points=user_data["total_points_earned"],
-            level=user_data["level"],
-            rank=i + 1
-        ))
+    return fast_response({
+        "leaderboard": leaderboard.page(offset, limit, level),
+        "page": page,
+        "page_size": page_size,
+        "total": leaderboard.size(level)
+    })
+
+@api_router.get("/leaderboard/me")
+async def get_my_leaderboard_rank(current_user: User = Depends(get_current_user)):
+    """Get the current user's overall and per-level rank"""
+    await leaderboard.ensure_loaded()
+    rank = leaderboard.rank(current_user.id)
+    if rank is None:
+        # Not seen by this process yet (e.g. a user created elsewhere since the last reconcile)
+        leaderboard.update(current_user.dict())
+        rank = leaderboard.rank(current_user.id)
     
-    return {"leaderboard": leaderboard}
+    return fast_response({
+        "entry": leaderboard.entry_for(current_user.id, rank),
+        "rank": rank,
+        "total": leaderboard.size(),
+        "level": current_user.level,
+        "level_rank": leaderboard.rank(current_user.id, current_user.level),
+        "level_total": leaderboard.size(current_user.level)
+    })
 
 @api_router.get("/badges")
-async def get_user_badges(current_user: User = Depends(get_current_user)):
-    """Get user's earned badges"""
-    badges = await db.badges.find({"user_id": current_user.id}).to_list(length=None)
-    return {"badges": [Badge(**parse_from_mongo(badge)) for badge in badges]}
+async def get_user_badges(response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Get user's earned badges, newest first"""
+    async with read_session(current_user.id) as session:
+        badges, next_cursor = await find_page(
+            read_collection("badges", "user"), {"user_id": current_user.id}, "earned_at", limit, cursor, projection_for(Badge), session
+        )
+    set_next_cursor_header(response, next_cursor)
+    return fast_response({
+        "badges": many_from_mongo(Badge, badges),
+        "next_cursor": next_cursor
+    }, response)
 
 # Consultation endpoints
 @api_router.post("/consultations/start")
@@ -1179,7 +4299,7 @@ async def start_consultation(request: ConsultationStartRequest, current_user: Us
         start_time=datetime.now(timezone.utc)
     )
     
-    consultation_dict = prepare_for_mongo(consultation.dict())
+    consultation_dict = to_mongo(consultation)
     await db.consultations.insert_one(consultation_dict)
     
     # Update professional active consultations
@@ -1207,7 +4327,7 @@ async def complete_consultation(request: ConsultationCompleteRequest, current_us
         {
             "$set": {
                 "status": ConsultationStatus.COMPLETED,
-                "end_time": datetime.now(timezone.utc).isoformat(),
+                "end_time": datetime.now(timezone.utc),
                 "notes": request.notes,
                 "recommendations": request.recommendations
             }
@@ -1215,7 +4335,7 @@ async def complete_consultation(request: ConsultationCompleteRequest, current_us
     )
     
     # Get consultation to award points to client
-    consultation = await db.consultations.find_one({"id": request.consultation_id})
+    consultation = await db.consultations.find_one({"id": request.consultation_id}, {"_id": 0, "client_id": 1})
     if consultation:
         # Award points to client
         await award_points(
@@ -1249,35 +4369,52 @@ async def get_active_consultations(current_user: User = Depends(get_current_user
     consultations = await db.consultations.find({
         "professional_id": current_user.id,
         "status": ConsultationStatus.IN_PROGRESS
-    }).to_list(length=None)
+    }, projection_for(ConsultationSession)).to_list(length=None)
     
-    return {
-        "active_consultations": [ConsultationSession(**parse_from_mongo(c)) for c in consultations]
-    }
+    return fast_response({
+        "active_consultations": many_from_mongo(ConsultationSession, consultations)
+    })
 
 # Dashboard endpoints
 @api_router.get("/dashboard/client", response_model=DashboardClientResponse)
-async def get_client_dashboard(current_user: User = Depends(get_current_user)):
+async def get_client_dashboard(response: Response, current_user: User = Depends(get_current_user)):
     if current_user.role != UserRole.CLIENT:
         raise HTTPException(status_code=403, detail="Access forbidden - clients only")
     
-    # Get recommended products (first 3)
-    products = await db.products.find().to_list(3)
-    recommended_products = [Product(**parse_from_mongo(product)) for product in products]
+    async def load_recommended_products():
+        # First 3 products
+        await product_catalog.ensure_loaded()
+        return product_catalog.list(limit=3)
     
-    # Get recent orders
-    orders = await db.orders.find({"user_id": current_user.id}).sort("created_at", -1).to_list(5)
-    recent_orders = [Order(**parse_from_mongo(order)) for order in orders]
+    # Each section reads on its own session: a session is not safe for concurrent use
+    async def load_recent_orders():
+        async with read_session(current_user.id) as session:
+            orders = await read_collection("orders", "user").find(
+                {"user_id": current_user.id}, projection_for(Order), session=session
+            ).sort("created_at", -1).to_list(5)
+        return many_from_mongo(Order, orders)
     
-    # Get recent points
-    recent_points = await db.points_transactions.find(
-        {"user_id": current_user.id}
-    ).sort("created_at", -1).to_list(5)
-    recent_points_list = [PointsTransaction(**parse_from_mongo(t)) for t in recent_points]
+    async def load_recent_points():
+        async with read_session(current_user.id) as session:
+            recent_points = await read_collection("points_transactions", "user").find(
+                {"user_id": current_user.id}, projection_for(PointsTransaction), session=session
+            ).sort("created_at", -1).to_list(5)
+        return many_from_mongo(PointsTransaction, recent_points)
     
-    # Get badges
-    badges = await db.badges.find({"user_id": current_user.id}).to_list(length=None)
-    badges_list = [Badge(**parse_from_mongo(badge)) for badge in badges]
+    async def load_badges():
+        async with read_session(current_user.id) as session:
+            badges = await read_collection("badges", "user").find(
+                {"user_id": current_user.id}, projection_for(Badge), session=session
+            ).to_list(length=None)
+        return many_from_mongo(Badge, badges)
+    
+    sections, timings, degraded = await load_sections({
+        "products": load_recommended_products(),
+        "orders": load_recent_orders(),
+        "points": load_recent_points(),
+        "badges": load_badges()
+    })
+    response.headers["Server-Timing"] = server_timing_header(timings)
     
     # Mock upcoming appointments
     upcoming_appointments = [
@@ -1291,7 +4428,7 @@ async def get_client_dashboard(current_user: User = Depends(get_current_user)):
         }
     ]
     
-    return DashboardClientResponse(
+    return fast_response(DashboardClientResponse(
         user=UserResponse(
             id=current_user.id,
             email=current_user.email,
@@ -1302,31 +4439,38 @@ async def get_client_dashboard(current_user: User = Depends(get_current_user)):
             level=current_user.level
         ),
         upcoming_appointments=upcoming_appointments,
-        recommended_products=recommended_products,
-        recent_orders=recent_orders,
-        recent_points=recent_points_list,
-        badges=badges_list
-    )
+        recommended_products=sections["products"] or [],
+        recent_orders=sections["orders"] or [],
+        recent_points=sections["points"] or [],
+        badges=sections["badges"] or [],
+        degraded_sections=degraded
+    ), response)
 
 @api_router.get("/dashboard/professional", response_model=DashboardProfessionalResponse)
-async def get_professional_dashboard(current_user: User = Depends(get_current_user)):
+async def get_professional_dashboard(response: Response, current_user: User = Depends(get_current_user)):
     if current_user.role != UserRole.PROFESSIONAL:
         raise HTTPException(status_code=403, detail="Access forbidden - professionals only")
     
-    # Get professional info
-    professional = await db.professionals.find_one({"user_id": current_user.id})
-    if not professional:
-        raise HTTPException(status_code=404, detail="Professional profile not found")
+    async def load_active_consultations():
+        active_consultations = await db.consultations.find({
+            "professional_id": current_user.id,
+            "status": ConsultationStatus.IN_PROGRESS
+        }, projection_for(ConsultationSession)).to_list(length=None)
+        return many_from_mongo(ConsultationSession, active_consultations)
     
-    professional_obj = Professional(**parse_from_mongo(professional))
+    # The professional profile is required; consultations degrade to an empty list
+    sections, timings, degraded = await load_sections({
+        "professional": db.professionals.find_one({"user_id": current_user.id}, projection_for(Professional)),
+        "consultations": load_active_consultations()
+    }, required=("professional",))
+    response.headers["Server-Timing"] = server_timing_header(timings)
     
-    # Get active consultations
-    active_consultations = await db.consultations.find({
-        "professional_id": current_user.id,
-        "status": ConsultationStatus.IN_PROGRESS
-    }).to_list(length=None)
+    professional = sections["professional"]
+    if not professional:
+        raise HTTPException(status_code=404, detail="Professional profile not found")
     
-    active_consultations_list = [ConsultationSession(**parse_from_mongo(c)) for c in active_consultations]
+    professional_obj = from_mongo(Professional, professional)
+    active_consultations_list = sections["consultations"] or []
     
     # Mock assigned clients with enhanced data
     assigned_clients = [
@@ -1372,7 +4516,7 @@ async def get_professional_dashboard(current_user: User = Depends(get_current_us
         }
     ]
     
-    return DashboardProfessionalResponse(
+    return fast_response(DashboardProfessionalResponse(
         user=UserResponse(
             id=current_user.id,
             email=current_user.email,
@@ -1391,82 +4535,69 @@ async def get_professional_dashboard(current_user: User = Depends(get_current_us
         upcoming_appointments=upcoming_appointments,
         commission_pending=professional_obj.commission_pending,
         total_earnings=professional_obj.total_earnings,
-        active_consultations=active_consultations_list
-    )
+        active_consultations=active_consultations_list,
+        degraded_sections=degraded
+    ), response)
 
 # Products endpoints
 @api_router.get("/products", response_model=List[Product])
 async def get_products(diet_type: Optional[str] = None):
-    query = {}
-    if diet_type:
-        query["diet_type"] = diet_type
-    
-    products = await db.products.find(query).to_list(length=None)
-    return [Product(**parse_from_mongo(product)) for product in products]
+    await product_catalog.ensure_loaded()
+    return Response(content=product_catalog.serialized_list(diet_type or None), media_type="application/json")
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id})
-    if not product:
+    await product_catalog.ensure_loaded()
+    product = product_catalog.serialized_product(product_id)
+    if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    return Product(**parse_from_mongo(product))
+    return Response(content=product, media_type="application/json")
 
 # Cart endpoints (now with user authentication)
 @api_router.post("/cart/add")
 async def add_to_cart(request: CartAddRequest, current_user: User = Depends(get_current_user)):
-    # Verify product exists
-    product = await db.products.find_one({"id": request.product_id})
-    if not product:
+    if not await merge_into_cart(current_user.id, [request.dict()]):
         raise HTTPException(status_code=404, detail="Product not found")
     
-    cart = await db.carts.find_one({"user_id": current_user.id})
-    if not cart:
-        cart = Cart(user_id=current_user.id, items=[]).dict()
-        cart = prepare_for_mongo(cart)
-        await db.carts.insert_one(cart)
-    
-    # Check if item already exists in cart
-    existing_item = None
-    for item in cart.get("items", []):
-        if item["product_id"] == request.product_id:
-            existing_item = item
-            break
-    
-    if existing_item:
-        await db.carts.update_one(
-            {"user_id": current_user.id, "items.product_id": request.product_id},
-            {"$inc": {"items.$.quantity": request.quantity}}
-        )
-    else:
-        new_item = CartItem(product_id=request.product_id, quantity=request.quantity).dict()
-        await db.carts.update_one(
-            {"user_id": current_user.id},
-            {"$push": {"items": new_item}}
-        )
-    
     return {"message": "Item added to cart successfully"}
 
+@api_router.put("/cart/items/{product_id}")
+async def update_cart_item(product_id: str, request: CartQuantityRequest, current_user: User = Depends(get_current_user)):
+    """Set a cart line's quantity; 0 removes it"""
+    if not await set_cart_quantity(current_user.id, product_id, request.quantity):
+        raise HTTPException(status_code=404, detail="Product not in cart")
+    return {"message": "Cart updated successfully"}
+
+@api_router.delete("/cart/items/{product_id}")
+async def remove_cart_item(product_id: str, current_user: User = Depends(get_current_user)):
+    if not await set_cart_quantity(current_user.id, product_id, 0):
+        raise HTTPException(status_code=404, detail="Product not in cart")
+    return {"message": "Item removed from cart successfully"}
+
 @api_router.get("/cart")
 async def get_cart(current_user: User = Depends(get_current_user)):
-    cart = await db.carts.find_one({"user_id": current_user.id})
+    cart = await db.carts.find_one({"user_id": current_user.id}, CART_PROJECTION)
     if not cart:
         return {"items": [], "total": 0}
     
-    enriched_items = []
-    total = 0
+    await product_catalog.ensure_loaded()
+    if cart.get("catalog_version") != product_catalog.price_version:
+        cart_snapshot_reads.inc("repriced")
+        cart = await reprice_cart(current_user.id, cart)
+    else:
+        cart_snapshot_reads.inc("fresh")
     
-    for item in cart.get("items", []):
-        product = await db.products.find_one({"id": item["product_id"]})
-        if product:
-            enriched_item = {
-                "product": Product(**parse_from_mongo(product)).dict(),
-                "quantity": item["quantity"],
-                "subtotal": product["price"] * item["quantity"]
-            }
-            enriched_items.append(enriched_item)
-            total += enriched_item["subtotal"]
+    enriched_items = [
+        {
+            "product": product,
+            "quantity": line["quantity"],
+            "subtotal": line["subtotal"]
+        }
+        for line in cart.get("items", [])
+        if (product := product_catalog.get(line["product_id"])) is not None
+    ]
     
-    return {"items": enriched_items, "total": round(total, 2)}
+    return fast_response({"items": enriched_items, "total": cart.get("total", 0)})
 
 @api_router.delete("/cart/clear")
 async def clear_cart(current_user: User = Depends(get_current_user)):
@@ -1475,52 +4606,34 @@ async def clear_cart(current_user: User = Depends(get_current_user)):
 
 # Orders endpoints
 @api_router.post("/orders", response_model=Order)
-async def create_order(current_user: User = Depends(get_current_user)):
-    cart = await db.carts.find_one({"user_id": current_user.id})
-    if not cart or not cart.get("items"):
-        raise HTTPException(status_code=400, detail="Cart is empty")
+async def create_order(
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    """Check out the cart. Retrying with the same Idempotency-Key returns the original order."""
+    record_id = None
+    if idempotency_key:
+        record_id = f"{current_user.id}:{idempotency_key}"
+        stored = await claim_idempotency_key(record_id, current_user.id)
+        if stored is not None:
+            return JSONResponse(stored["response"], status_code=stored["status_code"], headers={"Idempotent-Replayed": "true"})
     
-    # Calculate total
-    total = 0
-    for item in cart["items"]:
-        product = await db.products.find_one({"id": item["product_id"]})
-        if product:
-            total += product["price"] * item["quantity"]
-    
-    # Check if this is first purchase
-    existing_orders = await db.orders.count_documents({"user_id": current_user.id})
-    
-    # Create order
-    order = Order(
-        user_id=current_user.id,
-        items=cart["items"],
-        total_amount=round(total, 2),
-        status=OrderStatus.COMPLETED
-    ).dict()
-    
-    order = prepare_for_mongo(order)
-    await db.orders.insert_one(order)
-    
-    # Award points based on purchase
-    if existing_orders == 0:
-        # First purchase bonus
-        await award_points(current_user.id, PointAction.FIRST_PURCHASE, "¡Primera compra completada!")
-    
-    # Award points for amount spent
-    await award_points(current_user.id, PointAction.PURCHASE, f"Compra por ${total}", total)
-    
-    # Clear cart after order
-    await db.carts.delete_one({"user_id": current_user.id})
-    
-    print(f"📧 Email enviado a {current_user.email}")
-    print(f"🎉 Orden #{order['id']} completada exitosamente")
-    
-    return Order(**parse_from_mongo(order))
+    try:
+        return await checkout(current_user, record_id)
+    except Exception:
+        if record_id:
+            await release_idempotency_key(record_id)
+        raise
 
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: User = Depends(get_current_user)):
-    orders = await db.orders.find({"user_id": current_user.id}).sort("created_at", -1).to_list(length=None)
-    return [Order(**parse_from_mongo(order)) for order in orders]
+async def get_orders(response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Get user's orders, newest first; the next page's cursor is in the X-Next-Cursor header"""
+    async with read_session(current_user.id) as session:
+        orders, next_cursor = await find_page(
+            read_collection("orders", "user"), {"user_id": current_user.id}, "created_at", limit, cursor, projection_for(Order), session
+        )
+    set_next_cursor_header(response, next_cursor)
+    return fast_response(many_from_mongo(Order, orders), response)
 
 # Initialize database with demo data
 @api_router.post("/init-demo-data")
@@ -1531,15 +4644,17 @@ async def init_demo_data():
     await db.professionals.delete_many({})
     await db.points_transactions.delete_many({})
     await db.badges.delete_many({})
+    principal_cache.clear()
     
     # Insert demo products
     products_to_insert = []
     for product_data in demo_products:
         product = Product(**product_data)
-        product_dict = prepare_for_mongo(product.dict())
+        product_dict = to_mongo(product)
         products_to_insert.append(product_dict)
     
     await db.products.insert_many(products_to_insert)
+    await product_catalog.bump_version()
     
     # Create demo users with enhanced data
     demo_users = [
@@ -1587,7 +4702,7 @@ async def init_demo_data():
             level=user_data.get("level", "Beginner")
         )
         
-        user_dict = prepare_for_mongo(user.dict())
+        user_dict = to_mongo(user)
         await db.users.insert_one(user_dict)
         
         # Create professional profile if needed
@@ -1598,7 +4713,7 @@ async def init_demo_data():
                 specialization=user_data["specialization"],
                 bio=f"Especialista en {user_data['specialization']}"
             )
-            professional_dict = prepare_for_mongo(professional.dict())
+            professional_dict = to_mongo(professional)
             await db.professionals.insert_one(professional_dict)
         
         # Add demo points transactions
@@ -1616,7 +4731,7 @@ async def init_demo_data():
                     points=transaction_data["points"],
                     description=transaction_data["description"]
                 )
-                transaction_dict = prepare_for_mongo(transaction.dict())
+                transaction_dict = to_mongo(transaction)
                 await db.points_transactions.insert_one(transaction_dict)
         
         # Award badges based on level
@@ -1625,9 +4740,11 @@ async def init_demo_data():
                 user_id=user.id,
                 badge_type=BadgeType.ACTIVE if user.level == "Active" else BadgeType.PREMIUM if user.level == "Premium" else BadgeType.ELITE
             )
-            badge_dict = prepare_for_mongo(badge.dict())
+            badge_dict = to_mongo(badge)
             await db.badges.insert_one(badge_dict)
     
+    await leaderboard.reconcile(full=True)
+    
     return {
         "message": f"Initialized {len(demo_products)} products, {len(demo_users)} demo users with points system",
         "demo_accounts": [
@@ -1646,15 +4763,204 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "Idempotent-Replayed", "X-DB-Commands", "X-DB-Time-Ms", "X-DB-Slowest", "X-Request-ID"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(QueryStatsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security), x_admin_token: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint, for METRICS_TOKEN as a bearer token or the admin token"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not (METRICS_TOKEN and credentials and hmac.compare_digest(credentials.credentials, METRICS_TOKEN)):
+        await require_admin(x_admin_token)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Handlers never write on the event loop: records go onto a bounded queue (dropped
+# and counted when it is full) and a listener thread formats and writes them, as
+# one JSON object per line by default (LOG_FORMAT=text for the classic format).
+# Records are stamped with the request id (X-Request-ID, generated when absent).
+# Records carrying an `event` extra can be sampled per event with
+# LOG_SAMPLE_RATES, e.g. "points.awarded=0.1"; warnings and errors are always kept
+# and sampled records carry their `sample_rate`.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+def parse_sample_rates(spec: str) -> dict:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+LOG_SAMPLE_RATES = parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class EventSampler(logging.Filter):
+    """Keeps a fraction of the records for each sampled `event`"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        if random.random() < rate:
+            record.sample_rate = rate
+            return True
+        self.sampled_out += 1
+        return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking or erroring when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Runs in the caller: resolve everything that needs its context or live objects
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_handler = None
+_log_listener = None
+# What configure_logging replaced: root handlers and level, uvicorn's handlers
+_previous_logging = None
+
+def configure_logging():
+    """Route the root logger (and uvicorn's) through the queue; returns the handler.
+
+    Called from the lifespan and main() rather than at import, so importing the
+    module (tests, scripts) leaves logging alone; calling it again is a no-op.
+    """
+    global log_handler, _log_listener, _previous_logging
+    if log_handler is not None:
+        return log_handler
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream_handler = logging.StreamHandler(sys.stdout if LOG_FORMAT == "json" else sys.stderr)
+    stream_handler.setFormatter(JSONLogFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(EventSampler(LOG_SAMPLE_RATES))
+    
+    root = logging.getLogger()
+    _previous_logging = (root.handlers[:], root.level, {})
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        _previous_logging[2][name] = (uvicorn_logger.handlers, uvicorn_logger.propagate)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    log_handler, _log_listener = handler, listener
+    return handler
+
+def shutdown_logging():
+    """Flush queued records, stop the listener thread and restore the replaced handlers"""
+    global log_handler, _log_listener, _previous_logging
+    if log_handler is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(log_handler)
+    _log_listener.stop()
+    handlers, level, uvicorn_loggers = _previous_logging
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+    for name, (handlers, propagate) in uvicorn_loggers.items():
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = handlers
+        uvicorn_logger.propagate = propagate
+    log_handler = _log_listener = _previous_logging = None
+
 logger = logging.getLogger(__name__)
 
+def logging_stats():
+    if log_handler is None:
+        return {"format": LOG_FORMAT, "configured": False, "sample_rates": LOG_SAMPLE_RATES}
+    return {
+        "format": LOG_FORMAT,
+        "configured": True,
+        "queued": log_handler.queue.qsize(),
+        "dropped": log_handler.dropped,
+        "sampled_out": sum(f.sampled_out for f in log_handler.filters if isinstance(f, EventSampler)),
+        "sample_rates": LOG_SAMPLE_RATES,
+    }
+
+class RequestIdMiddleware:
+    """ASGI middleware binding X-Request-ID (taken from the client or generated) to logs and the response"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        if not request_id or len(request_id) > 128 or not request_id.isprintable():
+            request_id = uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+app.add_middleware(RequestIdMiddleware)
+
 # Video Gallery Routes
 @app.get("/api/videos")
 async def get_videos():
@@ -1726,56 +5032,62 @@ async def complete_video(video_id: str, current_user: User = Depends(get_current
         logger.error(f"Error completing video: {e}")
         raise HTTPException(status_code=500, detail="Error al completar video")
 
-# Duplicate cart endpoints removed - using api_router endpoints instead
+# Duplicate cart and order endpoints removed - using api_router endpoints instead
 
-@app.post("/api/orders")
-async def create_order(current_user: User = Depends(get_current_user)):
-    """Create order from cart and award points"""
+async def bootstrap_indexes():
+    if os.environ.get("ENSURE_INDEXES_ON_STARTUP", "true").lower() not in ("1", "true", "yes"):
+        return
     try:
-        # Get cart
-        cart = await db.carts.find_one({"user_id": current_user.id})
-        if not cart or not cart.get("items"):
-            raise HTTPException(status_code=400, detail="Carrito vacío")
-        
-        # Calculate total
-        total = 0.0
-        for item in cart["items"]:
-            product = await db.products.find_one({"id": item["product_id"]})
-            if product:
-                total += product["price"] * item["quantity"]
-        
-        # Create order
-        order = {
-            "id": str(uuid.uuid4()),
-            "user_id": current_user.id,
-            "items": cart["items"],
-            "total_amount": round(total, 2),
-            "status": "pending",
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        
-        await db.orders.insert_one(order)
-        
-        # Award points for purchase (10 points per dollar)
-        points_earned = int(total * 10)
-        await award_points(current_user.id, PointAction.PURCHASE, f"Compra por ${total:.2f}", points_earned)
-        
-        # Clear cart
-        await db.carts.update_one(
-            {"user_id": current_user.id},
-            {"$set": {"items": [], "updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
-        
-        return {
-            "message": "Pedido creado exitosamente",
-            "order_id": order["id"],
-            "total": total,
-            "points_earned": points_earned
-        }
+        log_index_report(await ensure_indexes())
+    except Exception as e:
+        logger.error(f"Error ensuring indexes: {e}")
+
+async def start_product_catalog():
+    try:
+        await product_catalog.start()
     except Exception as e:
-        logger.error(f"Error creating order: {e}")
-        raise HTTPException(status_code=500, detail="Error al crear pedido")
+        logger.error(f"Error loading product catalog: {e}")
+
+async def start_leaderboard():
+    try:
+        await leaderboard.start()
+    except Exception as e:
+        logger.error(f"Error loading leaderboard: {e}")
+
+def main(argv=None):
+    """Maintenance commands, e.g. `python server.py ensure-indexes --check` before a deploy"""
+    parser = argparse.ArgumentParser(prog="server.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    indexes = commands.add_parser("ensure-indexes", help="Create missing indexes and report drift")
+    mode = indexes.add_mutually_exclusive_group()
+    mode.add_argument("--check", action="store_true", help="Only report drift, do not create anything")
+    mode.add_argument("--fix", action="store_true", help="Also rebuild indexes that differ from their declaration")
+    grant = commands.add_parser("grant-monthly-points", help="Grant every user the monthly points of their membership")
+    grant.add_argument("--month", help="YYYY-MM to grant, defaults to the current UTC month; a month is only granted once")
+    migrate = commands.add_parser("migrate-datetimes", help="Convert ISO-string datetime fields to BSON dates")
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    migrate.add_argument("--restart", action="store_true", help="Ignore saved checkpoints and rescan every collection")
+    args = parser.parse_args(argv)
+    configure_logging()
+    connect_mongo()
+
+    try:
+        if args.command == "ensure-indexes":
+            report = asyncio.run(ensure_indexes(create_missing=not args.check, drop_mismatched=args.fix))
+            log_index_report(report)
+            return 1 if index_report_has_drift(report) else 0
+
+        if args.command == "migrate-datetimes":
+            asyncio.run(migrate_datetime_fields(batch_size=args.batch_size, restart=args.restart))
+            return 0
+
+        if args.command == "grant-monthly-points":
+            summary = asyncio.run(grant_monthly_membership_points(month=args.month))
+            logger.info(f"Monthly points granted: {summary}")
+            return 0
+    finally:
+        close_mongo()
+        shutdown_logging()
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
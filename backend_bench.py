@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+HealthLoop Nexus Backend Benchmark
+Replays the backend_test.py scenarios as weighted, concurrent virtual-user flows and
+reports p50/p95/p99 latency, throughput and MongoDB operations per request.
+
+    python backend_bench.py --users 20 --duration 30            # app in-process against MONGO_URL
+    python backend_bench.py --base-url http://localhost:8001    # a running server
+    python backend_bench.py --save-baseline                     # record bench_baseline.json
+    python backend_bench.py --baseline bench_baseline.json      # exit 1 on regressions
+
+In-process runs drive the FastAPI app through httpx's ASGI transport, with its lifespan,
+against a local mongod (MONGO_URL from backend/.env). They use their own database
+(--db-name, reset with init-demo-data on start) and count the Mongo commands each
+request issues. Against a running server Mongo operations are not available.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+from pymongo import monitoring
+
+from backend_payloads import ONBOARDING_STEPS, POINT_ACTIONS
+
+ROOT_DIR = Path(__file__).parent
+BACKEND_DIR = ROOT_DIR / "backend"
+DEFAULT_BASELINE = ROOT_DIR / "bench_baseline.json"
+
+PASSWORD = "bench-password"
+
+# Label of the request being timed; Motor copies context into its executor threads,
+# so the command listener can attribute each Mongo command to the request that sent it
+current_step = contextvars.ContextVar("bench_step", default=None)
+
+BACKGROUND = "(background)"
+
+
+class Recorder:
+    """Latency samples, errors and Mongo command counts per request label"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.mongo_ops = {}
+        self.flows = {}
+        self.track_mongo = False
+        self._lock = threading.Lock()
+
+    def record(self, label, elapsed_ms, ok):
+        self.samples.setdefault(label, []).append(elapsed_ms)
+        if not ok:
+            self.errors[label] = self.errors.get(label, 0) + 1
+
+    def count_mongo_op(self):
+        label = current_step.get() or BACKGROUND
+        with self._lock:
+            self.mongo_ops[label] = self.mongo_ops.get(label, 0) + 1
+
+
+class MongoOpCounter(monitoring.CommandListener):
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def started(self, event):
+        self.recorder.count_mongo_op()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class VirtualUser:
+    """One simulated client with its own account and bearer token"""
+
+    def __init__(self, client, recorder, index, run_id):
+        self.client = client
+        self.recorder = recorder
+        self.index = index
+        self.run_id = run_id
+        self.headers = {}
+        self.products = []
+        self._emails = 0
+
+    def new_email(self):
+        self._emails += 1
+        return f"bench-{self.run_id}-{self.index}-{self._emails}@example.com"
+
+    async def request(self, label, method, path, record=True, **kwargs):
+        kwargs.setdefault("headers", self.headers)
+        token = current_step.set(label if record else None)
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        finally:
+            current_step.reset(token)
+        if record:
+            self.recorder.record(label, (time.perf_counter() - start) * 1000, ok)
+        return response if ok else None
+
+    async def register(self, record=True):
+        email = self.new_email()
+        await self.request("POST /auth/register", "POST", "/api/auth/register", record=record, headers={}, json={
+            "email": email, "name": f"Bench User {self.index}", "password": PASSWORD, "role": "client"
+        })
+        response = await self.request("POST /auth/login", "POST", "/api/auth/login", record=record, headers={}, json={
+            "email": email, "password": PASSWORD
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"} if response else None
+
+    async def setup(self):
+        """Account used by every flow except signup; not measured"""
+        self.headers = await self.register(record=False) or {}
+        response = await self.request("GET /products", "GET", "/api/products", record=False)
+        self.products = [product["id"] for product in response.json()] if response else []
+
+
+async def signup_onboarding(vu, rng):
+    """Register, log in and complete onboarding steps 1-5"""
+    headers = await vu.register()
+    if headers is None:
+        return
+    for step, payload in enumerate(ONBOARDING_STEPS, start=1):
+        await vu.request(f"POST /onboarding/step{step}", "POST", f"/api/onboarding/step{step}", headers=headers, json=payload)
+
+
+async def shop_checkout(vu, rng):
+    """Browse products, add one to three of them to the cart and check out"""
+    await vu.request("GET /products", "GET", "/api/products")
+    if not vu.products:
+        return
+    for product_id in rng.sample(vu.products, k=min(len(vu.products), rng.randint(1, 3))):
+        await vu.request("POST /cart/add", "POST", "/api/cart/add", json={"product_id": product_id, "quantity": rng.randint(1, 2)})
+    await vu.request("GET /cart", "GET", "/api/cart")
+    await vu.request("POST /orders", "POST", "/api/orders", headers={**vu.headers, "Idempotency-Key": str(uuid.uuid4())})
+
+
+async def points_leaderboard(vu, rng):
+    """Earn points, then read the history and the leaderboard"""
+    await vu.request("POST /points/add", "POST", "/api/points/add", json=rng.choice(POINT_ACTIONS))
+    await vu.request("GET /points/history", "GET", "/api/points/history")
+    await vu.request("GET /leaderboard", "GET", "/api/leaderboard")
+
+
+FLOWS = {
+    "signup_onboarding": (signup_onboarding, 1),
+    "shop_checkout": (shop_checkout, 3),
+    "points_leaderboard": (points_leaderboard, 4),
+}
+
+
+def parse_weights(spec):
+    weights = {name: weight for name, (_, weight) in FLOWS.items()}
+    for item in filter(None, (spec or "").split(",")):
+        name, _, value = item.partition("=")
+        if name not in FLOWS:
+            raise SystemExit(f"Unknown flow {name!r}; choose from {', '.join(FLOWS)}")
+        weights[name] = float(value)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+async def run_virtual_user(vu, weights, deadline, iterations, seed):
+    rng = random.Random(seed)
+    await vu.setup()
+    names, flow_weights = list(weights), list(weights.values())
+    done = 0
+    while (iterations is None and time.perf_counter() < deadline) or (iterations is not None and done < iterations):
+        name = rng.choices(names, flow_weights)[0]
+        await FLOWS[name][0](vu, rng)
+        vu.recorder.flows[name] = vu.recorder.flows.get(name, 0) + 1
+        done += 1
+
+
+async def run_load(client, recorder, args, weights):
+    run_id = uuid.uuid4().hex[:8]
+    users = [VirtualUser(client, recorder, index, run_id) for index in range(args.users)]
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(
+        run_virtual_user(vu, weights, deadline, args.iterations, args.seed + vu.index) for vu in users
+    ))
+    return time.perf_counter() - start
+
+
+async def run_in_process(args, recorder, weights):
+    os.environ["DB_NAME"] = args.db_name
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    options = server.mongo_client_options()
+    options["event_listeners"].append(MongoOpCounter(recorder))
+    server.connect_mongo(AsyncIOMotorClient(server.mongo_url, **options))
+    recorder.track_mongo = True
+
+    async with server.lifespan(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout) as client:
+            (await client.post("/api/init-demo-data")).raise_for_status()
+            return await run_load(client, recorder, args, weights)
+
+
+async def run_over_http(args, recorder, weights):
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        if args.init_demo_data:
+            (await client.post("/api/init-demo-data")).raise_for_status()
+        return await run_load(client, recorder, args, weights)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(recorder, elapsed, args):
+    endpoints = {}
+    for label in sorted(recorder.samples):
+        values = sorted(recorder.samples[label])
+        endpoints[label] = {
+            "count": len(values),
+            "errors": recorder.errors.get(label, 0),
+            "mean_ms": round(sum(values) / len(values), 3),
+            "p50_ms": round(percentile(values, 0.50), 3),
+            "p95_ms": round(percentile(values, 0.95), 3),
+            "p99_ms": round(percentile(values, 0.99), 3),
+            "mongo_ops_per_request": round(recorder.mongo_ops.get(label, 0) / len(values), 2) if recorder.track_mongo else None,
+        }
+    requests = sum(entry["count"] for entry in endpoints.values())
+    errors = sum(entry["errors"] for entry in endpoints.values())
+    return {
+        "meta": {
+            "mode": "http" if args.base_url else "in-process",
+            "users": args.users,
+            "duration_s": round(elapsed, 2),
+            "weights": parse_weights(args.weights),
+            "commit": git_commit(),
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+        },
+        "totals": {
+            "requests": requests,
+            "errors": errors,
+            "error_rate": round(errors / requests, 4) if requests else 0.0,
+            "throughput_rps": round(requests / elapsed, 2) if elapsed else 0.0,
+            "flows": dict(recorder.flows),
+            "background_mongo_ops": recorder.mongo_ops.get(BACKGROUND, 0) if recorder.track_mongo else None,
+        },
+        "endpoints": endpoints,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_to_baseline(summary, baseline, threshold, min_delta_ms):
+    """Regressions of the current run against a saved one, as human-readable lines.
+
+    Latency regresses when p95 or p99 exceeds the baseline by more than `threshold`
+    (a fraction) plus `min_delta_ms`, which keeps sub-millisecond noise from failing
+    fast endpoints. Mongo ops per request regress on any increase above half an
+    operation; throughput regresses when it drops by more than `threshold`.
+    """
+    regressions = []
+    for label, before in baseline.get("endpoints", {}).items():
+        after = summary["endpoints"].get(label)
+        if after is None:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            allowed = before[metric] * (1 + threshold) + min_delta_ms
+            if after[metric] > allowed:
+                regressions.append(f"{label} {metric}: {before[metric]:.1f} -> {after[metric]:.1f} (allowed {allowed:.1f})")
+        ops_before, ops_after = before.get("mongo_ops_per_request"), after.get("mongo_ops_per_request")
+        if ops_before is not None and ops_after is not None and ops_after > ops_before + 0.5:
+            regressions.append(f"{label} mongo ops/request: {ops_before} -> {ops_after}")
+    throughput_before = baseline.get("totals", {}).get("throughput_rps")
+    throughput_after = summary["totals"]["throughput_rps"]
+    if throughput_before and throughput_after < throughput_before * (1 - threshold):
+        regressions.append(f"throughput: {throughput_before:.1f} -> {throughput_after:.1f} req/s")
+    return regressions
+
+
+def print_report(summary):
+    meta, totals = summary["meta"], summary["totals"]
+    print(f"\n📊 {meta['mode']} run, {meta['users']} users, {meta['duration_s']}s, commit {meta['commit'] or '?'}")
+    print(f"{'endpoint':<26}{'count':>7}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'mongo/req':>11}")
+    for label, entry in summary["endpoints"].items():
+        ops = entry["mongo_ops_per_request"]
+        print(f"{label:<26}{entry['count']:>7}{entry['errors']:>5}{entry['p50_ms']:>9.1f}{entry['p95_ms']:>9.1f}"
+              f"{entry['p99_ms']:>9.1f}{'-' if ops is None else ops:>11}")
+    print(f"\n🚀 {totals['requests']} requests, {totals['throughput_rps']} req/s, error rate {totals['error_rate']:.2%}")
+    print(f"   flows: {totals['flows']}")
+    if totals["background_mongo_ops"] is not None:
+        print(f"   background Mongo ops (jobs, caches): {totals['background_mongo_ops']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="backend_bench.py", description="Load-test the HealthLoop API")
+    parser.add_argument("--base-url", help="Benchmark a running server instead of the app in-process")
+    parser.add_argument("--init-demo-data", action="store_true", help="With --base-url: reset demo data first (wipes users)")
+    parser.add_argument("--db-name", default="healthloop_bench", help="Database for in-process runs (reset on start)")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run (ignored with --iterations)")
+    parser.add_argument("--iterations", type=int, help="Flows per virtual user, for repeatable runs")
+    parser.add_argument("--weights", help="Flow weights, e.g. shop_checkout=5,signup_onboarding=0")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--baseline", type=Path, help="Compare against this saved run")
+    parser.add_argument("--save-baseline", type=Path, nargs="?", const=DEFAULT_BASELINE, help="Save this run as a baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative regression (default 0.2 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="Latency slack added to every threshold")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--json", type=Path, help="Also write the summary to this file")
+    args = parser.parse_args(argv)
+
+    weights = parse_weights(args.weights)
+    recorder = Recorder()
+    runner = run_over_http if args.base_url else run_in_process
+    elapsed = asyncio.run(runner(args, recorder, weights))
+
+    summary = summarize(recorder, elapsed, args)
+    print_report(summary)
+    if args.json:
+        args.json.write_text(json.dumps(summary, indent=2))
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(summary, indent=2))
+        print(f"💾 Baseline saved to {args.save_baseline}")
+
+    failed = False
+    if summary["totals"]["error_rate"] > args.max_error_rate:
+        print(f"❌ Error rate {summary['totals']['error_rate']:.2%} above {args.max_error_rate:.2%}")
+        failed = True
+    if args.baseline:
+        regressions = compare_to_baseline(summary, json.loads(args.baseline.read_text()), args.threshold, args.min_delta_ms)
+        for regression in regressions:
+            print(f"❌ Regression: {regression}")
+        if not regressions:
+            print(f"✅ No regressions against {args.baseline}")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Request payloads shared by backend_test.py and backend_bench.py.
+
+Plain data only: importing this module has no side effects.
+"""
+
+ONBOARDING_STEPS = [
+    {
+        "first_name": "María",
+        "last_name": "González",
+        "date_of_birth": "1990-05-15",
+        "gender": "female",
+        "phone": "+52-555-123-4567",
+        "emergency_contact_name": "Carlos González",
+        "emergency_contact_phone": "+52-555-987-6543"
+    },
+    {
+        "weight_kg": 65.5,
+        "height_cm": 165.0,
+        "waist_circumference": 75.0,
+        "hip_circumference": 95.0,
+        "body_fat_percentage": 22.0,
+        "food_allergies": ["nuts", "shellfish"],
+        "food_intolerances": ["lactose"],
+        "medical_conditions": [],
+        "current_medications": [],
+        "is_pregnant": False,
+        "is_breastfeeding": False
+    },
+    {
+        "weight_loss": True,
+        "muscle_gain": False,
+        "maintenance": False,
+        "sports_performance": False,
+        "medical_management": False,
+        "target_weight": 60.0,
+        "timeline_months": 6,
+        "specific_goals": ["Lose 5kg", "Improve cardiovascular health"],
+        "activity_level": "moderate",
+        "sleep_hours_per_night": 7,
+        "water_glasses_per_day": 8
+    },
+    {
+        "heart_problems": False,
+        "chest_pain": False,
+        "loss_of_balance": False,
+        "bone_joint_problems": False,
+        "blood_pressure_medication": False,
+        "doctor_advised_no_exercise": False,
+        "meals_outside_home_per_week": 3,
+        "usual_meal_times": ["08:00", "13:00", "19:00"],
+        "smoking": False,
+        "alcohol_frequency": "occasionally"
+    },
+    {
+        "shipping_address": {
+            "street": "Av. Reforma 123",
+            "city": "Ciudad de México",
+            "state": "CDMX",
+            "postal_code": "06600",
+            "country": "México",
+            "delivery_instructions": "Tocar timbre del apartamento 4B"
+        },
+        "trainer_basic_data": True,
+        "trainer_anthropometric": True,
+        "trainer_fitness_evaluation": True,
+        "trainer_progress_tracking": True,
+        "nutritionist_basic_data": True,
+        "nutritionist_dietary_history": True,
+        "nutritionist_medical_conditions": False,
+        "nutritionist_progress_tracking": True,
+        "both_general_progress": True,
+        "both_integrated_data": True,
+        "data_analytics": True,
+        "marketing_communications": False
+    }
+]
+
+POINT_ACTIONS = [
+    {"action": "complete_profile", "description": "Profile completed during testing"},
+    {"action": "refer_friend", "description": "Referred a friend during testing"},
+    {"action": "purchase", "description": "Test purchase", "amount_spent": 25.50}
+]
@@ -11,6 +11,8 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+from backend_payloads import ONBOARDING_STEPS, POINT_ACTIONS
+
 # Load environment variables
 load_dotenv('/app/frontend/.env')
 
@@ -203,11 +205,7 @@ class HealthLoopTester:
         
         try:
             # Test different point actions
-            test_actions = [
-                {"action": "complete_profile", "description": "Profile completed during testing"},
-                {"action": "refer_friend", "description": "Referred a friend during testing"},
-                {"action": "purchase", "description": "Test purchase", "amount_spent": 25.50}
-            ]
+            test_actions = POINT_ACTIONS
             
             success_count = 0
             for action_data in test_actions:
@@ -430,15 +428,7 @@ class HealthLoopTester:
         try:
             # Step 1: Personal Data
             print("   📝 Step 1: Personal Data")
-            step1_data = {
-                "first_name": "María",
-                "last_name": "González",
-                "date_of_birth": "1990-05-15",
-                "gender": "female",
-                "phone": "+52-555-123-4567",
-                "emergency_contact_name": "Carlos González",
-                "emergency_contact_phone": "+52-555-987-6543"
-            }
+            step1_data = ONBOARDING_STEPS[0]
             
             step1_response = onboarding_session.post(f"{API_BASE}/onboarding/step1", json=step1_data)
             if step1_response.status_code != 200:
@@ -448,19 +438,7 @@ class HealthLoopTester:
             
             # Step 2: Health/Anthropometric Data
             print("   🏥 Step 2: Health/Anthropometric Data")
-            step2_data = {
-                "weight_kg": 65.5,
-                "height_cm": 165.0,
-                "waist_circumference": 75.0,
-                "hip_circumference": 95.0,
-                "body_fat_percentage": 22.0,
-                "food_allergies": ["nuts", "shellfish"],
-                "food_intolerances": ["lactose"],
-                "medical_conditions": [],
-                "current_medications": [],
-                "is_pregnant": False,
-                "is_breastfeeding": False
-            }
+            step2_data = ONBOARDING_STEPS[1]
             
             step2_response = onboarding_session.post(f"{API_BASE}/onboarding/step2", json=step2_data)
             if step2_response.status_code != 200:
@@ -470,19 +448,7 @@ class HealthLoopTester:
             
             # Step 3: Goals and Habits
             print("   🎯 Step 3: Goals and Habits")
-            step3_data = {
-                "weight_loss": True,
-                "muscle_gain": False,
-                "maintenance": False,
-                "sports_performance": False,
-                "medical_management": False,
-                "target_weight": 60.0,
-                "timeline_months": 6,
-                "specific_goals": ["Lose 5kg", "Improve cardiovascular health"],
-                "activity_level": "moderate",
-                "sleep_hours_per_night": 7,
-                "water_glasses_per_day": 8
-            }
+            step3_data = ONBOARDING_STEPS[2]
             
             step3_response = onboarding_session.post(f"{API_BASE}/onboarding/step3", json=step3_data)
             if step3_response.status_code != 200:
@@ -492,18 +458,7 @@ class HealthLoopTester:
             
             # Step 4: PAR-Q Evaluation
             print("   🏃 Step 4: PAR-Q Evaluation")
-            step4_data = {
-                "heart_problems": False,
-                "chest_pain": False,
-                "loss_of_balance": False,
-                "bone_joint_problems": False,
-                "blood_pressure_medication": False,
-                "doctor_advised_no_exercise": False,
-                "meals_outside_home_per_week": 3,
-                "usual_meal_times": ["08:00", "13:00", "19:00"],
-                "smoking": False,
-                "alcohol_frequency": "occasionally"
-            }
+            step4_data = ONBOARDING_STEPS[3]
             
             step4_response = onboarding_session.post(f"{API_BASE}/onboarding/step4", json=step4_data)
             if step4_response.status_code != 200:
@@ -513,28 +468,7 @@ class HealthLoopTester:
             
             # Step 5: Addresses and Consent
             print("   📍 Step 5: Addresses and Consent")
-            step5_data = {
-                "shipping_address": {
-                    "street": "Av. Reforma 123",
-                    "city": "Ciudad de México",
-                    "state": "CDMX",
-                    "postal_code": "06600",
-                    "country": "México",
-                    "delivery_instructions": "Tocar timbre del apartamento 4B"
-                },
-                "trainer_basic_data": True,
-                "trainer_anthropometric": True,
-                "trainer_fitness_evaluation": True,
-                "trainer_progress_tracking": True,
-                "nutritionist_basic_data": True,
-                "nutritionist_dietary_history": True,
-                "nutritionist_medical_conditions": False,
-                "nutritionist_progress_tracking": True,
-                "both_general_progress": True,
-                "both_integrated_data": True,
-                "data_analytics": True,
-                "marketing_communications": False
-            }
+            step5_data = ONBOARDING_STEPS[4]
             
             step5_response = onboarding_session.post(f"{API_BASE}/onboarding/step5", json=step5_data)
             if step5_response.status_code != 200:
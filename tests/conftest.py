@@ -0,0 +1,96 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+# server.py reads these at import time; nothing connects until a test asks for it
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "healthloop_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+# Tests marked `integration` need operators or features mongomock lacks ($round,
+# $mergeObjects, change streams, transactions) and run against the mongod at
+# MONGO_TEST_URL, e.g. MONGO_TEST_URL=mongodb://localhost:27017/?replicaSet=rs0
+MONGO_TEST_URL = os.environ.get("MONGO_TEST_URL")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "integration: needs a real mongod at MONGO_TEST_URL")
+
+
+def pytest_collection_modifyitems(config, items):
+    if MONGO_TEST_URL:
+        return
+    skip = pytest.mark.skip(reason="set MONGO_TEST_URL to run against a real mongod")
+    for item in items:
+        if "integration" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(request):
+    """A fresh database bound to server.db: mongomock, or a real mongod for integration tests"""
+    if "integration" in request.keywords:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        mongo_client = AsyncIOMotorClient(MONGO_TEST_URL)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        mongo_client = AsyncMongoMockClient()
+    previous = os.environ["DB_NAME"]
+    os.environ["DB_NAME"] = f"healthloop_test_{uuid.uuid4().hex[:8]}"
+    server.connect_mongo(mongo_client)
+    database = server.db
+    try:
+        await server.ensure_indexes()
+        yield database
+    finally:
+        if "integration" in request.keywords:
+            await mongo_client.drop_database(database.name)
+        server.close_mongo()
+        server.principal_cache.clear()
+        os.environ["DB_NAME"] = previous
+
+
+def make_product(product_id, price):
+    return server.Product(
+        id=product_id, name=product_id, description="", price=price, diet_type=server.DietType.KETO,
+        image_url="", calories=100, ingredients=[], allergens=[]
+    )
+
+
+@pytest.fixture
+async def catalog(db):
+    """Two products, p1 at 10.10 and p2 at 4.25, loaded into the process catalog"""
+    await db.products.insert_many([server.to_mongo(make_product("p1", 10.1)), server.to_mongo(make_product("p2", 4.25))])
+    await server.product_catalog.load()
+    return server.product_catalog
+
+
+@pytest.fixture
+async def user(db):
+    """A client user stored in the database"""
+    user = server.User(email="ana@example.com", name="Ana", role=server.UserRole.CLIENT, password_hash="x")
+    await db.users.insert_one(server.to_mongo(user))
+    return user
+
+
+@pytest.fixture
+def auth_headers(user):
+    return {"Authorization": f"Bearer {server.create_access_token({'sub': user.id})}"}
+
+
+@pytest.fixture
+async def api(db):
+    """httpx client calling the app in-process (without its lifespan)"""
+    import httpx
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as api_client:
+        yield api_client
@@ -0,0 +1,36 @@
+import pytest
+
+from backend_bench import compare_to_baseline, parse_weights, percentile
+
+
+def run(p95, p99, ops=3.0, throughput=100.0):
+    return {
+        "endpoints": {"GET /api/leaderboard": {"p95_ms": p95, "p99_ms": p99, "mongo_ops_per_request": ops}},
+        "totals": {"throughput_rps": throughput},
+    }
+
+
+def test_percentile_uses_the_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50 and percentile(values, 0.99) == 100
+    assert percentile([7.0], 0.95) == 7.0 and percentile([], 0.5) == 0.0
+
+
+def test_weights_override_defaults_and_drop_disabled_flows():
+    assert parse_weights("shop_checkout=0,points_leaderboard=2") == {"signup_onboarding": 1, "points_leaderboard": 2.0}
+    with pytest.raises(SystemExit):
+        parse_weights("browse=1")
+
+
+def test_regressions_allow_the_threshold_plus_the_slack():
+    baseline = run(p95=10.0, p99=20.0)
+    assert compare_to_baseline(run(p95=12.9, p99=24.9), baseline, threshold=0.2, min_delta_ms=1.0) == []
+
+    regressions = compare_to_baseline(run(p95=13.1, p99=20.0, ops=4.0, throughput=70.0), baseline, 0.2, 1.0)
+    assert [line.split(":")[0] for line in regressions] == [
+        "GET /api/leaderboard p95_ms", "GET /api/leaderboard mongo ops/request", "throughput"
+    ]
+
+
+def test_endpoints_missing_from_either_run_are_not_compared():
+    assert compare_to_baseline({"endpoints": {}, "totals": {"throughput_rps": 100.0}}, run(1.0, 1.0), 0.2, 1.0) == []
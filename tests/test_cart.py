@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+import server
+from server import merge_into_cart, price_cart_items, reprice_cart, set_cart_quantity
+
+
+async def set_price(db, catalog, product_id, price):
+    await db.products.update_one({"id": product_id}, {"$set": {"price": price}})
+    await catalog.bump_version()
+
+
+@pytest.mark.anyio
+async def test_price_cart_items_prices_lines_and_rounds_the_total(catalog):
+    items, total = price_cart_items([{"product_id": "p1", "quantity": 3}, {"product_id": "gone", "quantity": 2}])
+    assert items == [
+        {"product_id": "p1", "quantity": 3, "unit_price": 10.1, "subtotal": pytest.approx(30.3)},
+        {"product_id": "gone", "quantity": 2, "unit_price": None, "subtotal": 0},
+    ]
+    assert total == 30.3
+
+
+@pytest.mark.anyio
+async def test_reprice_cart_stores_current_prices_unless_the_cart_moved_on(db, catalog):
+    cart = {"user_id": "u1", "items": [{"product_id": "p1", "quantity": 2, "unit_price": 9.0, "subtotal": 18.0}],
+            "total": 18.0, "catalog_version": "old", "updated_at": 1}
+    await db.carts.insert_one(dict(cart))
+    
+    repriced = await reprice_cart("u1", cart)
+    assert repriced["total"] == 20.2 and repriced["catalog_version"] == catalog.price_version
+    assert (await db.carts.find_one({"user_id": "u1"}))["total"] == 20.2
+    
+    # A mutation in between (new updated_at) wins over the stale reprice
+    await db.carts.update_one({"user_id": "u1"}, {"$set": {"updated_at": 2, "total": 0}})
+    await reprice_cart("u1", cart)
+    assert (await db.carts.find_one({"user_id": "u1"}))["total"] == 0
+
+
+@pytest.mark.anyio
+async def test_merge_sums_quantities_and_prices_lines(db, catalog):
+    assert await merge_into_cart("u1", [{"product_id": "p1", "quantity": 1}, {"product_id": "p1", "quantity": 2}])
+    assert await merge_into_cart("u1", [{"product_id": "p1", "quantity": 1}, {"product_id": "p2", "quantity": 1}])
+    assert not await merge_into_cart("u1", [{"product_id": "gone", "quantity": 1}])
+    
+    cart = await db.carts.find_one({"user_id": "u1"})
+    assert [(item["product_id"], item["quantity"], item["subtotal"]) for item in cart["items"]] == [
+        ("p1", 4, pytest.approx(40.4)), ("p2", 1, 4.25)
+    ]
+    assert cart["total"] == 44.65
+    assert cart["catalog_version"] == catalog.price_version
+
+
+@pytest.mark.anyio
+async def test_concurrent_adds_lose_nothing(db, catalog):
+    await asyncio.gather(*(merge_into_cart("u1", [{"product_id": "p2", "quantity": 1}]) for _ in range(20)))
+    cart = await db.carts.find_one({"user_id": "u1"})
+    assert [(item["product_id"], item["quantity"]) for item in cart["items"]] == [("p2", 20)]
+    assert cart["total"] == 85.0
+
+
+@pytest.mark.anyio
+async def test_merge_after_a_price_change_drops_the_snapshot_version(db, catalog):
+    await merge_into_cart("u1", [{"product_id": "p1", "quantity": 1}])
+    await set_price(db, catalog, "p2", 5.0)
+    await merge_into_cart("u1", [{"product_id": "p2", "quantity": 1}])
+    # p1 kept its old unit price, so the next read has to reprice
+    assert (await db.carts.find_one({"user_id": "u1"}))["catalog_version"] is None
+
+
+@pytest.mark.anyio
+async def test_set_quantity_updates_totals_and_removes_at_zero(db, catalog):
+    await merge_into_cart("u1", [{"product_id": "p1", "quantity": 1}, {"product_id": "p2", "quantity": 1}])
+    
+    assert await set_cart_quantity("u1", "p2", 3)
+    cart = await db.carts.find_one({"user_id": "u1"})
+    assert cart["items"][1]["subtotal"] == 12.75 and cart["total"] == 22.85
+    
+    assert await set_cart_quantity("u1", "p1", 0)
+    cart = await db.carts.find_one({"user_id": "u1"})
+    assert [item["product_id"] for item in cart["items"]] == ["p2"] and cart["total"] == 12.75
+    
+    assert not await set_cart_quantity("u1", "p1", 1)
+    assert not await set_cart_quantity("nobody", "p1", 1)
+
+
+@pytest.mark.anyio
+async def test_get_cart_reprices_a_legacy_cart_once(db, catalog, api, user, auth_headers):
+    assert (await api.get("/api/cart", headers=auth_headers)).json() == {"items": [], "total": 0}
+
+    await db.carts.insert_one({"user_id": user.id, "items": [{"product_id": "p1", "quantity": 3}, {"product_id": "p2", "quantity": 2}]})
+    cart = (await api.get("/api/cart", headers=auth_headers)).json()
+    assert [(item["product"]["id"], item["quantity"], item["subtotal"]) for item in cart["items"]] == [("p1", 3, 30.3), ("p2", 2, 8.5)]
+    assert cart["total"] == 38.8
+    stored = await db.carts.find_one({"user_id": user.id})
+    assert stored["total"] == 38.8 and stored["catalog_version"] == catalog.price_version
+
+
+@pytest.mark.anyio
+async def test_login_merges_the_guest_cart(db, catalog, api, user, monkeypatch):
+    monkeypatch.setattr(server, "verify_password", lambda password, password_hash: True)
+    response = await api.post("/api/auth/login", json={
+        "email": user.email, "password": "x", "cart_items": [{"product_id": "p1", "quantity": 2}, {"product_id": "gone", "quantity": 1}]
+    })
+    assert response.status_code == 200, response.text
+    cart = await db.carts.find_one({"user_id": user.id})
+    assert [(item["product_id"], item["quantity"]) for item in cart["items"]] == [("p1", 2)] and cart["total"] == 20.2
@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+import pytest
+
+import server
+from server import ProductCatalog
+
+
+@pytest.mark.anyio
+async def test_snapshot_indexes_products_and_keeps_serialized_lists(catalog):
+    assert catalog.get("p1").price == 10.1 and catalog.get("gone") is None
+    assert [product.id for product in catalog.list()] == ["p1", "p2"]
+    assert [product.id for product in catalog.list(limit=1)] == ["p1"]
+    assert catalog.list("vegan") == [] and catalog.serialized_list("unknown") == b"[]"
+    assert [product["id"] for product in json.loads(catalog.serialized_list("keto"))] == ["p1", "p2"]
+    assert json.loads(catalog.serialized_product("p2"))["price"] == 4.25
+
+
+@pytest.mark.anyio
+async def test_bump_version_reloads_this_process(db, catalog):
+    version, refreshes = catalog.version, catalog.refreshes
+    await db.products.update_one({"id": "p1"}, {"$set": {"price": 11.0}})
+    assert catalog.get("p1").price == 10.1
+
+    await catalog.bump_version()
+    assert catalog.version == version + 1 and catalog.refreshes == refreshes + 1
+    assert catalog.get("p1").price == 11.0
+
+
+async def burst(count, pause=0.0):
+    for _ in range(count):
+        yield {"operationType": "update"}
+    await asyncio.sleep(pause)
+
+
+@pytest.mark.anyio
+async def test_a_burst_of_change_events_triggers_a_single_reload(db, catalog):
+    coalescing = ProductCatalog(poll_interval=30, coalesce_seconds=0.01)
+    await coalescing._reload_on(burst(50, pause=0.05))
+    assert coalescing.change_events == 50
+    assert coalescing.refreshes == 1 and coalescing.get("p2") is not None
+
+
+@pytest.mark.anyio
+async def test_start_falls_back_to_polling_without_change_streams(db, catalog):
+    polling = ProductCatalog(poll_interval=0.01)
+    await polling.start()
+    try:
+        await db.products.update_one({"id": "p2"}, {"$set": {"price": 5.0}})
+        await db.catalog_meta.update_one({"_id": ProductCatalog.META_ID}, {"$inc": {"version": 1}}, upsert=True)
+        await asyncio.sleep(0.05)
+        assert polling.refresh_mode == "polling"
+        assert polling.get("p2").price == 5.0 and polling.stats()["refreshes"] >= 2
+    finally:
+        await polling.stop()
+    assert server.product_catalog.get("p2").price == 4.25
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pydantic import ValidationError
+
+from server import (
+    CartItem, LeaderboardEntry, Order, OrderStatus, PointAction, PointsTransaction,
+    codec_for, from_mongo, projection_for, to_mongo,
+)
+
+
+def test_decode_parses_legacy_iso_strings_as_utc():
+    transaction = from_mongo(PointsTransaction, {
+        "id": "t1", "user_id": "u1", "action": "purchase", "points": 10, "description": "x",
+        "created_at": "2024-03-01T12:30:00",
+    })
+    assert transaction.created_at == datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc)
+
+
+def test_decode_keeps_offsets_and_native_dates():
+    aware = from_mongo(PointsTransaction, {"created_at": "2024-03-01T12:30:00+02:00"})
+    assert aware.created_at.utcoffset() == timedelta(hours=2)
+    native = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    assert from_mongo(PointsTransaction, {"created_at": native}).created_at is native
+
+
+def test_decode_converts_enums_and_rejects_unknown_values():
+    assert from_mongo(PointsTransaction, {"action": "purchase"}).action is PointAction.PURCHASE
+    assert from_mongo(Order, {"status": OrderStatus.PENDING}).status is OrderStatus.PENDING
+    with pytest.raises(ValidationError) as error:
+        from_mongo(Order, {"id": "o1", "user_id": "u1", "items": [], "total_amount": 0.0, "status": "archived"})
+    assert error.value.errors()[0]["loc"] == ("status",)
+
+
+def test_decode_builds_nested_models_and_drops_unknown_fields():
+    order = from_mongo(Order, {
+        "_id": "object-id", "id": "o1", "user_id": "u1", "total_amount": 20.0, "status": "completed",
+        "items": [{"product_id": "p1", "quantity": 2, "unit_price": 10.0, "subtotal": 20.0, "legacy": True}],
+    })
+    assert isinstance(order.items[0], CartItem) and order.items[0].quantity == 2
+    assert order.status is OrderStatus.COMPLETED
+    assert "_id" not in order.model_dump() and "legacy" not in order.items[0].model_dump()
+
+
+def test_codec_is_cached_per_model():
+    assert codec_for(Order) is codec_for(Order)
+    assert codec_for(Order).datetime_fields == ["created_at"]
+
+
+def test_encode_keeps_datetimes_native():
+    created_at = datetime(2024, 1, 2, tzinfo=timezone.utc)
+    document = to_mongo(PointsTransaction(user_id="u1", action=PointAction.PURCHASE, points=5, description="x", created_at=created_at))
+    assert document["created_at"] is created_at
+    assert from_mongo(PointsTransaction, document) == PointsTransaction(**document)
+
+
+def test_projection_covers_model_fields_without_id():
+    assert projection_for(CartItem) == {"_id": 0, "product_id": 1, "quantity": 1, "unit_price": 1, "subtotal": 1}
+
+
+def test_projection_applies_aliases_exclusions_and_extra_fields():
+    projection = projection_for(LeaderboardEntry, include=("id",), exclude=("rank",), aliases={"points": "total_points_earned"})
+    assert projection == {"_id": 0, "name": 1, "total_points_earned": 1, "level": 1, "id": 1}
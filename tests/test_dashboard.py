@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from server import load_sections, server_timing_header
+
+
+async def value(result, delay=0.0):
+    await asyncio.sleep(delay)
+    return result
+
+
+async def fail():
+    raise RuntimeError("section failed")
+
+
+@pytest.mark.anyio
+async def test_slow_and_failing_sections_degrade_to_none():
+    results, timings, degraded = await load_sections(
+        {"fast": value([1]), "slow": value([2], delay=1), "broken": fail()}, timeout=0.05
+    )
+
+    assert results == {"fast": [1], "slow": None, "broken": None}
+    assert degraded == ["slow", "broken"]
+    assert set(timings) == {"fast", "slow", "broken"} and timings["slow"] < 1000
+
+
+@pytest.mark.anyio
+async def test_a_failing_required_section_raises():
+    with pytest.raises(RuntimeError):
+        await load_sections({"profile": fail(), "extra": value(1)}, required=("profile",))
+
+
+def test_server_timing_lists_every_section():
+    assert server_timing_header({"orders": 1.234, "points": 20}) == "orders;dur=1.2, points;dur=20.0"
+
+
+@pytest.mark.anyio
+async def test_client_dashboard_reports_timings_and_degraded_sections(db, catalog, api, user, auth_headers):
+    response = await api.get("/api/dashboard/client", headers=auth_headers)
+    assert response.status_code == 200 and response.json()["degraded_sections"] == []
+    assert [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")] == ["products", "orders", "points", "badges"]
+    assert [product["id"] for product in response.json()["recommended_products"]] == ["p1", "p2"]
+
+    # A ledger row the model cannot read takes down only its own section
+    await db.points_transactions.insert_one({"user_id": user.id, "created_at": "yesterday"})
+    dashboard = (await api.get("/api/dashboard/client", headers=auth_headers)).json()
+    assert dashboard["degraded_sections"] == ["points"] and dashboard["recent_points"] == []
+    assert dashboard["user"]["id"] == user.id
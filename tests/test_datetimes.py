@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from server import migrate_datetime_fields
+
+
+@pytest.mark.anyio
+async def test_export_ranges_match_dates_and_legacy_strings(db):
+    await db.points_transactions.insert_many([
+        {"id": "native", "user_id": "u1", "created_at": datetime(2024, 1, 2, tzinfo=timezone.utc)},
+        {"id": "legacy", "user_id": "u1", "created_at": "2024-01-03T00:00:00+00:00"},
+        {"id": "late", "user_id": "u1", "created_at": "2024-02-01T00:00:00+00:00"},
+    ])
+    query = {"user_id": "u1", **server.datetime_range_query("created_at", datetime(2024, 1, 1), datetime(2024, 1, 10))}
+    assert {row["id"] for row in await db.points_transactions.find(query).to_list(None)} == {"native", "legacy"}
+    assert server.datetime_range_query("created_at") == {}
+
+
+@pytest.mark.anyio
+async def test_migration_converts_strings_once_and_checkpoints(db):
+    await db.points_transactions.insert_many([
+        {"id": f"t{n}", "created_at": f"2024-01-0{n + 1}T00:00:00"} for n in range(3)
+    ] + [{"id": "bad", "created_at": "yesterday"}, {"id": "done", "created_at": datetime(2024, 1, 1, tzinfo=timezone.utc)}])
+    await db.users.insert_one({"id": "u1", "created_at": "2024-01-01T00:00:00+00:00", "membership_start_date": "2024-01-01T00:00:00"})
+
+    summary = await migrate_datetime_fields(batch_size=2)
+
+    assert summary["points_transactions"] == {"migrated": 3, "skipped": 1}
+    assert summary["users"] == {"migrated": 1, "skipped": 0}
+    assert await db.points_transactions.count_documents({"created_at": {"$type": "string"}}) == 1
+    assert await db.users.count_documents({"membership_start_date": {"$type": "date"}}) == 1
+    checkpoint = await db.migrations.find_one({"_id": "bson-datetimes:points_transactions"})
+    assert checkpoint["completed"] and checkpoint["migrated"] == 3
+
+    await db.points_transactions.insert_one({"id": "t9", "created_at": "2024-01-09T00:00:00"})
+    assert (await migrate_datetime_fields())["points_transactions"]["migrated"] == 3
+    assert (await migrate_datetime_fields(restart=True))["points_transactions"] == {"migrated": 1, "skipped": 1}
@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from server import stream_points_ledger
+
+
+async def add_ledger(db, user_id, days):
+    await db.points_transactions.insert_many([
+        server.to_mongo(server.PointsTransaction(
+            id=f"t{day}", user_id=user_id, action=server.PointAction.PURCHASE, points=day, description=f"day {day}",
+            created_at=datetime(2024, 1, day, tzinfo=timezone.utc)
+        ))
+        for day in days
+    ])
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+@pytest.mark.anyio
+async def test_ndjson_export_is_written_in_batches_oldest_first(db, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_BATCH_SIZE", 2)
+    await add_ledger(db, "u1", [3, 1, 5, 2, 4])
+    await add_ledger(db, "u2", [6])
+
+    chunks = await collect(stream_points_ledger("u1"))
+
+    assert len(chunks) == 3
+    rows = [json.loads(line) for line in "".join(chunks).splitlines()]
+    assert [row["id"] for row in rows] == ["t1", "t2", "t3", "t4", "t5"]
+    assert set(rows[0]) == set(server.LEDGER_EXPORT_FIELDS)
+
+
+@pytest.mark.anyio
+async def test_csv_export_honours_the_half_open_range(db):
+    await add_ledger(db, "u1", [1, 2, 3, 4])
+
+    body = "".join(await collect(stream_points_ledger(
+        "u1", "csv", start=datetime(2024, 1, 2), end=datetime(2024, 1, 4, tzinfo=timezone.utc)
+    )))
+
+    rows = list(csv.DictReader(io.StringIO(body)))
+    assert [row["id"] for row in rows] == ["t2", "t3"] and rows[0]["points"] == "2"
+
+
+@pytest.mark.anyio
+async def test_export_endpoints_serve_the_caller_or_need_the_admin_token(db, api, user, auth_headers, monkeypatch):
+    await add_ledger(db, user.id, [1])
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", "admin")
+
+    own = await api.get("/api/points/export", params={"format": "csv"}, headers=auth_headers)
+    assert own.headers["content-type"].startswith("text/csv")
+    assert own.headers["content-disposition"] == f'attachment; filename="points-{user.id}.csv"'
+    assert (await api.get("/api/points/export", params={"format": "xml"}, headers=auth_headers)).status_code == 422
+
+    path = f"/api/admin/users/{user.id}/points/export"
+    assert (await api.get(path)).status_code == 403
+    assert json.loads((await api.get(path, headers={"X-Admin-Token": "admin"})).text)["id"] == "t1"
@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import server
+from server import FastJSONResponse, PointAction, PointsTransaction, fast_response
+
+
+def test_render_matches_the_stdlib_path_byte_for_byte():
+    transaction = PointsTransaction(
+        user_id="u1", action=PointAction.PURCHASE, points=5, description="café",
+        created_at=datetime(2024, 1, 2, 3, 4, 5, 600000, tzinfo=timezone.utc)
+    )
+    content = {"transactions": [transaction], "at": datetime(2024, 1, 2, tzinfo=timezone.utc), "ratio": 0.5, "next": None}
+    assert FastJSONResponse(content).body == JSONResponse(jsonable_encoder(content)).body
+
+
+def test_fast_response_only_wraps_with_the_flag_and_keeps_headers(monkeypatch):
+    content = {"items": []}
+    assert fast_response(content) is content
+
+    monkeypatch.setattr(server, "FAST_JSON_RESPONSES", True)
+    response = Response()
+    response.headers["X-Next-Cursor"] = "abc"
+    fast = fast_response(content, response)
+    assert isinstance(fast, FastJSONResponse) and fast.headers["x-next-cursor"] == "abc"
+    assert fast.body == b'{"items":[]}'
+
+
+@pytest.mark.anyio
+async def test_points_history_is_identical_with_the_flag_on(db, api, user, auth_headers, monkeypatch):
+    for action in (PointAction.VIDEO_COMPLETION, PointAction.REFER_FRIEND):
+        await server.award_points(user.id, action)
+
+    regular = await api.get("/api/points/history", params={"limit": 1}, headers=auth_headers)
+    monkeypatch.setattr(server, "FAST_JSON_RESPONSES", True)
+    fast = await api.get("/api/points/history", params={"limit": 1}, headers=auth_headers)
+
+    assert fast.content == regular.content
+    assert fast.headers["X-Next-Cursor"] == regular.headers["X-Next-Cursor"]
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import claim_idempotency_key
+
+
+@pytest.fixture(autouse=True)
+def standalone(monkeypatch):
+    # mongomock has no transactions; checkout takes the sequential path
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS", "off")
+
+
+async def fill_cart(db, user, quantity=2):
+    await db.carts.insert_one({"id": "c1", "user_id": user.id, "items": [{"product_id": "p1", "quantity": quantity}]})
+
+
+@pytest.mark.anyio
+async def test_claim_reserves_then_conflicts_then_replays(db):
+    assert await claim_idempotency_key("u1:k1", "u1") is None
+    with pytest.raises(HTTPException) as error:
+        await claim_idempotency_key("u1:k1", "u1")
+    assert error.value.status_code == 409
+    
+    await db.idempotency_keys.update_one({"_id": "u1:k1"}, {"$set": {"status": "completed", "status_code": 200, "response": {"id": "o1"}}})
+    stored = await claim_idempotency_key("u1:k1", "u1")
+    assert stored["response"] == {"id": "o1"}
+
+
+@pytest.mark.anyio
+async def test_claim_takes_over_dead_and_expired_keys(db):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await db.idempotency_keys.insert_many([
+        {"_id": "dead", "user_id": "u1", "status": "in_progress", "locked_until": past, "expires_at": past + timedelta(hours=1)},
+        {"_id": "expired", "user_id": "u1", "status": "completed", "status_code": 200, "response": {"id": "o1"}, "expires_at": past},
+    ])
+    assert await claim_idempotency_key("dead", "u1") is None
+    assert await claim_idempotency_key("expired", "u1") is None
+    record = await db.idempotency_keys.find_one({"_id": "expired"})
+    assert record["status"] == "in_progress" and "response" not in record
+
+
+@pytest.mark.anyio
+async def test_checkout_replays_the_first_order(db, catalog, user, auth_headers, api):
+    await fill_cart(db, user)
+    headers = {**auth_headers, "Idempotency-Key": "checkout-1"}
+    
+    first = await api.post("/api/orders", headers=headers)
+    assert first.status_code == 200, first.text
+    assert first.json()["total_amount"] == 20.2
+    
+    replay = await api.post("/api/orders", headers=headers)
+    assert replay.status_code == 200 and replay.headers["idempotent-replayed"] == "true"
+    assert replay.json()["id"] == first.json()["id"]
+    assert await db.orders.count_documents({"user_id": user.id}) == 1
+    assert await db.jobs.count_documents({"type": "order.points"}) == 1
+
+
+@pytest.mark.anyio
+async def test_failed_checkout_releases_the_key(db, catalog, user, auth_headers, api):
+    headers = {**auth_headers, "Idempotency-Key": "checkout-2"}
+    empty = await api.post("/api/orders", headers=headers)
+    assert empty.status_code == 400
+    assert await db.idempotency_keys.count_documents({}) == 0
+    
+    await fill_cart(db, user)
+    retried = await api.post("/api/orders", headers=headers)
+    assert retried.status_code == 200 and "idempotent-replayed" not in retried.headers
+
+
+@pytest.mark.anyio
+async def test_checkout_without_a_key_is_not_deduplicated(db, catalog, user, auth_headers, api):
+    await fill_cart(db, user)
+    assert (await api.post("/api/orders", headers=auth_headers)).status_code == 200
+    assert (await api.post("/api/orders", headers=auth_headers)).status_code == 400
+    assert await db.idempotency_keys.count_documents({}) == 0
@@ -0,0 +1,53 @@
+import pytest
+from pymongo import ASCENDING
+
+import server
+from server import ensure_indexes, index_report_has_drift
+
+
+@pytest.fixture
+def empty_db(db, monkeypatch):
+    """A database without any of the declared indexes yet"""
+    database = server.client[f"{db.name}_empty"]
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.mark.anyio
+async def test_check_only_reports_missing_indexes(empty_db):
+    report = await ensure_indexes(create_missing=False)
+    assert "id_unique" in report["users"]["missing"] and report["users"]["created"] == []
+    assert index_report_has_drift(report)
+    assert "id_unique" not in await empty_db.users.index_information()
+
+
+@pytest.mark.anyio
+async def test_bootstrap_creates_every_declared_index_once(empty_db):
+    report = await ensure_indexes()
+    assert set(report["users"]["created"]) == {spec.document["name"] for spec in server.INDEX_SPECS["users"]}
+    assert not index_report_has_drift(report)
+
+    again = await ensure_indexes()
+    assert all(not entry["missing"] and not entry["created"] for entry in again.values())
+
+
+@pytest.mark.anyio
+async def test_mismatched_indexes_are_only_rebuilt_with_drop_mismatched(empty_db):
+    await empty_db.users.create_index([("email", ASCENDING)], name="email_unique")
+    await empty_db.users.create_index([("legacy", ASCENDING)], name="legacy_1")
+
+    report = await ensure_indexes()
+    assert report["users"]["mismatched"] == ["email_unique"] and report["users"]["undeclared"] == ["legacy_1"]
+    assert not (await empty_db.users.index_information())["email_unique"].get("unique")
+
+    report = await ensure_indexes(drop_mismatched=True)
+    assert "email_unique" in report["users"]["created"]
+    indexes = await empty_db.users.index_information()
+    assert indexes["email_unique"]["unique"] and "legacy_1" in indexes
+
+
+def test_check_and_fix_cannot_be_combined(capsys):
+    with pytest.raises(SystemExit) as error:
+        server.main(["ensure-indexes", "--check", "--fix"])
+    assert error.value.code == 2
+    assert "not allowed with argument" in capsys.readouterr().err
@@ -0,0 +1,180 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from server import JobQueue
+
+
+@pytest.fixture
+def queue(db):
+    return JobQueue(workers=2, poll_seconds=0.05)
+
+
+async def stored(db, job_id):
+    return await db.jobs.find_one({"_id": job_id})
+
+
+def utc(value):
+    # mongomock hands datetimes back naive, a real mongod (with tz_aware off) too
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+@pytest.mark.anyio
+async def test_enqueue_is_idempotent_per_job_id(db, queue):
+    await queue.enqueue([JobQueue.job("noop", {}, "job-1")])
+    await queue.enqueue([JobQueue.job("noop", {}, "job-1"), JobQueue.job("noop", {}, "job-2")])
+    assert await db.jobs.count_documents({}) == 2
+
+
+@pytest.mark.anyio
+async def test_run_pending_runs_handlers_with_the_enqueuing_request_id(db, queue):
+    seen = []
+    
+    @queue.handler("record")
+    async def record(payload):
+        seen.append((payload["n"], server.request_id_var.get()))
+    
+    token = server.request_id_var.set("req-1")
+    try:
+        await queue.enqueue([JobQueue.job("record", {"n": 1}, "job-1")])
+    finally:
+        server.request_id_var.reset(token)
+    
+    assert await queue.run_pending() == 1
+    assert seen == [(1, "req-1")]
+    job = await stored(db, "job-1")
+    assert job["status"] == "done" and job["attempts"] == 1 and "locked_until" not in job
+    assert queue.stats()["processed"] == 1
+
+
+@pytest.mark.anyio
+async def test_failures_back_off_then_succeed(db, queue):
+    calls = []
+    
+    @queue.handler("flaky")
+    async def flaky(payload):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+    
+    await queue.enqueue([JobQueue.job("flaky", {}, "job-1")])
+    before = datetime.now(timezone.utc)
+    assert await queue.run_pending() == 1
+    job = await stored(db, "job-1")
+    assert job["status"] == "pending" and job["last_error"] == "boom"
+    assert utc(job["run_at"]) >= before + timedelta(seconds=server.JOB_RETRY_BASE_SECONDS) - timedelta(milliseconds=1)
+    
+    # Not due yet
+    assert await queue.run_pending() == 0
+    await db.jobs.update_one({"_id": "job-1"}, {"$set": {"run_at": before}})
+    assert await queue.run_pending() == 1
+    job = await stored(db, "job-1")
+    assert job["status"] == "done" and job["attempts"] == 2 and "last_error" not in job
+    assert queue.stats()["retried"] == 1
+
+
+@pytest.mark.anyio
+async def test_jobs_fail_for_good_after_max_attempts(db, queue, monkeypatch):
+    monkeypatch.setattr(server, "JOB_MAX_ATTEMPTS", 2)
+    await queue.enqueue([JobQueue.job("unknown", {}, "job-1")])
+    await queue.run_pending()
+    await db.jobs.update_one({"_id": "job-1"}, {"$set": {"run_at": datetime.now(timezone.utc)}})
+    await queue.run_pending()
+    job = await stored(db, "job-1")
+    assert job["status"] == "failed" and "No handler" in job["last_error"]
+    assert queue.stats()["failed"] == 1
+
+
+@pytest.mark.anyio
+async def test_expired_leases_are_reclaimed_and_live_ones_are_not(db, queue):
+    ran = []
+    
+    @queue.handler("record")
+    async def record(payload):
+        ran.append(payload["n"])
+    
+    now = datetime.now(timezone.utc)
+    await db.jobs.insert_many([
+        {**JobQueue.job("record", {"n": 1}, "dead"), "status": "running", "attempts": 1, "locked_until": now - timedelta(seconds=1)},
+        {**JobQueue.job("record", {"n": 2}, "live"), "status": "running", "attempts": 1, "locked_until": now + timedelta(minutes=1)},
+    ])
+    assert await queue.run_pending() == 1
+    assert ran == [1]
+    assert (await stored(db, "dead"))["attempts"] == 2
+    assert (await stored(db, "live"))["status"] == "running"
+
+
+@pytest.mark.anyio
+async def test_a_worker_that_outlived_its_lease_cannot_settle_the_job(db, queue):
+    @queue.handler("noop")
+    async def noop(payload):
+        pass
+    
+    await queue.enqueue([JobQueue.job("noop", {}, "job-1")])
+    stale = await queue._claim()
+    # The lease runs out and another worker takes the job over
+    await db.jobs.update_one({"_id": "job-1"}, {"$set": {"locked_until": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+    current = await queue._claim()
+    assert current["lease"] != stale["lease"]
+    
+    assert await queue.run_job(stale) is False
+    assert (await stored(db, "job-1"))["status"] == "running"
+    assert queue.stats()["lost_leases"] == 1 and queue.stats()["processed"] == 0
+    
+    # Nor can a stale run that failed reschedule it
+    del queue.handlers["noop"]
+    assert await queue.run_job(stale) is False
+    assert (await stored(db, "job-1"))["status"] == "running" and queue.stats()["retried"] == 0
+    
+    queue.handlers["noop"] = noop
+    assert await queue.run_job(current) is True
+    assert (await stored(db, "job-1"))["status"] == "done"
+
+
+@pytest.mark.anyio
+async def test_workers_pick_up_notified_jobs_and_stop_promptly(db, queue):
+    done = asyncio.Event()
+    
+    @queue.handler("signal")
+    async def signal(payload):
+        done.set()
+    
+    await queue.start()
+    try:
+        await queue.enqueue([JobQueue.job("signal", {}, "job-1")])
+        await asyncio.wait_for(done.wait(), 2)
+        # notify() right before stop() used to leave a worker waiting forever
+        queue.notify()
+    finally:
+        await asyncio.wait_for(queue.stop(), 2)
+    assert queue.stats()["workers"] == 0
+
+
+# mongomock returns no document from find_one_and_update when the updated user no
+# longer matches the pending_award_ids guard, so this runs against a real mongod
+@pytest.mark.integration
+@pytest.mark.anyio
+async def test_order_points_retry_finishes_a_half_applied_award(db, user, monkeypatch):
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS", "off")
+    payload = {"order_id": "o1", "user_id": user.id, "total": 20.0, "first_purchase": False}
+    collection_for = server.collection_for
+    
+    def users_down(name, op_class="default"):
+        if name == "users":
+            raise RuntimeError("worker died")
+        return collection_for(name, op_class)
+    
+    monkeypatch.setattr(server, "collection_for", users_down)
+    with pytest.raises(RuntimeError):
+        await server.award_order_points(payload)
+    monkeypatch.setattr(server, "collection_for", collection_for)
+    assert (await db.points_transactions.find_one({"id": "o1:purchase"}))["applied"] is False
+    
+    await server.award_order_points(payload)
+    await server.award_order_points(payload)
+    stored_user = await db.users.find_one({"id": user.id})
+    points = server.points_for_action(server.PointAction.PURCHASE, 20.0)
+    assert stored_user["points"] == user.points + points
+    assert (await db.points_transactions.find_one({"id": "o1:purchase"}))["applied"] is True
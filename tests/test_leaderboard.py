@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from server import Leaderboard
+
+
+@pytest.fixture
+def board(db, monkeypatch):
+    """A fresh process leaderboard, so rankings do not leak between tests"""
+    board = Leaderboard(reconcile_interval=60, full_reconcile_interval=3600)
+    monkeypatch.setattr(server, "leaderboard", board)
+    return board
+
+
+async def add_users(db, totals):
+    await db.users.insert_many([
+        {"id": user_id, "email": f"{user_id}@example.com", "name": user_id, "role": "client",
+         "points": total, "total_points_earned": total, "level": server.calculate_level(total)}
+        for user_id, total in totals.items()
+    ])
+
+
+@pytest.mark.anyio
+async def test_ranks_overall_and_per_level_and_follows_updates(db, board):
+    await add_users(db, {"a": 100, "b": 600, "c": 700, "d": 50})
+    await board.reconcile(full=True)
+
+    assert [entry.name for entry in board.page(0, 10)] == ["c", "b", "a", "d"]
+    assert board.rank("a") == 3 and board.rank("a", "Beginner") == 1 and board.rank("a", "Active") is None
+    assert [entry.rank for entry in board.page(1, 2)] == [2, 3]
+
+    board.update({"id": "d", "name": "d", "total_points_earned": 800, "level": "Active"})
+    assert board.rank("d") == 1 and board.size("Active") == 3 and board.size("Beginner") == 1
+
+
+@pytest.mark.anyio
+async def test_reconcile_reads_only_users_whose_ranked_at_moved(db, board):
+    await add_users(db, {"a": 100, "b": 200})
+    await board.reconcile(full=True)
+
+    # Another process awards a, and a signup lands without ranked_at
+    await db.users.update_one({"id": "a"}, {"$set": {"total_points_earned": 900, "level": "Active", "ranked_at": datetime.now(timezone.utc)}})
+    await add_users(db, {"c": 300})
+    await board.reconcile()
+    assert board.rank("a") == 1 and board.rank("c") is None
+
+    await board.reconcile(full=True)
+    assert board.rank("c") == 2 and board.stats()["full_reconciles"] == 2
+
+
+@pytest.mark.anyio
+async def test_award_points_moves_the_user_up(db, board):
+    await add_users(db, {"a": 100, "b": 200})
+    await board.reconcile(full=True)
+
+    await server.award_points("a", server.PointAction.REFER_FRIEND)
+    assert board.rank("a") == 1
+    assert (await db.users.find_one({"id": "a"}))["ranked_at"] is not None
+
+
+@pytest.mark.anyio
+async def test_anonymous_clients_only_page_through_the_public_depth(db, board, api, auth_headers, monkeypatch):
+    monkeypatch.setattr(server, "LEADERBOARD_PUBLIC_DEPTH", 3)
+    await add_users(db, {f"u{n}": 200 + n * 10 for n in range(6)})
+
+    first = (await api.get("/api/leaderboard", params={"page_size": 2})).json()
+    assert [entry["name"] for entry in first["leaderboard"]] == ["u5", "u4"] and first["total"] == 7
+    assert len((await api.get("/api/leaderboard", params={"page": 2, "page_size": 2})).json()["leaderboard"]) == 1
+    assert (await api.get("/api/leaderboard", params={"page": 3, "page_size": 2})).status_code == 401
+
+    deep = await api.get("/api/leaderboard", params={"page": 3, "page_size": 2}, headers=auth_headers)
+    assert [entry["rank"] for entry in deep.json()["leaderboard"]] == [5, 6]
+
+    me = (await api.get("/api/leaderboard/me", headers=auth_headers)).json()
+    assert me["rank"] == 7 and me["level_rank"] == 7 and me["level_total"] == 7
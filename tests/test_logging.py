@@ -0,0 +1,67 @@
+import json
+import logging
+import queue
+
+import pytest
+
+import server
+from server import EventSampler, JSONLogFormatter, NonBlockingQueueHandler, parse_sample_rates
+
+
+def record(level=logging.INFO, **extra):
+    entry = logging.LogRecord("server", level, __file__, 1, "Awarded %s points", (10,), None)
+    entry.__dict__.update(extra)
+    return entry
+
+
+def test_json_lines_carry_the_request_id_and_extras():
+    line = json.loads(JSONLogFormatter().format(record(request_id="req-1", event="points.awarded", points=10)))
+    assert line["message"] == "Awarded 10 points" and line["level"] == "INFO"
+    assert line["request_id"] == "req-1" and line["event"] == "points.awarded" and line["points"] == 10
+
+
+def test_sample_rates_are_parsed_and_clamped():
+    assert parse_sample_rates("points.awarded=0.1, badge.awarded=3,") == {"points.awarded": 0.1, "badge.awarded": 1.0}
+
+
+def test_sampling_never_drops_warnings_or_unsampled_events():
+    sampler = EventSampler({"points.awarded": 0.0})
+    assert not sampler.filter(record(event="points.awarded"))
+    assert sampler.filter(record(logging.WARNING, event="points.awarded"))
+    assert sampler.filter(record(event="order.email_sent")) and sampler.filter(record())
+    assert sampler.sampled_out == 1
+
+
+def test_a_full_queue_drops_records_instead_of_blocking():
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+    token = server.request_id_var.set("req-1")
+    try:
+        handler.handle(record())
+        handler.handle(record())
+    finally:
+        server.request_id_var.reset(token)
+    queued = handler.queue.get_nowait()
+    assert queued.request_id == "req-1" and queued.msg == "Awarded 10 points" and queued.args is None
+    assert handler.dropped == 1
+
+
+def test_configure_logging_is_idempotent_and_shutdown_restores_handlers():
+    root = logging.getLogger()
+    before = root.handlers[:]
+    assert server.logging_stats()["configured"] is False
+    handler = server.configure_logging()
+    try:
+        assert server.configure_logging() is handler
+        assert root.handlers == [handler] and server.logging_stats()["configured"] is True
+    finally:
+        server.shutdown_logging()
+    assert root.handlers == before and server.logging_stats()["configured"] is False
+
+
+@pytest.mark.anyio
+async def test_request_ids_are_echoed_or_generated(api):
+    response = await api.get("/api/videos", headers={"X-Request-ID": "client-42"})
+    assert response.headers["x-request-id"] == "client-42"
+
+    generated = (await api.get("/api/videos", headers={"X-Request-ID": "x" * 200})).headers["x-request-id"]
+    assert len(generated) == 32 and generated != "x" * 200
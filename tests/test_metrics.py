@@ -0,0 +1,103 @@
+import re
+
+import pytest
+
+import server
+from server import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_counter_renders_help_type_and_sorted_series():
+    counter = Counter("jobs_total", "Jobs run", ("type", "status"))
+    counter.inc("order.points", "done")
+    counter.inc("order.email", "done", amount=2)
+    counter.inc("order.points", "done")
+    assert counter.render() == [
+        "# HELP jobs_total Jobs run",
+        "# TYPE jobs_total counter",
+        'jobs_total{type="order.email",status="done"} 2',
+        'jobs_total{type="order.points",status="done"} 2',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("c", "c", ("route",))
+    counter.inc('a"b\\c\nd')
+    assert counter.render()[-1] == 'c{route="a\\"b\\\\c\\nd"} 1'
+
+
+def test_gauges_render_collected_values():
+    scalar = Gauge("pool_size", "Pool size", collect=lambda: 3)
+    labelled = Gauge("cache_entries", "Entries", ("cache",), collect=lambda: {("principal",): 5, ("catalog",): 1.5})
+    assert scalar.render()[-1] == "pool_size 3"
+    assert labelled.render()[2:] == ['cache_entries{cache="catalog"} 1.5', 'cache_entries{cache="principal"} 5']
+
+
+def test_histogram_buckets_are_cumulative_and_upper_bound_inclusive():
+    histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, "/api/cart")
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/api/cart",le="0.1"} 2',
+        'latency_seconds_bucket{route="/api/cart",le="1.0"} 3',
+        'latency_seconds_bucket{route="/api/cart",le="+Inf"} 4',
+        'latency_seconds_sum{route="/api/cart"} 3.65',
+        'latency_seconds_count{route="/api/cart"} 4',
+    ]
+
+
+def test_unobserved_histogram_has_only_metadata():
+    assert Histogram("h", "H").render() == ["# HELP h H", "# TYPE h histogram"]
+
+
+def test_registry_renders_metrics_in_registration_order():
+    registry = MetricsRegistry()
+    registry.counter("b_total", "B").inc()
+    registry.gauge("a", "A").set(1)
+    text = registry.render()
+    assert text.endswith("\n")
+    assert text.index("# HELP b_total") < text.index("# HELP a")
+
+
+# One sample line of the Prometheus text format 0.0.4
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? (-?[0-9.e+-]+|\+Inf|-Inf|NaN)$')
+
+
+@pytest.mark.anyio
+async def test_metrics_endpoint_labels_routes_by_template(db, catalog, api, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_TOKEN", "scrape")
+    assert (await api.get("/api/products/p1")).status_code == 200
+    assert (await api.get("/api/products/p2")).status_code == 200
+    
+    response = await api.get("/metrics", headers={"Authorization": "Bearer scrape"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    for line in lines:
+        assert line.startswith("# HELP ") or line.startswith("# TYPE ") or SAMPLE.match(line), line
+    
+    route = 'route="/api/products/{product_id}"'
+    assert any(line.startswith("healthloop_http_requests_total{") and route in line and 'status="200"' in line for line in lines)
+    assert not any("/api/products/p1" in line for line in lines)
+
+
+@pytest.mark.anyio
+async def test_metrics_endpoint_can_be_disabled(api, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_ENABLED", False)
+    assert (await api.get("/metrics")).status_code == 404
+
+
+@pytest.mark.anyio
+async def test_metrics_need_the_metrics_or_admin_token(api, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_TOKEN", "scrape")
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", "admin")
+    assert (await api.get("/metrics")).status_code == 403
+    assert (await api.get("/metrics", headers={"Authorization": "Bearer wrong"})).status_code == 403
+    assert (await api.get("/metrics", headers={"Authorization": "Bearer scrape"})).status_code == 200
+    assert (await api.get("/metrics", headers={"X-Admin-Token": "admin"})).status_code == 200
+    
+    # With neither token configured the endpoint is closed
+    monkeypatch.setattr(server, "METRICS_TOKEN", None)
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", None)
+    assert (await api.get("/metrics", headers={"Authorization": "Bearer scrape"})).status_code == 403
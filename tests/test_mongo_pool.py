@@ -0,0 +1,60 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+import server
+from server import PoolMonitor, collection_for, mongo_client_options
+
+
+def test_client_options_come_from_the_environment(monkeypatch, caplog):
+    monkeypatch.setenv("MONGO_MAX_POOL_SIZE", "50")
+    monkeypatch.setenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "250")
+    monkeypatch.setenv("MONGO_COMPRESSORS", "zlib,nosuch")
+    monkeypatch.setenv("MONGO_ZLIB_COMPRESSION_LEVEL", "6")
+    monkeypatch.setenv("MONGO_READ_PREFERENCE", "secondaryPreferred")
+
+    with caplog.at_level(logging.WARNING):
+        options = mongo_client_options()
+
+    assert options["tz_aware"] and options["maxPoolSize"] == 50 and options["waitQueueTimeoutMS"] == 250
+    assert "minPoolSize" not in options
+    assert options["compressors"] == "zlib" and options["zlibCompressionLevel"] == 6
+    assert options["readPreference"] == "secondaryPreferred"
+    assert "nosuch requested" in caplog.text
+
+
+@pytest.mark.anyio
+async def test_collections_carry_their_class_write_concern(db):
+    ledger = collection_for("points_transactions", "critical")
+    assert collection_for("points_transactions", "critical") is ledger
+    assert ledger.write_concern == server.WRITE_CONCERNS["critical"]
+    assert server.WRITE_CONCERNS["critical"].document == {"w": "majority", "j": True}
+    assert collection_for("points_transactions").write_concern == server.WRITE_CONCERNS["default"]
+
+
+def test_pool_monitor_counts_checkouts_failures_and_clears():
+    monitor = PoolMonitor()
+    for _ in range(3):
+        monitor.connection_check_out_started(None)
+        monitor.connection_checked_out(None)
+    monitor.connection_checked_in(None)
+    monitor.connection_check_out_started(None)
+    monitor.connection_check_out_failed(SimpleNamespace(reason="timeout"))
+    monitor.connection_created(None)
+    monitor.pool_cleared(None)
+
+    stats = monitor.stats()
+    assert stats["checkouts"] == 3 and stats["checked_out"] == 2
+    assert stats["checkout_failures"] == {"timeout": 1}
+    assert stats["open_connections"] == 1 and stats["pool_clears"] == 1
+    assert stats["max_wait_ms"] >= stats["p95_wait_ms"] >= 0
+
+
+@pytest.mark.anyio
+async def test_lifespan_keeps_a_connected_client_and_closes_it(db):
+    mongo_client = server.client
+    async with server.lifespan(server.app):
+        assert server.client is mongo_client
+        assert server.product_catalog.loaded and server.leaderboard.loaded_at is not None
+    assert server.client is None and server.db is None
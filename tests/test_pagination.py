@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import decode_cursor, encode_cursor, find_page
+
+
+@pytest.mark.parametrize("sort_value", [
+    datetime(2024, 5, 6, 7, 8, 9, 123000, tzinfo=timezone.utc),
+    42,
+    "2024-05-06",
+])
+def test_cursor_round_trips(sort_value):
+    cursor = encode_cursor(sort_value, "doc-1")
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (sort_value, "doc-1")
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "", encode_cursor(1, "x")[:-3]])
+def test_invalid_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_find_page_walks_every_document_once(db):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    # Two documents share a timestamp so the id breaks the tie; one is a legacy ISO string
+    documents = [{"id": f"t{i:02d}", "user_id": "u1", "created_at": start + timedelta(minutes=i // 2)} for i in range(7)]
+    documents.append({"id": "legacy", "user_id": "u1", "created_at": "2023-12-31T00:00:00"})
+    await db.points_transactions.insert_many(documents)
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = await find_page(db.points_transactions, {"user_id": "u1"}, "created_at", 3, cursor, {"_id": 0, "id": 1, "created_at": 1})
+        seen.extend(document["id"] for document in page)
+        if cursor is None:
+            break
+    assert seen == ["t06", "t05", "t04", "t03", "t02", "t01", "t00", "legacy"]
+
+
+@pytest.mark.anyio
+async def test_points_history_returns_the_next_cursor_in_body_and_header(db, api, user, auth_headers):
+    for _ in range(3):
+        await server.award_points(user.id, server.PointAction.VIDEO_COMPLETION)
+
+    first = await api.get("/api/points/history", params={"limit": 2}, headers=auth_headers)
+    assert len(first.json()["transactions"]) == 2
+    assert first.headers["X-Next-Cursor"] == first.json()["next_cursor"]
+
+    rest = await api.get("/api/points/history", params={"limit": 2, "cursor": first.json()["next_cursor"]}, headers=auth_headers)
+    assert len(rest.json()["transactions"]) == 1 and rest.json()["next_cursor"] is None
+    assert "X-Next-Cursor" not in rest.headers
+    assert (await api.get("/api/points/history", params={"cursor": "junk"}, headers=auth_headers)).status_code == 400
@@ -0,0 +1,197 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from server import PointAction, award_points, award_points_bulk, grant_monthly_membership_points
+
+
+async def add_user(db, user_id, points=0, membership_level="basic"):
+    await db.users.insert_one({
+        "id": user_id, "email": f"{user_id}@example.com", "name": user_id, "role": "client",
+        "points": points, "total_points_earned": points, "level": "Beginner", "membership_level": membership_level
+    })
+
+
+async def balance(db, user_id):
+    return (await db.users.find_one({"id": user_id}))["points"]
+
+
+async def left_unapplied(db, transaction_id, user_id, points, credited, claimed_at=None):
+    """A ledger row a crashed run wrote, with the balance updated or not"""
+    await db.points_transactions.insert_one({
+        "id": transaction_id, "user_id": user_id, "action": "monthly_membership", "points": points, "description": "x",
+        "created_at": datetime.now(timezone.utc), "applied": False, "claim": "dead",
+        "claimed_at": claimed_at or datetime.now(timezone.utc) - timedelta(seconds=server.AWARD_CLAIM_SECONDS + 1)
+    })
+    if credited:
+        await db.users.update_one({"id": user_id}, {"$inc": {"points": points}, "$push": {"pending_award_ids": transaction_id}})
+
+
+async def settled_badges():
+    await asyncio.gather(*server._badge_tasks)
+
+
+@pytest.mark.anyio
+async def test_award_records_the_ledger_row_and_credits_the_balance(db):
+    await add_user(db, "u1")
+
+    points = await award_points("u1", PointAction.VIDEO_COMPLETION)
+
+    assert points == server.POINT_VALUES[PointAction.VIDEO_COMPLETION]
+    assert await balance(db, "u1") == points
+    row = await db.points_transactions.find_one({"user_id": "u1"})
+    assert row["points"] == points and row["action"] == "video_completion"
+    user = await db.users.find_one({"id": "u1"})
+    assert user["level"] == "Beginner" and "badge_pending" not in user
+
+
+@pytest.mark.anyio
+async def test_crossing_a_level_settles_its_badge_off_the_award_path(db):
+    await add_user(db, "u1", points=450)
+
+    await award_points("u1", PointAction.SCHEDULE_CONSULTATION)
+    await settled_badges()
+
+    user = await db.users.find_one({"id": "u1"})
+    assert user["level"] == "Active" and "badge_pending" not in user
+    assert [badge["badge_type"] for badge in await db.badges.find({"user_id": "u1"}).to_list(None)] == ["active"]
+
+
+@pytest.mark.anyio
+async def test_unknown_users_keep_the_ledger_row_but_get_nothing(db):
+    assert await award_points("ghost", PointAction.REGISTRATION) == 0
+    assert await db.points_transactions.count_documents({"user_id": "ghost"}) == 1
+
+
+@pytest.mark.anyio
+async def test_an_award_id_already_in_the_ledger_is_not_paid_again(db):
+    await add_user(db, "u1")
+    await left_unapplied(db, "o1:purchase", "u1", 20, credited=True, claimed_at=datetime.now(timezone.utc))
+
+    # Still held by a live attempt: the job has to come back later
+    with pytest.raises(RuntimeError):
+        await award_points("u1", PointAction.PURCHASE, amount_spent=20.0, transaction_id="o1:purchase")
+
+    await db.points_transactions.update_one({"id": "o1:purchase"}, {"$set": {"applied": True}})
+    assert await award_points("u1", PointAction.PURCHASE, amount_spent=20.0, transaction_id="o1:purchase") == 0
+    assert await balance(db, "u1") == 20
+
+
+@pytest.mark.anyio
+async def test_badges_left_pending_by_a_dead_process_are_settled_once(db):
+    await add_user(db, "u1", points=1600)
+    await db.users.update_one({"id": "u1"}, {"$set": {"level": "Premium", "badge_pending": "Premium"}})
+
+    assert await server.settle_pending_badges() == 1
+    assert await server.settle_pending_badges() == 0
+    assert await db.badges.count_documents({"user_id": "u1", "badge_type": "premium"}) == 1
+
+
+@pytest.mark.anyio
+async def test_bulk_sums_per_user_and_skips_unknown_users(db):
+    await add_user(db, "u1")
+    await add_user(db, "u2", points=490)
+
+    summary = await award_points_bulk([
+        ("u1", "video_completion", None), ("u1", "video_completion", 5, "bonus"),
+        ("u2", "monthly_membership", 20), ("ghost", "monthly_membership", 20), ("u1", "video_completion", 0)
+    ])
+
+    assert summary["transactions"] == 3 and summary["users"] == 2
+    assert summary["points"] == server.POINT_VALUES[PointAction.VIDEO_COMPLETION] + 25
+    assert summary["skipped"] == 2 and summary["unknown_users"] == ["ghost"]
+    assert await balance(db, "u1") == server.POINT_VALUES[PointAction.VIDEO_COMPLETION] + 5
+    u2 = await db.users.find_one({"id": "u2"})
+    assert u2["level"] == "Active" and "badge_pending" not in u2
+    assert summary["badges_awarded"] == 1 and await db.badges.count_documents({"user_id": "u2"}) == 1
+    assert await db.points_transactions.count_documents({"applied": True}) == 3
+
+
+@pytest.mark.anyio
+async def test_monthly_grant_pays_each_month_once(db):
+    await add_user(db, "u1")
+    await add_user(db, "u2", membership_level="premium")
+
+    first = await grant_monthly_membership_points(batch_size=1, month="2026-01")
+    paid = {user_id: await balance(db, user_id) for user_id in ("u1", "u2")}
+    again = await grant_monthly_membership_points(month="2026-01")
+
+    assert first["transactions"] == 2 and paid["u2"] > paid["u1"] > 0
+    assert again["transactions"] == 0 and again["duplicates"] == 2
+    assert {user_id: await balance(db, user_id) for user_id in ("u1", "u2")} == paid
+    assert (await grant_monthly_membership_points(month="2026-02"))["transactions"] == 2
+
+
+@pytest.mark.anyio
+async def test_repeated_ids_in_one_call_are_counted_as_duplicates(db):
+    await add_user(db, "u1")
+    summary = await award_points_bulk([("u1", "monthly_membership", 10, None, "t1")] * 3)
+    assert summary["transactions"] == 1 and summary["duplicates"] == 2
+    assert await balance(db, "u1") == 10
+
+
+@pytest.mark.anyio
+async def test_rerun_finishes_rows_a_crashed_run_left_behind(db):
+    await add_user(db, "u1")
+    # t1: crashed before the balance update; t2: after it, before the rows were finished
+    await left_unapplied(db, "t1", "u1", 10, credited=False)
+    await left_unapplied(db, "t2", "u1", 20, credited=True)
+
+    summary = await award_points_bulk([("u1", "monthly_membership", 10, None, "t1"), ("u1", "monthly_membership", 20, None, "t2")])
+
+    assert summary["duplicates"] == 0 and summary["in_flight"] == 0
+    assert await balance(db, "u1") == 30
+    user = await db.users.find_one({"id": "u1"})
+    assert user["pending_award_ids"] == []
+    assert await db.points_transactions.count_documents({"applied": True}) == 2
+
+
+@pytest.mark.anyio
+async def test_rows_a_live_run_holds_are_left_to_it(db):
+    await add_user(db, "u1")
+    await left_unapplied(db, "t1", "u1", 10, credited=False, claimed_at=datetime.now(timezone.utc))
+
+    summary = await award_points_bulk([("u1", "monthly_membership", 10, None, "t1")])
+
+    assert summary["in_flight"] == 1 and summary["transactions"] == 0
+    assert await balance(db, "u1") == 0
+
+
+@pytest.mark.anyio
+async def test_many_awards_for_one_user_are_credited_once_after_a_crash(db, monkeypatch):
+    await add_user(db, "u1")
+    awards = [("u1", "monthly_membership", 1, None, f"t{n}") for n in range(120)]
+
+    async def crash(awards_by_user, claim):
+        raise RuntimeError("process died")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(server, "finish_awards", crash)
+        with pytest.raises(RuntimeError):
+            await award_points_bulk(awards)
+    assert await balance(db, "u1") == 120
+
+    # Still claimed by the dead run, so nothing happens until the claim goes stale
+    assert (await award_points_bulk(awards))["in_flight"] == 120
+    monkeypatch.setattr(server, "AWARD_CLAIM_SECONDS", 0)
+    summary = await award_points_bulk(awards)
+
+    assert summary["transactions"] == 120 and await balance(db, "u1") == 120
+    assert (await db.users.find_one({"id": "u1"}))["pending_award_ids"] == []
+    assert (await award_points_bulk(awards))["duplicates"] == 120
+
+
+@pytest.mark.anyio
+async def test_bulk_endpoint_needs_the_admin_token_and_caps_the_request(db, api, monkeypatch):
+    await add_user(db, "u1")
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", "admin")
+    award = {"user_id": "u1", "action": "monthly_membership", "amount": 5}
+
+    assert (await api.post("/api/points/bulk", json={"awards": [award]})).status_code == 403
+    response = await api.post("/api/points/bulk", json={"awards": [award]}, headers={"X-Admin-Token": "admin"})
+    assert response.status_code == 200 and response.json()["points"] == 5
+
+    too_many = {"awards": [award] * (server.BULK_AWARD_REQUEST_LIMIT + 1)}
+    assert (await api.post("/api/points/bulk", json=too_many, headers={"X-Admin-Token": "admin"})).status_code == 422
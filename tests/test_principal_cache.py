@@ -0,0 +1,70 @@
+import pytest
+
+import server
+from server import PrincipalCache
+
+
+@pytest.fixture
+def cache():
+    return PrincipalCache(ttl_seconds=30, fallback_ttl_seconds=5)
+
+
+def make_user(user_id="u1", points=0):
+    return server.User(id=user_id, email=f"{user_id}@example.com", name=user_id, role=server.UserRole.CLIENT, password_hash="x", points=points)
+
+
+@pytest.mark.anyio
+async def test_repeat_requests_are_served_from_the_cache(db, api, user, auth_headers):
+    before = server.principal_cache.stats()
+    for _ in range(3):
+        response = await api.get("/api/auth/me", headers=auth_headers)
+        assert response.status_code == 200 and response.json()["id"] == user.id
+    stats = server.principal_cache.stats()
+    assert stats["misses"] - before["misses"] == 1 and stats["hits"] - before["hits"] == 2
+
+
+@pytest.mark.anyio
+async def test_local_writes_invalidate_the_cached_principal(db, api, user, auth_headers):
+    await api.get("/api/auth/me", headers=auth_headers)
+    await db.users.update_one({"id": user.id}, {"$set": {"points": 999}})
+    server.invalidate_principal(user.id)
+    assert (await api.get("/api/auth/me", headers=auth_headers)).json()["points"] == 999
+
+
+def test_change_events_drop_the_entry_and_refuse_lookups_in_flight(cache):
+    generation = cache.generation("u1")
+    cache.put(make_user(), generation, key="oid-1")
+    assert cache.get("u1") is not None
+
+    # Another process wrote the document
+    cache.changed("oid-1")
+    assert cache.get("u1") is None
+
+    # A lookup that read the document before an event for anyone cannot cache it
+    generation = cache.generation("u1")
+    cache.changed("oid-other")
+    cache.put(make_user(), generation, key="oid-1")
+    assert cache.get("u1") is None
+
+
+def test_entries_only_get_the_full_ttl_while_a_change_stream_runs(cache):
+    assert cache.entry_ttl == 5
+    cache.refresh_mode = "change_stream"
+    assert cache.entry_ttl == 30
+
+
+@pytest.mark.anyio
+async def test_without_change_streams_the_cache_falls_back_to_the_short_ttl(db, cache):
+    # mongomock, like a standalone mongod, has no change streams
+    await cache.start()
+    await cache._task
+    assert cache.stats()["refresh_mode"] == "ttl" and cache.stats()["ttl_seconds"] == 5
+    await cache.stop()
+
+
+@pytest.mark.anyio
+async def test_system_stats_need_the_admin_token(db, api, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", "admin")
+    assert (await api.get("/api/system/stats")).status_code == 403
+    response = await api.get("/api/system/stats", headers={"X-Admin-Token": "admin"})
+    assert response.status_code == 200 and "principal_cache" in response.json()
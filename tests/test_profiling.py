@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import pytest
+
+import server
+from server import LoopLagMonitor, SamplingProfiler, SpanTimings
+
+
+def busy(seconds):
+    ends_at = time.perf_counter() + seconds
+    while time.perf_counter() < ends_at:
+        pass
+
+
+def test_disabled_spans_are_a_shared_no_op():
+    timings = SpanTimings(enabled=False)
+    with timings.span("decode") as first, timings.span("encode") as second:
+        pass
+    assert first is second and timings.stats() == {"enabled": False, "spans": {}}
+
+
+def test_enabled_spans_total_calls_time_and_max():
+    timings = SpanTimings(enabled=True)
+    timings.record("decode", 0.002)
+    timings.record("decode", 0.004)
+    with timings.span("encode"):
+        pass
+    spans = timings.stats()["spans"]
+    assert spans["decode"] == {"count": 2, "total_ms": 6.0, "avg_ms": 3.0, "max_ms": 4.0}
+    assert spans["encode"]["count"] == 1
+    timings.reset()
+    assert timings.stats()["spans"] == {}
+
+
+@pytest.mark.anyio
+async def test_timed_routes_record_request_and_response_validation(catalog, api, monkeypatch):
+    timings = SpanTimings(enabled=True)
+    monkeypatch.setattr(server, "span_timings", timings)
+    assert (await api.get("/api/products/p1")).status_code == 200
+    spans = timings.stats()["spans"]
+    assert spans["validation.request"]["count"] == 1 and spans["validation.response"]["count"] == 1
+
+
+@pytest.mark.anyio
+async def test_the_watchdog_reports_a_blocked_loop_once_per_stall():
+    monitor = LoopLagMonitor(interval=0.01, stall_seconds=0.05)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.02)
+        busy(0.3)
+        await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+    assert monitor.stalls == 1 and monitor.max_lag >= 0.2
+
+
+@pytest.mark.anyio
+async def test_the_profiler_folds_the_loop_threads_stacks():
+    profiler = SamplingProfiler(hz=200, max_stacks=100)
+    profiler.start()
+    try:
+        busy(0.2)
+    finally:
+        profiler.stop()
+    assert profiler.samples > 0 and not profiler.stats()["running"]
+    lines = profiler.folded().splitlines()
+    assert any("busy (test_profiling.py" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+@pytest.mark.anyio
+async def test_profiler_endpoints_need_the_admin_token(api, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", "admin")
+    monkeypatch.setattr(server, "span_timings", SpanTimings(enabled=False))
+    assert (await api.get("/api/admin/profiler")).status_code == 403
+
+    response = await api.post("/api/admin/profiler", json={"spans": True}, headers={"X-Admin-Token": "admin"})
+    assert response.status_code == 200 and server.span_timings.enabled
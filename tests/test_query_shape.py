@@ -0,0 +1,37 @@
+from server import command_shape, query_shape
+
+
+def aggregate(*pipeline):
+    return {"aggregate": "orders", "pipeline": list(pipeline)}
+
+
+def test_values_are_replaced_by_type_names():
+    assert query_shape({"user_id": "u1", "total": {"$gte": 10}}) == {"user_id": "str", "total": {"$gte": "int"}}
+
+
+def test_in_lists_share_a_shape_regardless_of_length():
+    assert query_shape({"id": {"$in": ["a"]}}) == query_shape({"id": {"$in": ["a", "b", "c"]}})
+
+
+def test_or_branches_are_kept():
+    assert query_shape({"$or": [{"a": 1}, {"b": "x"}]}) == {"$or": [{"a": "int"}, {"b": "str"}]}
+
+
+def test_pipelines_with_same_match_but_different_later_stages_differ():
+    match = {"$match": {"user_id": "u1"}}
+    grouped = command_shape("aggregate", aggregate(match, {"$group": {"_id": "$status", "n": {"$sum": 1}}}))
+    sorted_ = command_shape("aggregate", aggregate(match, {"$sort": {"created_at": -1}}, {"$limit": 10}))
+    assert grouped != sorted_
+    assert grouped == [{"$match": {"user_id": "str"}}, {"$group": {"_id": "...", "n": "..."}}]
+    assert sorted_ == [{"$match": {"user_id": "str"}}, {"$sort": {"created_at": "..."}}, {"$limit": "..."}]
+
+
+def test_pipeline_shape_ignores_match_values():
+    first = command_shape("aggregate", aggregate({"$match": {"user_id": "u1"}}, {"$limit": 5}))
+    second = command_shape("aggregate", aggregate({"$match": {"user_id": "u2"}}, {"$limit": 50}))
+    assert first == second
+
+
+def test_find_without_filter_has_no_shape():
+    assert command_shape("find", {"find": "users"}) is None
+    assert command_shape("update", {"update": "users", "updates": [{"q": {"id": "u1"}, "u": {}}]}) == {"id": "str"}
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+import server
+from server import CausalTokens, read_collection
+
+
+class FakeSession:
+    def __init__(self, cluster_time, operation_time):
+        self.cluster_time = cluster_time
+        self.operation_time = operation_time
+
+
+@pytest.mark.anyio
+async def test_every_read_uses_the_primary_with_routing_off(db):
+    for consistency in ("strong", "eventual", "user"):
+        assert read_collection("orders", consistency).read_preference == Primary()
+
+
+@pytest.mark.anyio
+async def test_eventual_reads_use_bounded_secondaries_with_routing_on(db, monkeypatch):
+    monkeypatch.setattr(server, "READ_ROUTING_ENABLED", True)
+    eventual = read_collection("orders", "eventual")
+    assert eventual.read_preference == SecondaryPreferred(max_staleness=server.MAX_STALENESS_SECONDS)
+    assert read_collection("orders", "eventual") is eventual
+    assert read_collection("orders", "strong").read_preference == Primary()
+
+
+@pytest.mark.anyio
+async def test_user_reads_stay_on_the_primary_unless_causal_reads_are_on(db, monkeypatch):
+    monkeypatch.setattr(server, "READ_ROUTING_ENABLED", True)
+    assert read_collection("badges", "user").read_preference == Primary()
+
+    monkeypatch.setattr(server, "CAUSAL_READS_ENABLED", True)
+    assert isinstance(read_collection("badges", "user").read_preference, SecondaryPreferred)
+
+
+@pytest.mark.anyio
+async def test_causal_write_runs_without_a_session_when_causal_reads_are_off(db):
+    sessions = []
+
+    async def operation(session):
+        sessions.append(session)
+        return "written"
+
+    assert await server.causal_write("u1", operation) == "written"
+    assert sessions == [None]
+    async with server.read_session("u1") as session:
+        assert session is None
+
+
+def test_causal_tokens_keep_the_latest_position_per_user():
+    tokens = CausalTokens(ttl_seconds=60)
+    tokens.record("u1", FakeSession({"clusterTime": 5}, 5))
+    tokens.record("u1", FakeSession({"clusterTime": 3}, 3))
+    assert tokens.get("u1") == ({"clusterTime": 5}, 5)
+    tokens.record("u1", None)
+    assert tokens.stats() == {"users": 1}
+
+
+def test_causal_tokens_expire_and_evict_the_oldest_user(monkeypatch):
+    tokens = CausalTokens(ttl_seconds=60, max_entries=2)
+    for user_id in ("u1", "u2", "u3"):
+        tokens.record(user_id, FakeSession({"clusterTime": 1}, 1))
+    assert tokens.get("u1") is None and tokens.get("u3") is not None
+
+    now = time.monotonic()
+    monkeypatch.setattr(server.time, "monotonic", lambda: now + 61)
+    assert tokens.get("u3") is None